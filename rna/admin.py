@@ -2,32 +2,221 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from datetime import datetime
+import hashlib
+import json
 
 from django import forms
+from django.conf import settings
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.paginator import InvalidPage, Paginator
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Q
+from django.http import HttpResponse
 from pagedown.widgets import AdminPagedownWidget
 
 # For the display of the images
 from django.utils.safestring import mark_safe
 from django.contrib.admin.widgets import AdminFileWidget
 
-from . import models
+from . import images, metrics, models, utils
 
 
 class AdminImageWidget(AdminFileWidget):
     """subclass the AdminFileWidget in order to display the image"""
     def render(self, name, value, attrs=None):
         output = []
+        # use the stored dimensions and thumbnail rather than opening
+        # the image from storage on every render
+        instance = getattr(value, 'instance', None)
         if value:
-            output.append(u'<div>{0} size: {1}x{2}</div>'.format(value, value.width, value.height))
+            output.append(u'<div>{0} size: {1}x{2}</div>'.format(
+                value, getattr(instance, 'image_width', None),
+                getattr(instance, 'image_height', None)))
         output.append(super(AdminFileWidget, self).render(name, value, attrs))
         if value and getattr(value, "url", None):
-            img = u'<div><img src="{0}" height="128px"/></div>'.format(value.url)
+            url = images.variant_urls(value).get('thumbnail', value.url)
+            img = u'<div><img src="{0}" height="128px"/></div>'.format(url)
             output.append(img)
         return mark_safe(u''.join(output))
 
 
+def cached_count(queryset):
+    """
+    Return queryset.count(), caching counts of at least
+    RNA['ADMIN_COUNT_THRESHOLD'] rows for RNA['ADMIN_COUNT_TIMEOUT']
+    seconds, keyed by the query's SQL, since an exact count of a large
+    table costs more than it is worth on every changelist load.
+    """
+    try:
+        sql = str(queryset.query)
+    except Exception:  # e.g. EmptyResultSet
+        return queryset.count()
+    key = 'rna:count:' + hashlib.md5(sql).hexdigest()
+    count = cache.get(key)
+    metrics.inc('rna_cache_requests_total', cache='admin_count',
+                result='miss' if count is None else 'hit')
+    if count is None:
+        count = queryset.count()
+        if count >= settings.RNA.get('ADMIN_COUNT_THRESHOLD', 10000):
+            cache.set(key, count, settings.RNA.get('ADMIN_COUNT_TIMEOUT', 300))
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    def _get_count(self):
+        if self._count is None:
+            self._count = cached_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class CachedCountChangeList(ChangeList):
+    def get_results(self, request):
+        # as ChangeList.get_results, but with cached full result counts,
+        # and previews only in the listed rows: deferred instances are of
+        # a proxy class, which the sender=Note signal handlers don't see
+        query_set = self.model_admin.preview_queryset(self.query_set)
+        paginator = self.model_admin.get_paginator(
+            request, query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = cached_count(self.root_query_set)
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class HighVolumeAdminMixin(object):
+    """
+    Changelist with cached counts above a threshold, and text previews
+    computed in SQL for the fields named in preview_fields, which are
+    otherwise deferred, so that long text is never loaded for a list.
+    Other views load whole objects.
+    """
+    paginator = CachedCountPaginator
+    preview_fields = ()
+    preview_length = 100
+
+    def get_changelist(self, request, **kwargs):
+        return CachedCountChangeList
+
+    def preview_queryset(self, qs):
+        if not self.preview_fields:
+            return qs
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        select = dict(
+            ('%s_preview' % f,
+             'SUBSTR(%s.%s, 1, %d)' % (table, qn(f), self.preview_length))
+            for f in self.preview_fields)
+        return qs.extra(select=select).defer(*self.preview_fields)
+
+
+def preview(field):
+    """Return a list_display method for a HighVolumeAdminMixin preview"""
+    def field_preview(self, obj):
+        return getattr(obj, '%s_preview' % field)
+    field_preview.short_description = field
+    field_preview.admin_order_field = field
+    return field_preview
+
+
+class ReleaseVersionListFilter(admin.SimpleListFilter):
+    """
+    Filter notes by release version, offering the versions of the most
+    recent releases rather than a distinct list over the whole join.
+    Other versions can be used through the query string.
+    """
+    title = 'release version'
+    parameter_name = 'release_version'
+    choice_count = 30
+
+    def lookups(self, request, model_admin):
+        versions = []
+        for version in models.Release.objects.order_by(
+                '-release_date').values_list('version', flat=True)[
+                :self.choice_count]:
+            if version not in versions:
+                versions.append(version)
+        # lookups() runs before the filter has read its parameter
+        current = request.GET.get(self.parameter_name)
+        if current and current not in versions:
+            versions.insert(0, current)
+        return [(v, v) for v in versions]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__in=models.Note.releases.through.objects.filter(
+                release__version=self.value()).values('note'))
+
+
+class ReleaseProductListFilter(admin.SimpleListFilter):
+    title = 'release product'
+    parameter_name = 'release_product'
+
+    def lookups(self, request, model_admin):
+        return [(p, p) for p in models.Release.PRODUCTS]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__in=models.Note.releases.through.objects.filter(
+                release__product=self.value()).values('note'))
+
+
+def search_releases(q):
+    """
+    Return releases matching every whitespace separated term of q by
+    version prefix, which can use the version index, or by product or
+    channel.
+    """
+    releases = models.Release.objects.all()
+    for term in q.split():
+        releases = releases.filter(
+            Q(version__startswith=term) | Q(product__icontains=term) |
+            Q(channel__iexact=term))
+    return releases
+
+
+class ReleaseAutocompleteWidget(forms.SelectMultiple):
+    """
+    Multiple select that renders only the selected releases, with a
+    search box that pages through the rest from ReleaseAdmin.autocomplete
+    """
+    class Media:
+        js = ('js/release_autocomplete.js',)
+
+    def render(self, name, value, attrs=None, choices=()):
+        self.choices = [(r.pk, unicode(r)) for r in
+                        models.Release.objects.filter(pk__in=value or [])]
+        attrs = dict(attrs or {})
+        attrs['data-autocomplete-url'] = reverse(
+            'admin:rna_release_autocomplete')
+        return super(ReleaseAutocompleteWidget, self).render(
+            name, value, attrs, choices)
+
+
 class NoteAdminForm(forms.ModelForm):
     note = forms.CharField(widget=AdminPagedownWidget())
 
@@ -35,15 +224,23 @@ class NoteAdminForm(forms.ModelForm):
         model = models.Note
 
 
-class NoteAdmin(admin.ModelAdmin):
+class NoteAdmin(HighVolumeAdminMixin, admin.ModelAdmin):
     form = NoteAdminForm
-    filter_horizontal = ['releases']
-    list_display = ('id', 'bug', 'tag', 'note', 'created')
+    list_display = ('id', 'bug', 'tag', 'note_preview', 'created')
     list_display_links = ('id',)
-    list_filter = ('tag', 'is_known_issue', 'releases__product',
-                   'releases__version')
+    list_filter = ('tag', 'is_known_issue', ReleaseProductListFilter,
+                   ReleaseVersionListFilter)
+    preview_fields = ('note',)
     search_fields = ('bug', 'note', 'releases__version')
 
+    note_preview = preview('note')
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        if db_field.name == 'releases':
+            kwargs['widget'] = ReleaseAutocompleteWidget
+        return super(NoteAdmin, self).formfield_for_manytomany(
+            db_field, request, **kwargs)
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         if db_field.name == 'image':  # The model has an 'image' field
             kwargs['widget'] = AdminImageWidget
@@ -62,11 +259,12 @@ class ReleaseAdminForm(forms.ModelForm):
         model = models.Release
 
 
-class ReleaseAdmin(admin.ModelAdmin):
+class ReleaseAdmin(HighVolumeAdminMixin, admin.ModelAdmin):
     actions = ['copy_releases']
     form = ReleaseAdminForm
     list_display = ('version', 'product', 'channel', 'is_public',
-                    'release_date', 'text', 'url')
+                    'release_date', 'text_preview', 'url')
+    preview_fields = ('text',)
     list_filter = ('product', 'channel', 'is_public')
     ordering = ('-release_date',)
     search_fields = ('version', 'text')
@@ -93,28 +291,45 @@ class ReleaseAdmin(admin.ModelAdmin):
                     staging=base_url_staging, product=product, version=obj.version, prod=base_url_prod))
 
     url.allow_tags = True
+    text_preview = preview('text')
+    autocomplete_per_page = 20
+
+    def get_urls(self):
+        return patterns(
+            '',
+            url(r'^autocomplete/$',
+                self.admin_site.admin_view(self.autocomplete),
+                name='rna_release_autocomplete'),
+        ) + super(ReleaseAdmin, self).get_urls()
+
+    def autocomplete(self, request):
+        """
+        One page of releases matching the q parameter, as JSON, fetching
+        one row beyond the page to tell if there are more rather than
+        counting them all.
+        """
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        start = (page - 1) * self.autocomplete_per_page
+        releases = list(search_releases(request.GET.get('q', '')).values_list(
+            'id', 'product', 'version', 'channel')[
+            start:start + self.autocomplete_per_page + 1])
+        return HttpResponse(
+            content=json.dumps({
+                'results': [
+                    {'id': pk, 'text': '%s %s %s' % (product, version, channel)}
+                    for pk, product, version, channel in
+                    releases[:self.autocomplete_per_page]],
+                'more': len(releases) > self.autocomplete_per_page}),
+            content_type='application/json')
 
     def copy_releases(self, request, queryset):
-        release_count = 0
-        for release in queryset:
-            release_count += 1
-            copy_count = self.model.objects.filter(
-                version__endswith=release.version,
-                product=release.product).count()
-            notes = list(release.note_set.all())
-            copy = release
-            copy.id = None
-            if copy_count > 1:
-                copy.version = 'copy%s-%s' % (copy_count, copy.version)
-            else:
-                copy.version = 'copy-' + copy.version
-            # By default, set it to public. Usually, the copy feature is used
-            # when copying aurora => beta or beta => release. We want to review
-            # it before going live
-            copy.is_public = False
-            copy.save()
-            copy.note_set.add(*notes)
-            copy.note_set.update(modified=datetime.now())
+        # The copies are not public by default. Usually, the copy feature
+        # is used when copying aurora => beta or beta => release. We want
+        # to review it before going live
+        release_count = len(utils.copy_releases(queryset))
         if release_count == 1:
             self.message_user(request, 'Copied Release')
         else:
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Timings and query counts for the RNA hot paths, run by the rnabench
+management command against a generated dataset.
+"""
+
+import json
+import time
+
+from django.conf import settings
+from django.test.client import RequestFactory
+from rest_framework.request import Request
+
+from . import clients, filters, models, profiling, views
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def render(view, request, **kwargs):
+    response = view(request, **kwargs)
+    response.render()
+    return response
+
+
+@benchmark
+def release_notes():
+    release = models.Release.objects.order_by('id')[0]
+    return lambda: release.notes()
+
+
+@benchmark
+def release_page():
+    release = models.Release.objects.order_by('id')[0]
+    return lambda: release.page()
+
+
+@benchmark
+def equivalent_release_for_product():
+    release = models.Release.objects.filter(
+        product='Firefox', channel='Release').order_by('id')[0]
+    return lambda: release.equivalent_release_for_product(
+        'Firefox for Android')
+
+
+@benchmark
+def notes_list():
+    view = views.NoteViewSet.as_view({'get': 'list'})
+    request = RequestFactory().get('/notes/')
+    return lambda: render(view, request)
+
+
+@benchmark
+def releases_list():
+    view = views.ReleaseViewSet.as_view({'get': 'list'})
+    request = RequestFactory().get('/releases/')
+    return lambda: render(view, request)
+
+
+@benchmark
+def nested_notes():
+    view = views.NestedNoteView.as_view()
+    pk = models.Release.objects.order_by('id')[0].pk
+    request = RequestFactory().get('/releases/%s/notes/' % pk)
+    return lambda: render(view, request, pk=pk)
+
+
+@benchmark
+def timestamped_filter_backend():
+    view = views.NoteViewSet()
+    request = Request(RequestFactory().get(
+        '/notes/', {'modified_after': '2014-01-01T00:00:00'}))
+    queryset = models.Note.objects.all()
+    backend = filters.TimestampedFilterBackend()
+    # the filter set class is built for every request, so time only that
+    return lambda: backend.filter_queryset(request, queryset, view)
+
+
+@benchmark
+def restore():
+    client = clients.RNAModelClient(base_url='http://testserver/')
+    serializer = client.serializer(models.Note)
+    response = render(views.NoteViewSet.as_view({'get': 'list'}),
+                      RequestFactory().get('/notes/'))
+    data = json.loads(response.content)[:100]
+
+    def restore_notes():
+        for d in data:
+            client.restore(serializer, dict(d))
+    return restore_notes
+
+
+def measure(setup, repeat=5):
+    """
+    Call setup() once and the function it returns repeat times, returning
+    the minimum and median seconds and the queries made per call.
+    """
+    func = setup()
+    times = []
+    for i in range(repeat):
+        with profiling.query_stats() as stats:
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'queries': stats.count}
+
+
+def run(names=None, repeat=5):
+    return dict((b.__name__, measure(b, repeat)) for b in BENCHMARKS
+                if not names or b.__name__ in names)
+
+
+def compare(results, baseline, time_threshold=None, query_threshold=None):
+    """
+    Return messages for the benchmarks whose median time exceeds the
+    baseline's by more than the time_threshold fraction, or whose query
+    count exceeds it by more than query_threshold.
+    """
+    if time_threshold is None:
+        time_threshold = settings.RNA.get('BENCHMARK_TIME_THRESHOLD', 0.25)
+    if query_threshold is None:
+        query_threshold = settings.RNA.get('BENCHMARK_QUERY_THRESHOLD', 0)
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['median'] > base['median'] * (1 + time_threshold):
+            regressions.append('%s: %.4fs against %.4fs' % (
+                name, result['median'], base['median']))
+        if result['queries'] > base['queries'] + query_threshold:
+            regressions.append('%s: %s queries against %s' % (
+                name, result['queries'], base['queries']))
+    return regressions
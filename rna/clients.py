@@ -2,19 +2,195 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import contextlib
+from email.utils import mktime_tz, parsedate_tz
+import hashlib
+import json
+import random
 import re
+import threading
+import time
+from urlparse import urlparse
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 import requests
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from rest_framework.compat import parse_datetime
 
-from . import models, serializers
+from . import httpcache, metrics, models, serializers
+
+# methods that are safe to send again when a response did not arrive
+RETRY_METHODS = ('get', 'head', 'options', 'put', 'delete')
+RETRY_STATUSES = (429, 502, 503, 504)
+
+_local = threading.local()
+_breakers = {}
+_breakers_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class DeadlineExceeded(RequestException):
+    pass
+
+
+class CircuitOpen(RequestException):
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Fail the requests made in the block once seconds have passed, and
+    shorten their timeouts and retries to fit, so that a slow upstream
+    cannot hold up a sync indefinitely.
+    """
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = time.time() + seconds
+    if previous is not None:
+        _local.deadline = min(previous, _local.deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def time_left():
+    """Seconds until the deadline of the current block, or None"""
+    end = getattr(_local, 'deadline', None)
+    if end is not None:
+        return end - time.time()
+
+
+def clear_caches():
+    """Empty the response cache of every shared model client"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.cache.clear()
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast for reset_timeout seconds after threshold failures in a
+    row, then let a single request through to find out whether upstream
+    is back.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.reset_timeout:
+                # others keep failing fast while this request tries
+                self.opened = time.time()
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened = time.time()
+
+
+def get_breaker(url):
+    """The circuit breaker shared by all requests to url's host"""
+    host = urlparse(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(
+                settings.RNA.get('CIRCUIT_BREAKER_THRESHOLD', 5),
+                settings.RNA.get('CIRCUIT_BREAKER_RESET', 30))
+        return _breakers[host]
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to a response's Retry-After header, given
+    in seconds or as an HTTP date, or None if it has none.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date:
+        return max(mktime_tz(date) - time.time(), 0)
+
+
+def iter_json_list(chunks):
+    """
+    Decode a JSON list from an iterable of byte strings, yielding each
+    item as soon as it has been read, so that memory use depends on the
+    size of one item rather than of the whole list. A document that is
+    not a list is yielded whole.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+
+    def skip(buf, pos, chars=' \t\n\r'):
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    def read(buf, pos):
+        # drop what has been decoded, then add the next chunk
+        for chunk in chunks:
+            if chunk:
+                return buf[pos:] + chunk, 0
+        raise StopIteration
+
+    try:
+        while skip(buf, pos) == len(buf):
+            buf, pos = read(buf, pos)
+    except StopIteration:
+        raise ValueError('No JSON document in the response')
+    pos = skip(buf, pos)
+    if buf[pos] != '[':
+        yield json.loads(buf[pos:] + ''.join(chunks))
+        return
+    pos += 1
+    while True:
+        pos = skip(buf, pos, ' \t\n\r,')
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+            # a number may continue in the next chunk, so only trust an
+            # item followed by the end of the item
+            end = skip(buf, end)
+            if end == len(buf) or buf[end] not in ',]':
+                raise ValueError('Item may be incomplete')
+        except ValueError:
+            try:
+                buf, pos = read(buf, pos)
+            except StopIteration:
+                raise ValueError('Truncated or invalid JSON list in the '
+                                 'response')
+            continue
+        yield item
+        pos = end
 
 
 class RestClient(object):
     full_url_regex = re.compile('^https?://.*')
 
-    def __init__(self, base_url='', token='', cache=None):
+    def __init__(self, base_url='', token='', cache=None, session=None,
+                 http_cache=None):
         """Initialize a RestClient instance.
 
         Args:
@@ -24,32 +200,153 @@ class RestClient(object):
             token (str): Token to add to Authorization HTTP header.
                 Defaults to settings.RNA.get('TOKEN', '')
             cache (dict): Defaults to empty dict
+            session (requests.Session): Session to make requests with,
+                reusing its connections. Defaults to a new connection
+                per request
+            http_cache (httpcache.DiskCache): Persistent cache consulted
+                when cache misses. Defaults to one at
+                settings.RNA['HTTP_CACHE_PATH'] if set
         """
         self.base_url = base_url or settings.RNA['BASE_URL']
         self.cache = cache or {}
         self.token = token or settings.RNA.get('TOKEN', '')
+        self.session = session
+        if http_cache is None and settings.RNA.get('HTTP_CACHE_PATH'):
+            http_cache = httpcache.DiskCache(settings.RNA['HTTP_CACHE_PATH'])
+        self.http_cache = http_cache
 
-    def request(self, method, url, **kwargs):
+    def full_url(self, url):
         if self.base_url and not self.full_url_regex.match(url):
-            url = self.base_url + url
+            return self.base_url + url
+        return url
+
+    def http_cache_key(self, method, url):
+        # responses may depend on who asks
+        return '%s %s %s' % (method.upper(), self.full_url(url),
+                             hashlib.md5(self.token).hexdigest())
+
+    def fetch(self, method, url, **kwargs):
+        """
+        Make a request through the persistent HTTP cache if there is one:
+        answer from a fresh stored response, revalidate a stale one and
+        store successful responses.
+        """
+        if not self.http_cache:
+            return self.request(method, url, **kwargs)
+        key = self.http_cache_key(method, url)
+        cached = self.http_cache.get(key)
+        if cached and cached.fresh:
+            metrics.inc('rna_cache_requests_total', cache='disk',
+                        result='hit')
+            return cached.response()
+        if cached:
+            kwargs['headers'] = dict(cached.validators(),
+                                     **kwargs.get('headers', {}))
+        response = self.request(method, url, **kwargs)
+        if cached and response.status_code == 304:
+            metrics.inc('rna_cache_requests_total', cache='disk',
+                        result='revalidated')
+            refreshed = self.http_cache.refresh(key, response)
+            if refreshed is None:
+                # evicted since it was read, so store it again
+                cached.revalidate(response)
+                self.http_cache.set(key, cached.response())
+                return cached.response()
+            return refreshed.response()
+        metrics.inc('rna_cache_requests_total', cache='disk', result='miss')
+        if response.status_code == 200:
+            self.http_cache.set(key, response)
+        return response
+
+    def forget(self, url):
+        self.cache.pop(url, None)
+        if self.http_cache:
+            for method in ('get', 'options'):
+                self.http_cache.pop(self.http_cache_key(method, url))
+
+    def request(self, method, url, **kwargs):
+        url = self.full_url(url)
         if self.token:
             kwargs.setdefault('headers', {})
             kwargs['headers'].setdefault(
                 'Authorization', 'Token ' + self.token)
         if not settings.RNA.get('VERIFY_SSL_CERT', True):
             kwargs['verify'] = False
-        return requests.request(method, url, **kwargs)
+        timeout = kwargs.pop('timeout', settings.RNA.get('TIMEOUT', (5, 30)))
+        breaker = get_breaker(url)
+        retries = 0
+        if method.lower() in RETRY_METHODS:
+            retries = settings.RNA.get('RETRIES', 3)
+
+        attempt = 0
+        while True:
+            left = time_left()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded('Deadline passed before %s %s' % (
+                    method.upper(), url))
+            if not breaker.allow():
+                raise CircuitOpen('Not sending %s %s, %s is failing' % (
+                    method.upper(), url, urlparse(url).netloc))
+            if left is not None:
+                if isinstance(timeout, tuple):
+                    kwargs['timeout'] = tuple(min(t, left) for t in timeout)
+                else:
+                    kwargs['timeout'] = min(timeout, left)
+            else:
+                kwargs['timeout'] = timeout
+
+            response = error = None
+            try:
+                response = (self.session or requests).request(
+                    method, url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                error = e
+                delay = self.retry_delay(attempt)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record(response.status_code < 500)
+                    return response
+                delay = self.retry_delay(attempt, response)
+
+            left = time_left()
+            if (attempt >= retries or delay is None or
+                    (left is not None and delay >= left)):
+                # one failure per request, however many attempts it made
+                breaker.record(error is None and response.status_code < 500)
+                if error:
+                    raise error
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Seconds to wait before retrying: what the response's Retry-After
+        asks for, or a jittered exponential backoff. None if Retry-After
+        asks for longer than RNA['RETRY_MAX_DELAY'].
+        """
+        max_delay = settings.RNA.get('RETRY_MAX_DELAY', 60)
+        delay = retry_after(response) if response is not None else None
+        if delay is not None:
+            return delay if delay <= max_delay else None
+        # full jitter, so that clients failing together do not retry
+        # together
+        return random.uniform(0, min(
+            settings.RNA.get('RETRY_BACKOFF', 0.5) * 2 ** attempt,
+            max_delay))
 
     def delete(self, url='', **kwargs):
-        self.cache.pop(url, None)
+        self.forget(url)
         return self.request('delete', url, **kwargs)
 
     def get(self, url='', **kwargs):
         if kwargs.get('params', None):
             return self.request('get', url, **kwargs)
         response = self.cache.get(url)
+        metrics.inc('rna_cache_requests_total', cache='client',
+                    result='hit' if response else 'miss')
         if not response:
-            response = self.request('get', url, **kwargs)
+            response = self.fetch('get', url, **kwargs)
             if response.status_code == 200:
                 self.cache[url] = response
         return response
@@ -57,61 +354,86 @@ class RestClient(object):
     def options(self, url='', **kwargs):
         self.cache.setdefault('OPTIONS', {})
         if url not in self.cache['OPTIONS']:
-            self.cache['OPTIONS'][url] = self.request('options', url, **kwargs)
+            self.cache['OPTIONS'][url] = self.fetch('options', url, **kwargs)
         return self.cache['OPTIONS'][url]
 
     def post(self, url='', data=None, **kwargs):
-        self.cache.pop(url, None)
+        self.forget(url)
         return self.request('post', url, data=data, **kwargs)
 
     def put(self, url='', data=None, **kwargs):
-        self.cache.pop(url, None)
+        self.forget(url)
         return self.request('put', url, data=data, **kwargs)
 
 
 class RestModelClient(RestClient):
+    # names of the models in the API root, not to be changed at run time
     model_map = {}
 
-    def __init__(self, base_url='', token='', cache=None, model_class=None):
+    def __init__(self, base_url='', token='', cache=None, model_class=None,
+                 session=None, http_cache=None):
         self.model_class = model_class
-        super(RestModelClient, self).__init__(base_url=base_url, token=token,
-                                              cache=cache)
+        super(RestModelClient, self).__init__(
+            base_url=base_url, token=token, cache=cache, session=session,
+            http_cache=http_cache)
 
     def model(self, model_class=None, save=False, modified=False, **kwargs):
-        data = self.get(**kwargs).json()
+        response = self.get(**kwargs)
+        response.raise_for_status()
+        data = response.json()
         serializer = self.serializer(model_class or self.model_class)
         if isinstance(data, list):
             return [self.restore(serializer, d, save, modified) for d in data]
         else:
             return self.restore(serializer, data, save, modified)
 
+    def iter_model(self, model_class=None, save=False, modified=False,
+                   url='', **kwargs):
+        """
+        Like model, but read the response in chunks of
+        RNA['STREAM_CHUNK_SIZE'] bytes and restore each object as soon as
+        it has been read, for lists too large to hold in memory.
+        """
+        response = self.request('get', url, stream=True, **kwargs)
+        try:
+            response.raise_for_status()
+            serializer = self.serializer(model_class or self.model_class)
+            for data in iter_json_list(response.iter_content(
+                    settings.RNA.get('STREAM_CHUNK_SIZE', 65536))):
+                yield self.restore(serializer, data, save, modified)
+        finally:
+            response.close()
+
     def restore(self, serializer, data, save=False, modified=False):
-        data.pop('url', None)
-        for field in serializer.Meta.model._meta.fields:
-            if isinstance(field, models.models.ForeignKey):
-                data[field.name] = self.hypermodel(
-                    data.pop(field.name, None), field.rel.to, save)
-
-        # ManyToManyFields
-        for field in serializer.Meta.model._meta.many_to_many:
-            data[field.name] = [self.hypermodel(url, field.rel.to, save)
-                                for url in data.pop(field.name, [])]
-
-        instance = serializer.restore_object(data)
+        deserializer = serializers.get_deserializer(serializer.Meta.model)
+        instance = deserializer.restore(
+            data, lambda url, model_class: self.hypermodel(
+                url, model_class, save))
         if save:
             serializer.save_object(instance, modified=modified)
         return instance
 
     def model_client(self, url_name='', model_class=None, **kwargs):
+        """
+        Return the client for a model, by its name in the API root or its
+        class, shared by every caller with the same base URL, token and
+        HTTP cache path. The client uses this client's token, session and
+        HTTP cache unless given others.
+        """
         # TODO: decide appropriate level of error handling for this method
         if url_name and not model_class:
             kwargs.setdefault('base_url', self.get().json()[url_name])
             model_class = self.model_map[url_name]
         model_class = model_class or self.model_class
-        self.model_map.setdefault(
-            model_class,
-            self.__class__(model_class=model_class, **kwargs))
-        return self.model_map[model_class]
+        kwargs.setdefault('token', self.token)
+        kwargs.setdefault('session', self.session)
+        kwargs.setdefault('http_cache', self.http_cache)
+        client = self.__class__(model_class=model_class, **kwargs)
+        # by value, since sessions and HTTP caches are made per client
+        key = (self.__class__, model_class, client.base_url, client.token,
+               getattr(client.http_cache, 'path', None))
+        with _clients_lock:
+            return _clients.setdefault(key, client)
 
     def post_instance(self, instance, url='', **kwargs):
         return self.post(url, self.serialize(instance), **kwargs)
@@ -128,6 +450,23 @@ class RestModelClient(RestClient):
             instance=instance)
 
     def hypermodel(self, url, model_class, save):
+        """
+        Return the instance a hyperlink refers to, from the database or
+        else from the API. The hyperlink can also be the object itself,
+        embedded with ?expand=, which is restored unless the database has
+        it modified as recently.
+        """
+        if isinstance(url, dict):
+            try:
+                instance = model_class.objects.get(pk=url['id'])
+            except ObjectDoesNotExist:
+                instance = None
+            modified = url.get('modified')
+            if instance is None or (modified and parse_datetime(
+                    modified) > instance.modified):
+                return self.restore(self.serializer(model_class), dict(url),
+                                    save=save)
+            return instance
         if url:
             base_url, pk = url.rstrip('/').rsplit('/', 1)
             try:
@@ -143,4 +482,5 @@ class RNAModelClient(RestModelClient):
     model_map = {
         'notes': models.Note,
         'releases': models.Release,
+        'tombstones': models.Tombstone,
     }
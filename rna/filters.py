@@ -12,6 +12,18 @@ class ISO8601DateTimeFilter(django_filters.DateTimeFilter):
     field_class = fields.ISO8601DateTimeField
 
 
+class IdListFilter(django_filters.CharFilter):
+    """Filter on a comma separated list of ids"""
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        try:
+            ids = [int(i) for i in value.split(',')]
+        except ValueError:
+            return qs.none()
+        return qs.filter(**{'%s__in' % self.name: ids})
+
+
 class TimestampedFilterBackend(DjangoFilterBackend):
     def get_filter_class(self, view, queryset=None):
         filter_class = getattr(view, 'filter_class', None)
@@ -22,7 +34,7 @@ class TimestampedFilterBackend(DjangoFilterBackend):
             return super(TimestampedFilterBackend, self).get_filter_class(
                 view, queryset=queryset)
 
-        elif queryset and hasattr(queryset, 'model') and issubclass(
+        elif queryset is not None and hasattr(queryset, 'model') and issubclass(
                 queryset.model, models.TimeStampedModel):
             class AutoFilterSet(self.default_filter_set):
                 created_before = ISO8601DateTimeFilter(
@@ -35,10 +47,12 @@ class TimestampedFilterBackend(DjangoFilterBackend):
                 modified_after = ISO8601DateTimeFilter(
                     name='modified', lookup_type='gte')
 
+                ids = IdListFilter(name='pk')
+
                 class Meta:
                     model = queryset.model
                     fields = ['created_before', 'created_after',
-                              'modified_before', 'modified_after']
+                              'modified_before', 'modified_after', 'ids']
                     fields.extend(f.name for f in model._meta.fields
                                   if f.name not in ('created', 'modified'))
                     fields = [f for f in fields
@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A persistent HTTP cache for the RNA clients, in a SQLite database that
+several processes can share, so that rnasync runs and restarted workers
+do not start cold.
+
+Set RNA['HTTP_CACHE_PATH'] to use it. Responses are fresh for their
+Cache-Control max-age, or RNA['HTTP_CACHE_MAX_AGE'] seconds without one,
+and are then revalidated with their ETag or Last-Modified. The least
+recently used responses are evicted once the bodies add up to more than
+RNA['HTTP_CACHE_MAX_SIZE'] bytes.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+import requests
+from requests.structures import CaseInsensitiveDict
+
+MAX_AGE_REGEX = re.compile(r'max-age=(\d+)')
+# headers a 304 Not Modified updates on the stored response
+REVALIDATED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+'''
+
+
+def freshness(response):
+    """
+    Seconds a response may be used without revalidating it, or None if
+    it must not be stored.
+    """
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    match = MAX_AGE_REGEX.search(cache_control)
+    if match:
+        return int(match.group(1))
+    return settings.RNA.get('HTTP_CACHE_MAX_AGE', 300)
+
+
+class CachedResponse(object):
+    def __init__(self, url, status, headers, body, expires):
+        self.url = url
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.expires = expires
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        """Headers that make a request conditional on this response"""
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def revalidate(self, response):
+        """
+        Take the validators and freshness of a 304 Not Modified for this
+        response, returning its new freshness as freshness() does.
+        """
+        self.headers.update((name, response.headers[name])
+                            for name in REVALIDATED_HEADERS
+                            if name in response.headers)
+        max_age = freshness(self.response())
+        if max_age is not None:
+            self.expires = time.time() + max_age
+        return max_age
+
+    def response(self):
+        response = requests.Response()
+        response.url = self.url
+        response.status_code = self.status
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = self.body
+        return response
+
+
+class DiskCache(object):
+    """
+    HTTP responses by key in a SQLite database at path, with at most
+    max_size bytes of bodies, give or take the evict_fraction of max_size
+    that each process may write before it checks.
+    """
+    evict_fraction = 0.01
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size or settings.RNA.get(
+            'HTTP_CACHE_MAX_SIZE', 100 * 1024 * 1024)
+        self._local = threading.local()
+        self._written = 0
+
+    @property
+    def db(self):
+        # sqlite3 connections can't be shared by threads or forked
+        # processes, so each gets its own
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.text_factory = str
+            # readers don't wait for writers in another process
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def get(self, key):
+        with self.db as db:
+            row = db.execute(
+                'SELECT url, status, headers, body, expires FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                       (time.time(), key))
+        url, status, headers, body, expires = row
+        return CachedResponse(url, status, json.loads(headers), str(body),
+                              expires)
+
+    def set(self, key, response):
+        """
+        Store a response under key, unless it asks not to be, then evict
+        the least recently used responses beyond max_size once enough has
+        been written since the last time.
+        """
+        max_age = freshness(response)
+        if max_age is None:
+            self.pop(key)
+            return
+        now = time.time()
+        body = response.content
+        with self.db as db:
+            db.execute(
+                'INSERT OR REPLACE INTO responses (key, url, status, '
+                'headers, body, size, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, response.status_code,
+                 json.dumps(dict(response.headers)), sqlite3.Binary(body),
+                 len(body), now + max_age, now))
+        # adding up the sizes takes a scan of the table
+        self._written += len(body)
+        if self._written >= self.max_size * self.evict_fraction:
+            self._written = 0
+            self.evict()
+
+    def refresh(self, key, response):
+        """
+        Extend the freshness of the response stored under key after a 304
+        Not Modified, with the validators the 304 came with. Returns the
+        response, or None if none is stored.
+        """
+        cached = self.get(key)
+        if cached is None:
+            return None
+        if cached.revalidate(response) is None:
+            self.pop(key)
+            return cached
+        with self.db as db:
+            db.execute(
+                'UPDATE responses SET headers = ?, expires = ? '
+                'WHERE key = ?',
+                (json.dumps(dict(cached.headers)), cached.expires, key))
+        return cached
+
+    def pop(self, key):
+        with self.db as db:
+            db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def size(self):
+        return self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self):
+        """
+        Delete the least recently used responses until the bodies fit in
+        max_size, returning the number deleted.
+        """
+        with self.db as db:
+            excess = db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone(
+                )[0] - self.max_size
+            if excess <= 0:
+                return 0
+            keys = []
+            for key, size in db.execute(
+                    'SELECT key, size FROM responses ORDER BY accessed'):
+                keys.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            db.executemany('DELETE FROM responses WHERE key = ?', keys)
+        return len(keys)
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from cStringIO import StringIO
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+def get_sizes():
+    """
+    Return a mapping of variant name to maximum (width, height), from
+    settings.RNA['IMAGE_VARIANTS'] if set.
+    """
+    return settings.RNA.get('IMAGE_VARIANTS', {
+        'thumbnail': (128, 128),
+        'medium': (640, 640),
+    })
+
+
+def variant_name(name, size_name):
+    """
+    Return the storage name of a variant of the image with the given
+    name, e.g. screenshot/1/variants/shot-thumbnail.png for
+    screenshot/1/shot.png
+    """
+    head, tail = os.path.split(name)
+    root, ext = os.path.splitext(tail)
+    return '/'.join(filter(None, [
+        head, 'variants', '%s-%s%s' % (root, size_name, ext)]))
+
+
+def variant_urls(image):
+    """
+    Return a mapping of variant name to URL for an image field file,
+    computed from the names alone without touching storage.
+    """
+    if not image:
+        return {}
+    return dict((size_name, image.storage.url(variant_name(image.name,
+                                                           size_name)))
+                for size_name in get_sizes())
+
+
+def generate_variants(image):
+    """
+    Save each configured size variant of an image field file to its
+    storage, unless it is already there.
+    """
+    original = None
+    for size_name, size in get_sizes().items():
+        name = variant_name(image.name, size_name)
+        if image.storage.exists(name):
+            continue
+        if original is None:
+            image.open()
+            original = Image.open(image)
+            original.load()
+        variant = original.copy()
+        variant.thumbnail(size, Image.ANTIALIAS)
+        if original.format == 'JPEG' and variant.mode != 'RGB':
+            variant = variant.convert('RGB')
+        buf = StringIO()
+        variant.save(buf, format=original.format or 'PNG')
+        image.storage.save(name, ContentFile(buf.getvalue()))
+    if original is not None:
+        image.close()
+
+
+def delete_variants(storage, name):
+    """Delete the size variants of the image with the given name"""
+    for size_name in get_sizes():
+        storage.delete(variant_name(name, size_name))
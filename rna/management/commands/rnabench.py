@@ -0,0 +1,75 @@
+from optparse import make_option
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ... import benchmarks, utils
+
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = ('Time the RNA hot paths against a generated dataset in a test '
+            'database, optionally comparing the results with a baseline.')
+    option_list = BaseCommand.option_list + (
+        make_option('--releases', type='int', dest='releases', default=50,
+                    help='Number of releases to generate'),
+        make_option('--notes-per-release', type='int',
+                    dest='notes_per_release', default=20,
+                    help='Number of notes to generate for each release'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed for the generated note attributes'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Number of timed calls of each benchmark'),
+        make_option('--output', dest='output',
+                    help='Write the results to this JSON file'),
+        make_option('--baseline', dest='baseline',
+                    help='Compare the results with this JSON file'),
+        make_option('--time-threshold', type='float', dest='time_threshold',
+                    help='Allowed fractional slowdown of the median time, '
+                         'defaults to RNA["BENCHMARK_TIME_THRESHOLD"] or '
+                         '0.25'),
+        make_option('--query-threshold', type='int', dest='query_threshold',
+                    help='Allowed number of extra queries, defaults to '
+                         'RNA["BENCHMARK_QUERY_THRESHOLD"] or 0'),
+    )
+
+    def handle(self, *args, **options):
+        unknown = set(args).difference(
+            b.__name__ for b in benchmarks.BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: %s' % ', '.join(
+                sorted(unknown)))
+
+        # South would otherwise run every migration to create the tables
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            utils.generate_data(options['releases'],
+                                options['notes_per_release'],
+                                options['seed'])
+            results = benchmarks.run(args, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, result in sorted(results.items()):
+            self.stdout.write('%-32s %8.4fs %8.4fs %6s queries\n' % (
+                name, result['median'], result['min'], result['queries']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'dataset': dict((key, options[key]) for key in (
+                        'releases', 'notes_per_release', 'seed')),
+                    'results': results,
+                }, f, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            regressions = benchmarks.compare(
+                results, baseline, options['time_threshold'],
+                options['query_threshold'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n%s' % (
+                    options['baseline'], '\n'.join(regressions)))
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ... import models, profiling
+
+
+class Command(BaseCommand):
+    help = ('Delete tombstones older than the retention period, and '
+            'superseded duplicates, and all but the latest change of each '
+            'object. Mirrors that have not synced within the retention '
+            'period need a full resync.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    help='Retention period in days. Defaults to '
+                         "settings.RNA['TOMBSTONE_RETENTION_DAYS'] or 90"),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        days = options['days'] or settings.RNA.get(
+            'TOMBSTONE_RETENTION_DAYS', 90)
+        count = models.Tombstone.objects.compact(
+            datetime.now() - timedelta(days=days))
+        self.stdout.write('Deleted %s tombstones\n' % count)
+        count = models.Change.objects.compact()
+        self.stdout.write('Deleted %s superseded changes\n' % count)
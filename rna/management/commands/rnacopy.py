@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import models, profiling, utils
+
+
+class Command(BaseCommand):
+    args = '[release_id ...]'
+    help = ('Copy releases with their notes in a single transaction, '
+            'selected by id and/or by product and channel.')
+    option_list = BaseCommand.option_list + (
+        make_option('--product', dest='product',
+                    help='Copy all releases of this product'),
+        make_option('--channel', dest='channel',
+                    help='Copy all releases in this channel'),
+        make_option('--version-startswith', dest='version_startswith',
+                    help='Copy all releases whose version starts with this'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        filters = dict((field, options[field]) for field in (
+            'product', 'channel') if options.get(field))
+        if options.get('version_startswith'):
+            filters['version__startswith'] = options['version_startswith']
+        if args:
+            filters['pk__in'] = args
+        if not filters:
+            raise CommandError('Select releases by id, product or channel')
+        copies = utils.copy_releases(models.Release.objects.filter(**filters))
+        self.stdout.write('Copied %s releases\n' % len(copies))
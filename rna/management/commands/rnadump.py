@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import profiling, snapshots
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = ('Write a gzipped snapshot of releases, notes, their links and '
+            'tombstones for bootstrapping a mirror with rnaload.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Rows read per query'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the snapshot to write')
+        counts = snapshots.dump(args[0], options['batch_size'])
+        self.stdout.write('Dumped %s\n' % ', '.join(
+            '%s %s' % (count, kind) for kind, count in sorted(counts.items())))
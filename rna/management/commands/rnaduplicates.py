@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import profiling, utils
+
+
+class Command(BaseCommand):
+    help = 'List releases that share a product and version.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=200, help='Product and version pairs per query'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        duplicates = utils.get_duplicate_product_versions(
+            batch_size=options['batch_size'])
+        for (product, version), ids in sorted(duplicates.items()):
+            self.stdout.write('%s %s: %s\n' % (
+                product, version, ', '.join(str(pk) for pk in ids)))
+        self.stdout.write('%s duplicated product versions\n' % len(duplicates))
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import profiling, utils
+
+
+class Command(BaseCommand):
+    help = ('Generate releases of every product and channel with notes '
+            'and release links, deterministically from a seed, for load '
+            'testing and sizing indexes.')
+    option_list = BaseCommand.option_list + (
+        make_option('--releases', type='int', dest='releases', default=1000,
+                    help='Number of releases to generate'),
+        make_option('--notes-per-release', type='int',
+                    dest='notes_per_release', default=20,
+                    help='Number of notes to generate for each release'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed for the generated attributes'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Rows written per query'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        def progress(name, count):
+            self.stdout.write('%s %s\n' % (count, name))
+
+        verbosity = int(options.get('verbosity', 1))
+        counts = utils.generate_data(
+            options['releases'], options['notes_per_release'],
+            options['seed'], options['batch_size'],
+            progress if verbosity > 1 else None)
+        self.stdout.write('Generated %(releases)s releases, %(notes)s notes '
+                          'and %(links)s release links\n' % counts)
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import images, models, profiling
+
+
+class Command(BaseCommand):
+    help = ('Store the dimensions of note images that lack them and '
+            'generate any missing size variants.')
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Process every note with an image, not only '
+                         'those without stored dimensions'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100, help='Notes read per query'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        notes = models.Note.objects.exclude(image='').order_by('id').only(
+            'id', 'image', 'image_width', 'image_height')
+        if not options['all']:
+            notes = notes.filter(image_width__isnull=True)
+        count = last_id = 0
+        while True:
+            batch = list(notes.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for note in batch:
+                try:
+                    # a backfill, not an edit for mirrors to pick up
+                    models.Note.objects.filter(pk=note.pk).update(
+                        image_width=note.image.width,
+                        image_height=note.image.height,
+                        modified=False, record=False)
+                    images.generate_variants(note.image)
+                except IOError as e:
+                    self.stderr.write('Note %s: %s\n' % (note.pk, e))
+                else:
+                    count += 1
+            self.stdout.write('%s images\n' % count)
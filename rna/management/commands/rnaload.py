@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import profiling, snapshots
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = ('Load a snapshot written by rnadump into an empty database in '
+            'a single transaction. rnasync then continues from the '
+            'snapshot.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Rows written per query'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the snapshot to load')
+        try:
+            header, counts = snapshots.load(args[0], options['batch_size'])
+        except snapshots.SnapshotError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Loaded %s from the snapshot of %s\n' % (
+            ', '.join('%s %s' % (count, kind)
+                      for kind, count in sorted(counts.items())),
+            header['watermark']))
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import profiling, utils
+
+
+class Command(BaseCommand):
+    help = ('Rewrite X.0.0 release versions to the form used by their '
+            'channel, in batches.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Releases per UPDATE'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Report without writing'),
+    )
+
+    @profiling.log_query_stats
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(count, versions):
+            if options['dry_run'] and verbosity > 1:
+                for pk, version in sorted(versions.items()):
+                    self.stdout.write('%s -> %s\n' % (pk, version))
+            if verbosity:
+                self.stdout.write('%s releases\n' % count)
+
+        count = utils.migrate_versions(
+            batch_size=options['batch_size'], dry_run=options['dry_run'],
+            progress=progress)
+        if options['dry_run']:
+            self.stdout.write('Would rewrite %s releases\n' % count)
+        else:
+            self.stdout.write('Rewrote %s releases\n' % count)
@@ -1,14 +1,53 @@
+from optparse import make_option
+import logging
+import random
+import signal
+import threading
+import time
+
+from django.conf import settings
 from django.core.mail import mail_admins
 from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Max, Q
 
+import requests
 from requests.exceptions import RequestException
+from rest_framework.compat import parse_datetime
+
+from ... import clients, metrics, models, profiling
 
-from ... import clients
+logger = logging.getLogger('rna.sync')
 
 
 class Command(BaseCommand):
     # TODO: args, help, docstrings
+    batch_size = 500
+    # ids per ?ids= request when fetching changed objects
+    fetch_size = 200
+    deadline = None
+    option_list = BaseCommand.option_list + (
+        make_option('--changes', action='store_true', dest='changes',
+                    default=False,
+                    help='Follow the change feed from the latest local '
+                         'change instead of asking for everything '
+                         'modified since the latest local modified time'),
+        make_option('--daemon', action='store_true', dest='daemon',
+                    default=False,
+                    help='Keep syncing until SIGTERM, reusing connections '
+                         'between syncs'),
+        make_option('--min-interval', type='float', dest='min_interval',
+                    help='Seconds between syncs while upstream changes, '
+                         "defaults to RNA['SYNC_MIN_INTERVAL'] or 5"),
+        make_option('--max-interval', type='float', dest='max_interval',
+                    help='Longest wait between syncs while upstream is idle '
+                         "or failing, defaults to RNA['SYNC_MAX_INTERVAL'] "
+                         'or 300'),
+        make_option('--deadline', type='float', dest='deadline',
+                    help='Seconds a sync may take before its requests '
+                         "fail, defaults to RNA['SYNC_DEADLINE'] or 900"),
+    )
 
     def model_params(self, models):
         params = dict((m, {}) for m in models)
@@ -21,13 +60,268 @@ class Command(BaseCommand):
                 params[m]['modified_after'] = latest.modified.isoformat()
         return params
 
+    def batches(self, items):
+        items = list(items)
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    @transaction.commit_on_success
+    def apply_tombstones(self, tombstones):
+        """
+        Apply upstream deletes and unlinks in bulk, then store the
+        tombstones themselves so the next run continues after them.
+        """
+        ids = dict((kind, set()) for kind in models.Tombstone.KINDS)
+        links = set()
+        for t in tombstones:
+            if t.kind == 'note_releases':
+                links.add((t.object_id, t.related_id))
+            else:
+                ids[t.kind].add(t.object_id)
+
+        with models.preserve_modified():
+            for model_class in (models.Note, models.Release):
+                for batch in self.batches(ids[model_class._meta.module_name]):
+                    model_class.objects.filter(pk__in=batch).delete()
+            through = models.Note.releases.through
+            for batch in self.batches(links):
+                q = Q()
+                for note_id, release_id in batch:
+                    q |= Q(note_id=note_id, release_id=release_id)
+                through.objects.filter(q).delete()
+            for batch in self.batches(tombstones):
+                models.Tombstone.objects.filter(
+                    pk__in=[t.pk for t in batch]).delete()
+                models.Tombstone.objects.bulk_create(batch, modified=False)
+
+    @transaction.commit_on_success
+    def apply_changes(self, rc, changes):
+        """
+        Apply a page of upstream changes, only the last action of each
+        object or link, then store the changes themselves so the next run
+        continues after them.
+        """
+        latest = {}
+        for c in changes:
+            latest[(c['kind'], c['object_id'], c['related_id'])] = c['action']
+        keys = dict((action, set()) for action in models.Change.ACTIONS)
+        for (kind, object_id, related_id), action in latest.items():
+            keys[action].add((kind, object_id, related_id))
+        through = models.Note.releases.through
+
+        with models.preserve_modified():
+            for model_class in (models.Note, models.Release):
+                name = model_class._meta.module_name
+                ids = [k[1] for k in keys['delete'] if k[0] == name]
+                for batch in self.batches(ids):
+                    model_class.objects.filter(pk__in=batch).delete()
+            for batch in self.batches(keys['unlink']):
+                q = Q()
+                for kind, note_id, release_id in batch:
+                    q |= Q(note_id=note_id, release_id=release_id)
+                through.objects.filter(q).delete()
+
+            # releases first, so the notes' links find them
+            for url_name, model_class in (('releases', models.Release),
+                                          ('notes', models.Note)):
+                name = model_class._meta.module_name
+                ids = sorted(k[1] for k in keys['save'] if k[0] == name)
+                client = rc.model_client(url_name)
+                for i in range(0, len(ids), self.fetch_size):
+                    client.model(save=True, params={'ids': ','.join(
+                        str(pk) for pk in ids[i:i + self.fetch_size])})
+
+            for batch in self.batches(keys['link']):
+                links = set((note_id, release_id)
+                            for kind, note_id, release_id in batch)
+                q = Q()
+                for note_id, release_id in links:
+                    q |= Q(note_id=note_id, release_id=release_id)
+                links.difference_update(through.objects.filter(q).values_list(
+                    'note_id', 'release_id'))
+                # skip links to objects deleted upstream since
+                notes = set(models.Note.objects.filter(pk__in=[
+                    link[0] for link in links]).values_list('pk', flat=True))
+                releases = set(models.Release.objects.filter(pk__in=[
+                    link[1] for link in links]).values_list('pk', flat=True))
+                through.objects.bulk_create([
+                    through(note_id=note_id, release_id=release_id)
+                    for note_id, release_id in links
+                    if note_id in notes and release_id in releases])
+
+            for batch in self.batches(changes):
+                models.Change.objects.filter(
+                    pk__in=[c['id'] for c in batch]).delete()
+                models.Change.objects.bulk_create([
+                    models.Change(id=c['id'], kind=c['kind'],
+                                  action=c['action'],
+                                  object_id=c['object_id'],
+                                  related_id=c['related_id'],
+                                  created=parse_datetime(c['created']))
+                    for c in batch])
+
+    def sync_changes(self, rc):
+        """
+        Page through the change feed from the latest local change,
+        applying each page in its own transaction, and return the number
+        of changes applied.
+        """
+        since = models.Change.objects.aggregate(
+            latest=Max('id'))['latest'] or 0
+        count = 0
+        while True:
+            page = rc.get('changes/', params={'since': since}).json()
+            if page['results']:
+                self.apply_changes(rc, page['results'])
+                count += len(page['results'])
+            since = page['last_seq']
+            if not page['next']:
+                return count
+
+    def record_metrics(self, model_class, params, count, latest=None):
+        """
+        Report how many records of a model were synced and how far the
+        latest modified of them was ahead of the local data before the
+        sync.
+        """
+        name = model_class._meta.module_name
+        metrics.set_gauge('rna_sync_records', count, model=name)
+        lag = 0
+        local = params.get('modified_after')
+        if latest and local:
+            delta = latest - parse_datetime(local)
+            lag = max(delta.days * 86400 + delta.seconds, 0)
+        metrics.set_gauge('rna_sync_lag_seconds', lag, model=name)
+
+    def sync_modified(self, rc):
+        """
+        Sync the tombstones and then the objects modified upstream since
+        the latest local modified time of each model, returning the number
+        of records synced.
+        """
+        model_params = self.model_params(rc.model_map.values())
+        # deletes go first, so a link removed and then added again
+        # upstream is restored by the notes synced afterwards
+        tombstones = rc.model_client('tombstones').model(
+            params=model_params[models.Tombstone])
+        self.apply_tombstones(tombstones)
+        self.record_metrics(
+            models.Tombstone, model_params[models.Tombstone],
+            len(tombstones), max([t.modified for t in tombstones] or [None]))
+        total = len(tombstones)
+        for url_name, model_class in rc.model_map.items():
+            if model_class is models.Tombstone:
+                continue
+            params = model_params[model_class]
+            # saved as they are read, so a large backlog is never held in
+            # memory at once
+            count, latest = 0, None
+            for record in rc.model_client(url_name).iter_model(
+                    save=True, params=params):
+                count += 1
+                latest = max(latest, record.modified)
+            self.record_metrics(model_class, params, count, latest)
+            total += count
+        return total
+
+    @profiling.log_query_stats
+    def sync(self, rc, changes=False):
+        """
+        Sync once, by the change feed or by modified time, and return the
+        number of records synced.
+        """
+        start = time.time()
+        try:
+            with clients.deadline(self.deadline or settings.RNA.get(
+                    'SYNC_DEADLINE', 900)):
+                if changes:
+                    count = self.sync_changes(rc)
+                    metrics.set_gauge('rna_sync_records', count,
+                                      model='change')
+                else:
+                    count = self.sync_modified(rc)
+        finally:
+            metrics.set_gauge('rna_sync_duration_seconds',
+                              time.time() - start)
+            metrics.flush(force=True)
+        metrics.set_gauge('rna_sync_last_success_timestamp_seconds',
+                          time.time())
+        metrics.flush(force=True)
+        return count
+
+    def next_interval(self, interval, count, min_interval, max_interval):
+        """
+        Poll again soon after a sync that found changes, and twice as
+        late as last time after one that found none.
+        """
+        if count:
+            return min_interval
+        return min(interval * 2, max_interval)
+
+    def backoff(self, failures, min_interval, max_interval):
+        """
+        Wait exponentially longer after each failure in a row, jittered
+        so that mirrors failing together do not retry together.
+        """
+        delay = min(min_interval * 2 ** failures, max_interval)
+        return random.uniform(delay / 2, delay)
+
+    def daemon(self, rc, options):
+        min_interval = options.get('min_interval') or settings.RNA.get(
+            'SYNC_MIN_INTERVAL', 5)
+        max_interval = options.get('max_interval') or settings.RNA.get(
+            'SYNC_MAX_INTERVAL', 300)
+        stop = threading.Event()
+
+        # finish the sync in progress, then exit
+        def handle_signal(signum, frame):
+            logger.info('rnasync stopping after signal %s', signum)
+            stop.set()
+
+        handlers = dict((signum, signal.signal(signum, handle_signal))
+                        for signum in (signal.SIGTERM, signal.SIGINT))
+        interval = min_interval
+        failures = 0
+        try:
+            while not stop.is_set():
+                # responses are only reused within a sync, so that the
+                # caches neither grow nor go stale between syncs
+                rc.cache.clear()
+                clients.clear_caches()
+                try:
+                    count = self.sync(rc, options.get('changes'))
+                except Exception as e:
+                    failures += 1
+                    logger.exception('rnasync failed %s times in a row',
+                                     failures)
+                    if failures == 1:
+                        mail_admins('Problem syncing from Nucleus', str(e))
+                    # reconnect next time, in case the database went away
+                    connection.close()
+                    delay = self.backoff(failures, min_interval,
+                                         max_interval)
+                else:
+                    failures = 0
+                    # end the read transaction, so the next sync sees the
+                    # data as it is then
+                    transaction.commit_unless_managed()
+                    interval = self.next_interval(
+                        interval, count, min_interval, max_interval)
+                    delay = interval
+                stop.wait(delay)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
     def handle(self, *args, **options):
+        self.deadline = options.get('deadline')
+        if options.get('daemon'):
+            rc = clients.RNAModelClient(session=requests.Session())
+            self.daemon(rc, options)
+            return
         rc = clients.RNAModelClient()
-        model_params = self.model_params(rc.model_map.values())
         try:
-            for url_name, model_class in rc.model_map.items():
-                params = model_params[model_class]
-                rc.model_client(url_name).model(save=True, params=params)
+            self.sync(rc, options.get('changes'))
         except RequestException as e:
             subject = 'Problem connecting to Nucleus'
             mail_admins(subject, str(e))
@@ -0,0 +1,264 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Counters, gauges and histograms for the RNA API and rnasync, served in
+the Prometheus text format by metrics_view when RNA['METRICS'] is set.
+
+Values are kept in the process. When RNA['METRICS_DIR'] is set, each
+process also writes its values to a file there, at most every
+RNA['METRICS_FLUSH_INTERVAL'] seconds, and metrics_view adds up the files
+of all processes, so that forked WSGI workers and rnasync runs report
+together. Add 'rna.metrics.MetricsMiddleware' to MIDDLEWARE_CLASSES for
+the request metrics and use rna.metrics.TokenAuthentication in place of
+DRF's to count token lookups.
+"""
+
+import atexit
+from bisect import bisect_left
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from rest_framework import authentication, exceptions
+
+from . import profiling
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'rna_requests_total': (
+        'counter', 'Requests by view, method and status', None),
+    'rna_request_duration_seconds': (
+        'histogram', 'Request latency by view', LATENCY_BUCKETS),
+    'rna_response_size_bytes': (
+        'histogram', 'Response body size by view', SIZE_BUCKETS),
+    'rna_db_queries_total': (
+        'counter', 'SQL queries made by requests, by view', None),
+    'rna_db_seconds_total': (
+        'counter', 'Time spent in SQL queries by requests, by view', None),
+    'rna_cache_requests_total': (
+        'counter', 'Cache lookups by cache and result', None),
+    'rna_token_auth_total': (
+        'counter', 'API token lookups by result', None),
+    'rna_sync_duration_seconds': (
+        'gauge', 'Duration of the last rnasync run', None),
+    'rna_sync_last_success_timestamp_seconds': (
+        'gauge', 'When the last successful rnasync run finished', None),
+    'rna_sync_records': (
+        'gauge', 'Records synced by the last rnasync run, by model', None),
+    'rna_sync_lag_seconds': (
+        'gauge', 'Upstream modified minus local modified before the last '
+                 'rnasync run, by model', None),
+}
+
+_lock = threading.Lock()
+_values = {}
+_state = {'pid': os.getpid(), 'flushed': 0}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _current():
+    # forget values inherited from a parent process, which reports them
+    if _state['pid'] != os.getpid():
+        _values.clear()
+        _state.update(pid=os.getpid(), flushed=0)
+    return _values
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        values = _current()
+        key = _key(name, labels)
+        values[key] = values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    with _lock:
+        values = _current()
+        key = _key(name, labels)
+        if key not in values:
+            values[key] = {'buckets': [0] * (len(buckets) + 1),
+                           'sum': 0, 'count': 0}
+        histogram = values[key]
+        histogram['buckets'][bisect_left(buckets, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        # gauges from several processes are merged by taking the latest
+        _current()[_key(name, labels)] = [value, time.time()]
+
+
+def merge(into, values):
+    for key, value in values.items():
+        kind = METRICS[key[0]][0]
+        if key not in into:
+            into[key] = json.loads(json.dumps(value))
+        elif kind == 'counter':
+            into[key] += value
+        elif kind == 'gauge':
+            if value[1] > into[key][1]:
+                into[key] = list(value)
+        else:
+            histogram = into[key]
+            histogram['buckets'] = [a + b for a, b in zip(
+                histogram['buckets'], value['buckets'])]
+            histogram['sum'] += value['sum']
+            histogram['count'] += value['count']
+    return into
+
+
+def _path(directory, pid):
+    return os.path.join(directory, 'rna-%s.json' % pid)
+
+
+def flush(force=False):
+    """
+    Write this process's values to its file in RNA['METRICS_DIR'], if
+    set, unless that was done less than RNA['METRICS_FLUSH_INTERVAL']
+    seconds ago.
+    """
+    directory = settings.RNA.get('METRICS_DIR')
+    if not directory:
+        return
+    now = time.time()
+    with _lock:
+        values = _current()
+        if not force and now - _state['flushed'] < settings.RNA.get(
+                'METRICS_FLUSH_INTERVAL', 1):
+            return
+        _state['flushed'] = now
+        data = json.dumps([[name, labels, value]
+                           for (name, labels), value in values.items()])
+    # write then rename, so readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.rename(tmp, _path(directory, os.getpid()))
+
+
+atexit.register(lambda: flush(force=True))
+
+
+def collect():
+    """
+    Return the values of this process, or of every process that wrote to
+    RNA['METRICS_DIR'] if set.
+    """
+    directory = settings.RNA.get('METRICS_DIR')
+    if not directory:
+        with _lock:
+            return merge({}, _current())
+    flush(force=True)
+    values = {}
+    for path in glob.glob(_path(directory, '*')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            continue
+        merge(values, dict(((name, tuple(tuple(label) for label in labels)), value)
+                           for name, labels, value in data))
+    return values
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (
+        k, v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in labels)
+
+
+def render(values):
+    lines = []
+    for name in sorted(METRICS):
+        kind, help, buckets = METRICS[name]
+        samples = sorted((labels, value) for (n, labels), value
+                         in values.items() if n == name)
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if kind == 'counter':
+                lines.append('%s%s %r' % (name, _format_labels(labels),
+                                          float(value)))
+            elif kind == 'gauge':
+                lines.append('%s%s %r' % (name, _format_labels(labels),
+                                          float(value[0])))
+            else:
+                cumulative = 0
+                for le, count in zip(buckets + ('+Inf',), value['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        name, _format_labels(labels + (('le', str(le)),)),
+                        cumulative))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                                              float(value['sum'])))
+                lines.append('%s_count%s %s' % (name, _format_labels(labels),
+                                                value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    if not settings.RNA.get('METRICS', False):
+        raise Http404
+    return HttpResponse(content=render(collect()),
+                        content_type='text/plain; version=0.0.4')
+
+
+class MetricsMiddleware(object):
+    def process_request(self, request):
+        request._rna_metrics = (time.time(), profiling.QueryStats().start())
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # DRF's as_view() copies the view class name onto the function
+        request._rna_metrics_view = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        start, stats = getattr(request, '_rna_metrics', (None, None))
+        if start is None:
+            return response
+        del request._rna_metrics
+        stats.stop()
+        # unresolved paths would make a label value per URL
+        view = getattr(request, '_rna_metrics_view', None) or 'none'
+        inc('rna_requests_total', view=view, method=request.method,
+            status=response.status_code)
+        observe('rna_request_duration_seconds', time.time() - start,
+                view=view)
+        if not getattr(response, 'streaming', False):
+            observe('rna_response_size_bytes', len(response.content),
+                    view=view)
+        inc('rna_db_queries_total', stats.count, view=view)
+        inc('rna_db_seconds_total', stats.time, view=view)
+        flush()
+        return response
+
+
+class TokenAuthentication(authentication.TokenAuthentication):
+    def authenticate_credentials(self, key):
+        try:
+            credentials = super(
+                TokenAuthentication, self).authenticate_credentials(key)
+        except exceptions.AuthenticationFailed:
+            inc('rna_token_auth_total', result='failure')
+            raise
+        inc('rna_token_auth_total', result='success')
+        return credentials
@@ -2,12 +2,92 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import threading
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save)
 from django_extensions.db.fields import CreationDateTimeField
 
+from . import images
+
+
+_local = threading.local()
+
+
+@contextmanager
+def preserve_modified():
+    """
+    Within this context, adding or removing many-to-many links does not
+    stamp the modified timestamp of either side, and changes leave no
+    tombstones or change log entries, which is what a mirror wants while
+    restoring rows, tombstones and changes as they are upstream.
+    """
+    previous = getattr(_local, 'preserve_modified', False)
+    _local.preserve_modified = True
+    try:
+        yield
+    finally:
+        _local.preserve_modified = previous
+
+
+class TimeStampedQuerySet(QuerySet):
+    """
+    QuerySet whose bulk operations stamp the modified timestamp in the
+    same statement, the way TimeStampedModel.save does for a single
+    instance. Pass modified=False to leave the timestamp untouched, or
+    a datetime to set it explicitly. Updated releases and notes are
+    logged as saved in the change log, unless record=False, in the
+    caller's transaction if there is one, so that it commits or rolls
+    back the update as a whole, or else in one of its own.
+    """
+    def update(self, **kwargs):
+        modified = kwargs.pop('modified', True)
+        if modified is True:
+            kwargs['modified'] = datetime.now()
+        elif modified is not False:
+            kwargs['modified'] = modified
+        kind = self.model._meta.module_name
+        if not kwargs.pop('record', True) or kind not in Change.KINDS:
+            return super(TimeStampedQuerySet, self).update(**kwargs)
+        if transaction.is_managed(using=self.db):
+            return self._update_and_record(kind, kwargs)
+        with transaction.commit_on_success(using=self.db):
+            return self._update_and_record(kind, kwargs)
+
+    def _update_and_record(self, kind, kwargs):
+        pks = list(self.values_list('pk', flat=True))
+        count = super(TimeStampedQuerySet, self).update(**kwargs)
+        Change.objects.record(kind, 'save', pks, self.db)
+        return count
+
+    def bulk_create(self, objs, batch_size=None, modified=True):
+        if modified:
+            now = datetime.now()
+            for obj in objs:
+                obj.modified = now
+        return super(TimeStampedQuerySet, self).bulk_create(
+            objs, batch_size=batch_size)
+
+    def touch(self):
+        """Stamp the modified timestamp of every row in a single UPDATE"""
+        return self.update()
+
+
+class TimeStampedManager(models.Manager):
+    use_for_related_fields = True
+
+    def get_query_set(self):
+        return TimeStampedQuerySet(self.model, using=self._db)
+
+    def touch(self):
+        return self.get_query_set().touch()
+
 
 class TimeStampedModel(models.Model):
     """
@@ -19,6 +99,8 @@ class TimeStampedModel(models.Model):
     created = CreationDateTimeField()
     modified = models.DateTimeField(editable=False, blank=True, db_index=True)
 
+    objects = TimeStampedManager()
+
     class Meta:
         abstract = True
 
@@ -38,7 +120,7 @@ class Release(TimeStampedModel):
                                choices=[(p, p) for p in PRODUCTS])
     channel = models.CharField(max_length=255,
                                choices=[(c, c) for c in CHANNELS])
-    version = models.CharField(max_length=255)
+    version = models.CharField(max_length=255, db_index=True)
     release_date = models.DateTimeField()
     text = models.TextField(blank=True)
     is_public = models.BooleanField(default=False)
@@ -46,6 +128,12 @@ class Release(TimeStampedModel):
     bug_search_url = models.CharField(max_length=2000, blank=True)
     system_requirements = models.TextField(blank=True)
 
+    def is_released(self):
+        """
+        Whether the release is public and its release date has passed.
+        """
+        return self.is_public and self.release_date <= datetime.now()
+
     def major_version(self):
         return self.version.split('.', 1)[0]
 
@@ -104,12 +192,15 @@ class Release(TimeStampedModel):
         and then for new features we also sort by tag in the order specified
         by Note.TAGS, with untagged notes coming first, then finally moving
         any note with the fixed tag that starts with the release version to
-        the top, for what we call "dot fixes".
+        the top, for what we call "dot fixes". The fixed_in_release and
+        releases of each note are fetched along, in two queries in all.
         """
-        tag_index = dict((tag, i) for i, tag in enumerate(Note.TAGS))
-        notes = self.note_set.order_by('-sort_num')
+        notes = self.note_set.select_related(
+            'fixed_in_release').prefetch_related('releases').order_by(
+            '-sort_num')
         if public_only:
             notes = notes.filter(is_public=True)
+        tag_index = dict((tag, i) for i, tag in enumerate(Note.TAGS))
         known_issues = [n for n in notes if n.is_known_issue_for(self)]
         new_features = sorted(
             sorted(
@@ -120,6 +211,68 @@ class Release(TimeStampedModel):
 
         return new_features, known_issues
 
+    def page(self, public_only=False):
+        """
+        Everything a release notes page shows for this release: its notes
+        as grouped by notes(), its equivalent releases and its bug search
+        URL, in at most three queries whatever the number of notes.
+        """
+        new_features, known_issues = self.notes(public_only)
+        return {
+            'release': self,
+            'new_features': new_features,
+            'known_issues': known_issues,
+            'equivalent_android_release': self.equivalent_android_release(),
+            'equivalent_desktop_release': self.equivalent_desktop_release(),
+            'bug_search_url': self.get_bug_search_url(),
+        }
+
+    def page_etag(self, public_only=False):
+        """
+        Return an ETag for page(public_only) derived from the modified
+        timestamps of this release, of its notes and of its equivalent
+        releases, and from the number of its notes, in two queries.
+        """
+        notes = self.note_set.aggregate(
+            latest=models.Max('modified'), count=models.Count('id'))
+        key = [self.pk, self.modified, notes['latest'], notes['count']]
+        for equivalent in (self.equivalent_android_release(),
+                           self.equivalent_desktop_release()):
+            key.extend([equivalent and equivalent.pk,
+                        equivalent and equivalent.modified])
+        key.append(public_only)
+        return '"%s"' % hashlib.md5(':'.join(map(str, key))).hexdigest()
+
+    def note_diff(self, other):
+        """
+        Compare the notes of this release with those of another release,
+        returning querysets of the notes that were added in the other
+        release, removed from it, and modified, where modified notes are
+        those in both releases whose content was saved after the later of
+        the two releases was created, such as notes edited after a copy.
+        Adding or removing links doesn't make a note modified. All three
+        sets are computed in SQL over the Note.releases join table.
+        """
+        notes = Note.objects.all()
+        added = notes.filter(releases=other).exclude(releases=self)
+        removed = notes.filter(releases=self).exclude(releases=other)
+        modified = notes.filter(releases=self).filter(
+            releases=other).filter(
+            content_modified__gt=max(self.created, other.created))
+        return added, removed, modified
+
+    def note_diff_etag(self, other):
+        """
+        Return an ETag for note_diff(other) derived from the modified
+        timestamps of both releases and of the notes linked to either.
+        """
+        latest_note = Note.objects.filter(
+            releases__in=[self.pk, other.pk]).aggregate(
+            latest=models.Max('modified'))['latest']
+        key = '%s:%s:%s:%s:%s' % (self.pk, self.modified, other.pk,
+                                  other.modified, latest_note)
+        return '"%s"' % hashlib.md5(key).hexdigest()
+
     def __unicode__(self):
         return '{product} {version} {channel}'.format(
             product=self.product, version=self.version, channel=self.channel)
@@ -145,10 +298,239 @@ class Note(TimeStampedModel):
     sort_num = models.IntegerField(default=0)
     is_public = models.BooleanField(default=True)
 
-    image = models.ImageField(upload_to=lambda instance, filename: '/'.join(['screenshot', str(instance.pk), filename]))
+    image = models.ImageField(upload_to=lambda instance, filename: '/'.join(['screenshot', str(instance.pk), filename]),
+                              width_field='image_width',
+                              height_field='image_height')
+    image_width = models.PositiveIntegerField(null=True, blank=True,
+                                              editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True,
+                                               editable=False)
+    # stamped by saves only, unlike modified, which release link changes
+    # and touch() also stamp
+    content_modified = models.DateTimeField(null=True, blank=True,
+                                            editable=False)
+
+    def save(self, *args, **kwargs):
+        if kwargs.get('modified', True):
+            self.content_modified = datetime.now()
+        super(Note, self).save(*args, **kwargs)
+
+    def image_variants(self):
+        return images.variant_urls(self.image)
 
     def is_known_issue_for(self, release):
         return self.is_known_issue and self.fixed_in_release != release
 
     def __unicode__(self):
         return self.note
+
+
+class TombstoneManager(TimeStampedManager):
+    def compact(self, before):
+        """
+        Delete tombstones last modified before the given datetime, and
+        all but the latest tombstone for any object or link that has
+        been recorded more than once. Returns the number deleted.
+        """
+        count = self.filter(modified__lt=before).count()
+        self.filter(modified__lt=before).delete()
+        duplicates = self.values('kind', 'object_id', 'related_id').annotate(
+            count=models.Count('id'), latest=models.Max('id')).filter(
+            count__gt=1)
+        for d in duplicates:
+            superseded = self.filter(
+                kind=d['kind'], object_id=d['object_id'],
+                related_id=d['related_id'], id__lt=d['latest'])
+            count += superseded.count()
+            superseded.delete()
+        return count
+
+
+class Tombstone(TimeStampedModel):
+    """
+    Record of a deleted Release or Note, or of a removed Note.releases
+    link, so that mirrors syncing with modified_after can apply deletes.
+    For links, object_id is the note and related_id is the release.
+    """
+    KINDS = ('release', 'note', 'note_releases')
+
+    kind = models.CharField(max_length=20, choices=[(k, k) for k in KINDS])
+    object_id = models.IntegerField()
+    related_id = models.IntegerField(null=True, blank=True)
+
+    objects = TombstoneManager()
+
+    def __unicode__(self):
+        return '{kind} {object_id} {related_id}'.format(
+            kind=self.kind, object_id=self.object_id,
+            related_id=self.related_id or '').strip()
+
+
+class ChangeManager(models.Manager):
+    def record(self, kind, action, keys, using=None):
+        """
+        Append a change for each key, an object id or a (note id, release
+        id) pair for links, unless within preserve_modified.
+        """
+        if getattr(_local, 'preserve_modified', False):
+            return
+        changes = []
+        for key in keys:
+            object_id, related_id = key if isinstance(key, tuple) else (
+                key, None)
+            changes.append(Change(kind=kind, action=action,
+                                  object_id=object_id, related_id=related_id))
+        self.db_manager(using).bulk_create(changes)
+
+    def compact(self):
+        """
+        Delete all but the latest change of each object or link, which is
+        all a consumer needs to catch up from any sequence number. Returns
+        the number deleted.
+        """
+        count = 0
+        latest = self.values('kind', 'object_id', 'related_id').annotate(
+            count=models.Count('id'), latest=models.Max('id')).filter(
+            count__gt=1).order_by()
+        for group in latest:
+            superseded = self.filter(
+                kind=group['kind'], object_id=group['object_id'],
+                related_id=group['related_id'], id__lt=group['latest'])
+            count += group['count'] - 1
+            superseded.delete()
+        return count
+
+
+class Change(models.Model):
+    """
+    Append-only log of saved and deleted releases and notes and of added
+    and removed Note.releases links, whose ids are sequence numbers that
+    consumers of the change feed continue from. For links, object_id is
+    the note and related_id is the release.
+    """
+    KINDS = Tombstone.KINDS
+    ACTIONS = ('save', 'delete', 'link', 'unlink')
+
+    kind = models.CharField(max_length=20, choices=[(k, k) for k in KINDS])
+    action = models.CharField(max_length=10,
+                              choices=[(a, a) for a in ACTIONS])
+    object_id = models.IntegerField()
+    related_id = models.IntegerField(null=True, blank=True)
+    created = CreationDateTimeField()
+
+    objects = ChangeManager()
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return '{id} {action} {kind} {object_id} {related_id}'.format(
+            id=self.id, action=self.action, kind=self.kind,
+            object_id=self.object_id,
+            related_id=self.related_id or '').strip()
+
+
+def note_releases_changed(sender, instance, action, reverse, model, pk_set,
+                          using, **kwargs):
+    """
+    Stamp the modified timestamp on both sides of Note.releases links as
+    they are added, removed or cleared, since neither side is saved, log
+    each change and keep a tombstone for each removed link.
+    """
+    if getattr(_local, 'preserve_modified', False):
+        return
+    if action == 'pre_clear':
+        related = instance.note_set if reverse else instance.releases
+        instance._cleared_pks = list(related.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_pks', None)
+        # the links are logged below rather than saves of either side
+        instance.modified = datetime.now()
+        instance._default_manager.using(using).filter(
+            pk=instance.pk).update(modified=instance.modified, record=False)
+        if not pk_set:
+            return
+        model._default_manager.using(using).filter(
+            pk__in=pk_set).update(modified=instance.modified, record=False)
+        if reverse:
+            links = [(pk, instance.pk) for pk in pk_set]
+        else:
+            links = [(instance.pk, pk) for pk in pk_set]
+        Change.objects.record(
+            'note_releases', 'link' if action == 'post_add' else 'unlink',
+            links, using)
+
+        if action == 'post_add':
+            # a link that comes back is no longer deleted
+            tombstones = Tombstone.objects.using(using).filter(
+                kind='note_releases')
+            if reverse:
+                tombstones = tombstones.filter(
+                    object_id__in=pk_set, related_id=instance.pk)
+            else:
+                tombstones = tombstones.filter(
+                    object_id=instance.pk, related_id__in=pk_set)
+            tombstones.delete()
+        else:
+            Tombstone.objects.using(using).bulk_create([
+                Tombstone(kind='note_releases', object_id=note_id,
+                          related_id=release_id)
+                for note_id, release_id in links])
+
+
+def record_save(sender, instance, raw, using, **kwargs):
+    """Log a saved Release or Note"""
+    if not raw:
+        Change.objects.record(sender._meta.module_name, 'save',
+                              [instance.pk], using)
+
+
+def record_deletion(sender, instance, using, **kwargs):
+    """Log a deleted Release or Note and keep a tombstone for it"""
+    if getattr(_local, 'preserve_modified', False):
+        return
+    Tombstone.objects.using(using).create(
+        kind=sender._meta.module_name, object_id=instance.pk)
+    Change.objects.record(sender._meta.module_name, 'delete',
+                          [instance.pk], using)
+
+
+def note_image_loaded(sender, instance, **kwargs):
+    value = instance.__dict__.get('image')
+    instance._image_name = getattr(value, 'name', value) or ''
+
+
+def note_image_saved(sender, instance, raw, **kwargs):
+    """
+    Replace the size variants of the previous image with those of the
+    new one when the image changes.
+    """
+    if raw or getattr(_local, 'preserve_modified', False):
+        return
+    original = getattr(instance, '_image_name', None)
+    if original is None or instance.image.name == original:
+        return
+    if original:
+        images.delete_variants(instance.image.storage, original)
+    if instance.image:
+        try:
+            images.generate_variants(instance.image)
+        except IOError:
+            pass  # the original is still served; rnaimages --all retries
+    instance._image_name = instance.image.name
+
+
+def note_image_deleted(sender, instance, **kwargs):
+    if instance.image:
+        images.delete_variants(instance.image.storage, instance.image.name)
+
+
+m2m_changed.connect(note_releases_changed, sender=Note.releases.through)
+post_init.connect(note_image_loaded, sender=Note)
+post_save.connect(note_image_saved, sender=Note)
+post_delete.connect(note_image_deleted, sender=Note)
+post_save.connect(record_save, sender=Release)
+post_save.connect(record_save, sender=Note)
+post_delete.connect(record_deletion, sender=Release)
+post_delete.connect(record_deletion, sender=Note)
@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+SQL query counts and times for requests, management commands and tests.
+
+Add 'rna.profiling.QueryStatsMiddleware' to MIDDLEWARE_CLASSES to log the
+queries of every request to the rna.queries logger, with response headers
+in DEBUG mode and per-view budgets from RNA['QUERY_BUDGETS'], such as
+{'NoteViewSet': 3}.
+"""
+
+import contextlib
+import functools
+import logging
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('rna.queries')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats(object):
+    """
+    The queries made on the connection of the database alias using, or on
+    all the connections such as the replicas of ReplicaRouter, between
+    start() and stop(), with their count, total time in seconds and the
+    slowest statements.
+    """
+    def __init__(self, using=None):
+        self.connections = [connections[using]] if using else \
+            connections.all()
+        self.queries = []
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+
+    def start(self):
+        self._starts = []
+        for connection in self.connections:
+            self._starts.append((connection, connection.use_debug_cursor,
+                                 len(connection.queries)))
+            connection.use_debug_cursor = True
+        return self
+
+    def stop(self):
+        self.queries = []
+        for connection, use_debug_cursor, start in self._starts:
+            self.queries.extend(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+            if not (use_debug_cursor or settings.DEBUG):
+                # nobody else asked for the queries, so don't let them
+                # pile up in long running commands
+                del connection.queries[start:]
+        self.count = len(self.queries)
+        self.time = sum(float(q['time']) for q in self.queries)
+        self.slowest = sorted(
+            self.queries, key=lambda q: float(q['time']),
+            reverse=True)[:settings.RNA.get('SLOW_QUERY_COUNT', 3)]
+        return self
+
+    def log(self, name, budget=None):
+        logger.info(
+            '%s: %s queries in %.3fs', name, self.count, self.time,
+            extra={'query_source': name, 'query_count': self.count,
+                   'query_time': self.time, 'query_budget': budget,
+                   'slowest_queries': self.slowest})
+
+    def check(self, name, budget):
+        """
+        Raise QueryBudgetExceeded listing the statements if more than
+        budget queries were made.
+        """
+        if budget is not None and self.count > budget:
+            raise QueryBudgetExceeded(
+                '%s made %s queries, more than its budget of %s:\n%s' % (
+                    name, self.count, budget,
+                    '\n'.join(q['sql'] for q in self.queries)))
+
+
+@contextlib.contextmanager
+def query_stats(using=None):
+    stats = QueryStats(using).start()
+    try:
+        yield stats
+    finally:
+        stats.stop()
+
+
+@contextlib.contextmanager
+def max_queries(budget, name='block', using=None):
+    """
+    Fail with QueryBudgetExceeded if the block makes more than budget
+    queries, for tests that guard against N+1 regressions.
+    """
+    with query_stats(using) as stats:
+        yield stats
+    stats.check(name, budget)
+
+
+def log_query_stats(handle):
+    """
+    Log the queries made by a management command's handle method.
+    """
+    @functools.wraps(handle)
+    def wrapper(self, *args, **options):
+        with query_stats() as stats:
+            result = handle(self, *args, **options)
+        stats.log(self.__module__.rsplit('.', 1)[-1])
+        return result
+    return wrapper
+
+
+class QueryStatsMiddleware(object):
+    def process_request(self, request):
+        request._rna_query_stats = QueryStats().start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # DRF's as_view() copies the view class name onto the function
+        request._rna_view_name = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        stats = getattr(request, '_rna_query_stats', None)
+        if stats is None:
+            return response
+        del request._rna_query_stats
+        stats.stop()
+        name = getattr(request, '_rna_view_name', None) or request.path
+        budget = settings.RNA.get('QUERY_BUDGETS', {}).get(name)
+        stats.log(name, budget)
+        if settings.DEBUG:
+            response['X-RNA-Query-Count'] = str(stats.count)
+            response['X-RNA-Query-Time'] = '%.3f' % stats.time
+        try:
+            stats.check(name, budget)
+        except QueryBudgetExceeded:
+            if settings.RNA.get('ENFORCE_QUERY_BUDGETS', False):
+                raise
+            logger.warning('%s made %s queries, more than its budget of %s',
+                           name, stats.count, budget)
+        return response
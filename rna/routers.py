@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Read replica routing for the RNA API.
+
+Add 'rna.routers.ReplicaRouter' to DATABASE_ROUTERS and list the replica
+aliases in RNA['REPLICAS']. Only reads made inside use_replica(), which
+ReplicaReadMixin wraps around safe API requests, go to a replica, so
+writes, the admin and rnasync stay on the default database.
+
+A client that made a write reads from the default database for the next
+RNA['REPLICA_STICKY_SECONDS'] seconds, so it sees its own writes. A
+replica whose latest modified note or release is more than
+RNA['REPLICA_MAX_LAG'] seconds behind the default database's is not used,
+checked at most every RNA['REPLICA_LAG_CHECK_INTERVAL'] seconds.
+"""
+
+import contextlib
+import hashlib
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+# django.db loads the routers, so this module can't import it or models
+# at the top
+from django.db.utils import DEFAULT_DB_ALIAS, DatabaseError
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_local = threading.local()
+_lag_checks = {}
+
+
+def replica_lag(alias):
+    """
+    Return how many seconds the latest modified note or release in a
+    replica is behind the default database's, or None if it could not
+    be read.
+    """
+    from django.db.models import Max
+    from . import models
+
+    lag = 0
+    try:
+        for model in (models.Note, models.Release):
+            primary = model.objects.using(DEFAULT_DB_ALIAS).aggregate(
+                latest=Max('modified'))['latest']
+            replica = model.objects.using(alias).aggregate(
+                latest=Max('modified'))['latest']
+            if primary and not replica:
+                return None
+            if primary and primary > replica:
+                delta = primary - replica
+                lag = max(lag, delta.days * 86400 + delta.seconds)
+    except DatabaseError:
+        return None
+    return lag
+
+
+def healthy_replicas():
+    replicas = []
+    now = time.time()
+    max_lag = settings.RNA.get('REPLICA_MAX_LAG', 60)
+    for alias in settings.RNA.get('REPLICAS', ()):
+        checked, lag = _lag_checks.get(alias, (None, None))
+        if checked is None or now - checked > settings.RNA.get(
+                'REPLICA_LAG_CHECK_INTERVAL', 5):
+            lag = replica_lag(alias)
+            _lag_checks[alias] = (now, lag)
+        if lag is not None and lag <= max_lag:
+            replicas.append(alias)
+    return replicas
+
+
+@contextlib.contextmanager
+def use_replica():
+    """
+    Send the reads made in the block to one healthy replica, chosen for
+    the whole block, or to the default database if there is none.
+    """
+    previous = getattr(_local, 'replica', None)
+    replicas = healthy_replicas()
+    _local.replica = random.choice(replicas) if replicas else None
+    try:
+        yield _local.replica
+    finally:
+        _local.replica = previous
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = set(settings.RNA.get('REPLICAS', ()))
+        aliases.add(DEFAULT_DB_ALIAS)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+
+
+def _sticky_key(request):
+    client = (request.META.get('HTTP_AUTHORIZATION') or
+              request.COOKIES.get(settings.SESSION_COOKIE_NAME) or
+              request.META.get('REMOTE_ADDR', ''))
+    return 'rna:primary:' + hashlib.md5(client).hexdigest()
+
+
+def is_sticky(request):
+    return bool(cache.get(_sticky_key(request)))
+
+
+def make_sticky(request):
+    cache.set(_sticky_key(request), True,
+              settings.RNA.get('REPLICA_STICKY_SECONDS', 10))
+
+
+class ReplicaReadMixin(object):
+    """
+    Serve safe requests from a replica, unless the client wrote recently,
+    and keep a client that writes on the default database for a while.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            if settings.RNA.get('REPLICAS') and not is_sticky(request):
+                with use_replica():
+                    return super(ReplicaReadMixin, self).dispatch(
+                        request, *args, **kwargs)
+            return super(ReplicaReadMixin, self).dispatch(
+                request, *args, **kwargs)
+        response = super(ReplicaReadMixin, self).dispatch(
+            request, *args, **kwargs)
+        if settings.RNA.get('REPLICAS') and response.status_code < 400:
+            make_sticky(request)
+        return response
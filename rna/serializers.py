@@ -2,16 +2,114 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from rest_framework import serializers
+from itertools import islice
+from operator import itemgetter
+
+from django.core.urlresolvers import NoReverseMatch
+from django.db.models import AutoField, DateField, DateTimeField, ForeignKey
+from django.db.models import Field as ModelFieldBase
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import is_protected_type, smart_unicode
+from rest_framework import fields, relations, serializers
 from rest_framework.compat import parse_datetime
+from rest_framework.reverse import reverse
+
+from . import images, models
+
+# stands in for the lookup value when reversing a URL template
+URL_LOOKUP_MARKER = 'rna-lookup-marker'
+
+_client_serializer_classes = {}
+_deserializers = {}
 
 
 def get_client_serializer_class(model_class):
-    class ClientSerializer(UnmodifiedTimestampSerializer):
-        class Meta:
-            model = model_class
+    if model_class not in _client_serializer_classes:
+        class ClientSerializer(UnmodifiedTimestampSerializer):
+            class Meta:
+                model = model_class
+
+        _client_serializer_classes[model_class] = ClientSerializer
+    return _client_serializer_classes[model_class]
+
+
+def get_deserializer(model_class):
+    if model_class not in _deserializers:
+        _deserializers[model_class] = ModelDeserializer(model_class)
+    return _deserializers[model_class]
+
+
+def _parse_datetime(value):
+    if isinstance(value, basestring):
+        return parse_datetime(value) or value
+    return value
+
+
+class ModelDeserializer(object):
+    """
+    Restores a model instance from API data like a ClientSerializer's
+    restore_object, with the field lookups made once per model rather
+    than once per object. Keys the model doesn't have are dropped,
+    datetimes are parsed, hyperlinks are resolved with the related
+    callback and many-to-many values are kept for save_object.
+    """
+    def __init__(self, model_class):
+        meta = model_class._meta
+        self.model_class = model_class
+        # (attname, name, converter, related model, default)
+        self.fields = []
+        for f in meta.fields:
+            self.fields.append((
+                f.attname, f.name,
+                _parse_datetime if isinstance(f, DateTimeField) else None,
+                f.rel.to if isinstance(f, ForeignKey) else None,
+                f.get_default))
+        self.fk_caches = [(f.name, f.get_cache_name()) for f in meta.fields
+                          if isinstance(f, ForeignKey)]
+        self.many_to_many = [(f.name, f.rel.to) for f in meta.many_to_many]
+        self.reverse_fks = set(
+            o.field.related_query_name()
+            for o, m in meta.get_all_related_objects_with_model())
+        self.reverse_m2ms = set(
+            o.field.related_query_name()
+            for o, m in meta.get_all_related_m2m_objects_with_model())
 
-    return ClientSerializer
+    def restore(self, data, related):
+        """
+        Return an unsaved instance for data, calling related(url, model)
+        for the instance each hyperlink refers to.
+        """
+        values = []
+        relations = {}
+        for attname, name, convert, related_model, default in self.fields:
+            if related_model:
+                url = data.get(name)
+                obj = related(url, related_model) if url else None
+                relations[name] = obj
+                values.append(obj.pk if obj is not None else None)
+            elif name in data:
+                value = data[name]
+                values.append(convert(value) if convert else value)
+            else:
+                values.append(default())
+        # positional arguments take Model.__init__'s fast path
+        instance = self.model_class(*values)
+        for name, cache_name in self.fk_caches:
+            if relations[name] is not None:
+                setattr(instance, cache_name, relations[name])
+
+        m2m_data = {}
+        for name, related_model in self.many_to_many:
+            m2m_data[name] = [related(url, related_model)
+                              for url in data.get(name, [])]
+        related_data = {}
+        for name in self.reverse_fks.intersection(data):
+            related_data[name] = data[name]
+        for name in self.reverse_m2ms.intersection(data):
+            m2m_data[name] = data[name]
+        instance._related_data = related_data
+        instance._m2m_data = m2m_data
+        return instance
 
 
 class HyperlinkedModelSerializerWithPkField(
@@ -25,11 +123,38 @@ class HyperlinkedModelSerializerWithPkField(
         return self.get_field(model_field)
 
 
+class ImageVariantsField(serializers.Field):
+    """
+    The URLs of the size variants of an image field, like its model's
+    image_variants method.
+    """
+    def __init__(self, image_field='image', *args, **kwargs):
+        self.image_field = image_field
+        super(ImageVariantsField, self).__init__(*args, **kwargs)
+
+    def field_to_native(self, obj, field_name):
+        return self.to_native(images.variant_urls(
+            getattr(obj, self.image_field)))
+
+    def values_to_native(self, values):
+        field = self.parent.opts.model._meta.get_field(self.image_field)
+        return self.to_native(images.variant_urls(field.attr_class(
+            None, field, values[field.attname])))
+
+
+class NoteSerializer(HyperlinkedModelSerializerWithPkField):
+    image_variants = ImageVariantsField()
+
+    class Meta:
+        model = models.Note
+
+
 class UnmodifiedTimestampSerializer(serializers.ModelSerializer):
     def restore_object(self, attrs, instance=None):
         obj = super(UnmodifiedTimestampSerializer, self).restore_object(
             attrs, instance=instance)
-        for attr in ('created', 'modified'):  # TODO: dynamic attr list
+        # TODO: dynamic attr list
+        for attr in ('created', 'modified', 'content_modified'):
             value = getattr(obj, attr, None)
             if value and isinstance(value, basestring):
                 setattr(obj, attr, parse_datetime(value))
@@ -37,5 +162,187 @@ class UnmodifiedTimestampSerializer(serializers.ModelSerializer):
 
     def save_object(self, obj, **kwargs):
         kwargs['modified'] = False
-        return super(UnmodifiedTimestampSerializer, self).save_object(
-            obj, **kwargs)
+        with models.preserve_modified():
+            return super(UnmodifiedTimestampSerializer, self).save_object(
+                obj, **kwargs)
+
+
+class UnsupportedField(Exception):
+    pass
+
+
+def _url_template(view_name, request, format):
+    """
+    The URL of view_name around its pk, as a (prefix, suffix) pair.
+    """
+    try:
+        url = reverse(view_name, kwargs={'pk': URL_LOOKUP_MARKER},
+                      request=request, format=format)
+    except NoReverseMatch:
+        raise UnsupportedField('Could not reverse %s' % view_name)
+    if url.count(URL_LOOKUP_MARKER) != 1:
+        raise UnsupportedField('Could not reverse %s' % view_name)
+    return tuple(url.split(URL_LOOKUP_MARKER))
+
+
+def _is_integer_pk(model_class):
+    return isinstance(model_class._meta.pk, AutoField)
+
+
+def _links_to_pk(model_field):
+    """
+    Whether a relation's values are the integer pks of its model.
+    """
+    rel = model_field.rel
+    if not rel or not _is_integer_pk(rel.to):
+        return False
+    return model_field in model_field.model._meta.many_to_many or (
+        rel.field_name == rel.to._meta.pk.name)
+
+
+def _related_ordering(prefix, model_class):
+    ordering = []
+    for name in model_class._meta.ordering:
+        if name.startswith('-'):
+            ordering.append('-%s__%s' % (prefix, name[1:]))
+        else:
+            ordering.append('%s__%s' % (prefix, name))
+    return ordering
+
+
+def _hyperlink(template, attname):
+    prefix, suffix = template
+
+    def get(values):
+        pk = values[attname]
+        if pk is None:
+            return None
+        return '%s%s%s' % (prefix, pk, suffix)
+    return get
+
+
+class ValuesListSerializer(object):
+    """
+    Serializes a queryset to the same data as serializer(queryset,
+    many=True), from values() rows rather than model instances. Each
+    field is compiled once, hyperlinks are filled in from URL templates
+    reversed once, and many-to-many hyperlinks come from one query per
+    batch_size rows. Raises UnsupportedField for a serializer with a field
+    it can't reproduce exactly.
+    """
+    batch_size = 500
+
+    def __init__(self, serializer, queryset):
+        self.queryset = queryset
+        meta = queryset.model._meta
+        self.attnames = [f.attname for f in meta.fields]
+        self.pk_attname = meta.pk.attname
+        model_fields = dict((f.name, f) for f in meta.fields)
+        many_to_many = dict((f.name, f) for f in meta.many_to_many)
+        request = serializer.context.get('request')
+        context_format = serializer.context.get('format')
+
+        # (key, function of the values of a row)
+        self.columns = []
+        # (key, many-to-many model field, URL template)
+        self.many_to_many = []
+        for field_name, field in serializer.fields.items():
+            field.initialize(parent=serializer, field_name=field_name)
+            key = serializer.get_field_key(field_name)
+            source = field.source or field_name
+            model_field = model_fields.get(source)
+            if isinstance(field, relations.HyperlinkedIdentityField):
+                format = context_format
+                if format and field.format and field.format != format:
+                    format = field.format
+                if field.lookup_field != 'pk' or not _is_integer_pk(
+                        queryset.model):
+                    raise UnsupportedField(field_name)
+                column = _hyperlink(
+                    _url_template(field.view_name, request, format),
+                    self.pk_attname)
+            elif isinstance(field, relations.HyperlinkedRelatedField):
+                format = field.format or context_format
+                related = (many_to_many.get(source) if field.many
+                           else model_field)
+                if (field.lookup_field != 'pk' or related is None or
+                        not _links_to_pk(related)):
+                    raise UnsupportedField(field_name)
+                template = _url_template(field.view_name, request, format)
+                if field.many:
+                    self.many_to_many.append((key, related, template))
+                    column = itemgetter(key)
+                else:
+                    column = _hyperlink(template, related.attname)
+            elif hasattr(field, 'values_to_native'):
+                column = field.values_to_native
+            elif (isinstance(field, relations.RelatedField) or
+                    model_field is None or model_field.rel):
+                raise UnsupportedField(field_name)
+            elif isinstance(field, fields.ModelField):
+                column = self._model_field_column(field_name, model_field)
+            elif (type(field).field_to_native.im_func is not
+                    fields.Field.field_to_native.im_func):
+                raise UnsupportedField(field_name)
+            elif isinstance(field, fields.FileField):
+                # the name of the file, which is what the row holds
+                column = itemgetter(model_field.attname)
+            elif (type(field).to_native.im_func is
+                    fields.Field.to_native.im_func):
+                # database values come out the same without to_native
+                column = itemgetter(model_field.attname)
+            else:
+                column = self._to_native_column(field, model_field.attname)
+            self.columns.append((key, column))
+
+    def _model_field_column(self, field_name, model_field):
+        # ModelField passes protected types through, so dates stay
+        # datetime objects for the renderer, and strings anything else
+        if (not isinstance(model_field, DateField) and
+                type(model_field).value_to_string.im_func is not
+                ModelFieldBase.value_to_string.im_func):
+            raise UnsupportedField(field_name)
+        attname = model_field.attname
+
+        def get(values):
+            value = values[attname]
+            if is_protected_type(value):
+                return value
+            return smart_unicode(value)
+        return get
+
+    def _to_native_column(self, field, attname):
+        to_native = field.to_native
+        return lambda values: to_native(values[attname])
+
+    def add_many_to_many(self, rows):
+        ids = [row[self.pk_attname] for row in rows]
+        for key, model_field, (prefix, suffix) in self.many_to_many:
+            urls = dict((pk, []) for pk in ids)
+            through = model_field.rel.through
+            source = model_field.m2m_field_name()
+            target = model_field.m2m_reverse_field_name()
+            # in the order of the related manager's all()
+            ordering = _related_ordering(target, model_field.rel.to)
+            links = through.objects.filter(**{
+                '%s__in' % source: ids}).order_by(
+                *(ordering or ['pk'])).values_list(
+                '%s_id' % source, '%s_id' % target)
+            for pk, related_pk in links:
+                urls[pk].append('%s%s%s' % (prefix, related_pk, suffix))
+            for row in rows:
+                row[key] = urls[row[self.pk_attname]]
+
+    @property
+    def data(self):
+        data = []
+        rows = self.queryset.values(*self.attnames).iterator()
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return data
+            if self.many_to_many:
+                self.add_many_to_many(batch)
+            for row in batch:
+                data.append(SortedDict(
+                    [(key, column(row)) for key, column in self.columns]))
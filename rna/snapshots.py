@@ -0,0 +1,193 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Gzipped JSON lines snapshots of releases, notes, their links, tombstones
+and the change log, for bootstrapping a mirror in one step rather than paging
+through the API with rnasync.
+
+The first line is a header with the format version and the watermark, the
+time the dump started. Each following line is a [kind, values] pair and
+the last line holds the count of each kind, so that a truncated snapshot
+is refused. All the tables are read in one transaction that sees a single
+snapshot of the database, on the backends in SNAPSHOT_SQL, so that rows
+only refer to rows in the snapshot. Rows modified after the watermark are
+written with the watermark as their modified time, so rnasync, which asks
+for what was modified since the latest local modified time, fetches them
+again after a load. Only changes logged before the dump started are
+written, so a mirror following the change feed after a load applies again
+whatever changed while the dump ran.
+"""
+
+from datetime import datetime
+import gzip
+import json
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from . import models
+
+FORMAT = 'rna-snapshot'
+VERSION = 3
+
+# the statement starting a transaction whose reads see a single snapshot
+SNAPSHOT_SQL = {
+    'postgresql': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+    'mysql': 'START TRANSACTION WITH CONSISTENT SNAPSHOT',
+    'oracle': 'SET TRANSACTION READ ONLY',
+    'sqlite': 'BEGIN',
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _kinds():
+    # in load order, so that rows only refer to rows loaded before them
+    return (('release', models.Release), ('note', models.Note),
+            ('note_releases', models.Note.releases.through),
+            ('tombstone', models.Tombstone), ('change', models.Change))
+
+
+def _attnames(model):
+    return [f.attname for f in model._meta.fields]
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+@transaction.commit_manually
+def dump(path, batch_size=1000):
+    """
+    Write a snapshot to path, returning the count of each kind.
+    """
+    # a transaction left open by earlier reads can't change its isolation
+    transaction.commit()
+    try:
+        sql = SNAPSHOT_SQL.get(connection.vendor)
+        if sql:
+            connection.cursor().execute(sql)
+        return _dump(path, batch_size)
+    finally:
+        # nothing was written
+        transaction.rollback()
+
+
+def _dump(path, batch_size):
+    watermark = datetime.now()
+    last_change = models.Change.objects.aggregate(
+        latest=Max('id'))['latest'] or 0
+    counts = {}
+    with gzip.open(path, 'wb') as f:
+        def write(line):
+            f.write(json.dumps(line, default=_default) + '\n')
+
+        write({'format': FORMAT, 'version': VERSION,
+               'watermark': watermark})
+        for kind, model in _kinds():
+            names = _attnames(model)
+            modified = names.index('modified') if 'modified' in names else -1
+            rows = model.objects.order_by('id').values_list(*names)
+            if kind == 'change':
+                rows = rows.filter(id__lte=last_change)
+            counts[kind] = last_id = 0
+            while True:
+                # read by id so that memory use does not grow with the table
+                batch = list(rows.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+                for row in batch:
+                    row = list(row)
+                    if modified >= 0 and row[modified] > watermark:
+                        row[modified] = watermark
+                    write([kind, row])
+                counts[kind] += len(batch)
+        write({'counts': counts})
+    return counts
+
+
+def read(path):
+    """
+    Yield the header of the snapshot at path and then its (kind, row)
+    pairs, raising SnapshotError if it is not a complete snapshot of a
+    version this code can load.
+    """
+    counts = dict((kind, 0) for kind, model in _kinds())
+    with gzip.open(path, 'rb') as f:
+        lines = (json.loads(line) for line in f)
+        try:
+            header = next(lines)
+        except (StopIteration, ValueError, IOError):
+            raise SnapshotError('%s is not a snapshot' % path)
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise SnapshotError('%s is not a snapshot' % path)
+        if header.get('version') != VERSION:
+            raise SnapshotError('%s is a version %s snapshot, not %s' % (
+                path, header.get('version'), VERSION))
+        yield header
+        try:
+            for line in lines:
+                if isinstance(line, dict):
+                    if line.get('counts') != counts:
+                        raise SnapshotError('%s has the wrong counts' % path)
+                    return
+                kind, row = line
+                counts[kind] += 1
+                yield kind, row
+        except (ValueError, IOError, KeyError) as e:
+            raise SnapshotError('%s is damaged: %s' % (path, e))
+    raise SnapshotError('%s is incomplete' % path)
+
+
+@transaction.commit_on_success
+def load(path, batch_size=1000):
+    """
+    Load a snapshot into an empty database in a single transaction, with
+    constraint checks deferred until all rows are in. Returns the header
+    and the count of each kind.
+    """
+    kinds = _kinds()
+    if any(model.objects.exists() for kind, model in kinds):
+        raise SnapshotError('The database already has RNA data')
+    fields = dict((kind, model._meta.fields) for kind, model in kinds)
+    model_for = dict(kinds)
+    pending = dict((kind, []) for kind, model in kinds)
+    counts = dict((kind, 0) for kind, model in kinds)
+
+    def create(kind):
+        objs = pending[kind]
+        queryset = model_for[kind].objects.all()
+        if isinstance(queryset, models.TimeStampedQuerySet):
+            queryset.bulk_create(objs, modified=False)
+        else:
+            queryset.bulk_create(objs)
+        counts[kind] += len(objs)
+        pending[kind] = []
+
+    rows = read(path)
+    header = next(rows)
+    with connection.constraint_checks_disabled():
+        for kind, row in rows:
+            pending[kind].append(model_for[kind](**dict(
+                (f.attname, f.to_python(value))
+                for f, value in zip(fields[kind], row))))
+            if len(pending[kind]) >= batch_size:
+                create(kind)
+        for kind, model in kinds:
+            create(kind)
+    connection.check_constraints(
+        table_names=[model._meta.db_table for kind, model in kinds])
+
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(
+            no_style(), [model for kind, model in kinds]):
+        cursor.execute(sql)
+    return header, counts
@@ -0,0 +1,63 @@
+// Search box for ReleaseAutocompleteWidget. The select only holds the
+// chosen releases; matching releases are fetched a page at a time and
+// added to it as selected options when clicked. Deselecting an option
+// removes the release when the form is saved.
+;(function($) {
+  'use strict';
+
+  $(function() {
+    $('select[data-autocomplete-url]').each(function() {
+      var $select = $(this);
+      var url = $select.attr('data-autocomplete-url');
+      var $input = $('<input type="text" autocomplete="off" placeholder="Search releases">');
+      var $results = $('<ul class="release-autocomplete-results"></ul>');
+      var timer, query, page;
+
+      function fetch() {
+        $.getJSON(url, {q: query, page: page}, function(data) {
+          if (page === 1) {
+            $results.empty();
+          }
+          $results.find('.more').remove();
+          $.each(data.results, function(i, release) {
+            $('<li><a href="#"></a></li>').find('a').text(release.text)
+              .data('release', release).end().appendTo($results);
+          });
+          if (data.more) {
+            $('<li class="more"><a href="#">More&hellip;</a></li>').appendTo($results);
+          }
+        });
+      }
+
+      $input.bind('keyup', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+          if ($input.val() !== query) {
+            query = $input.val();
+            page = 1;
+            fetch();
+          }
+        }, 250);
+      });
+
+      $results.delegate('a', 'click', function(e) {
+        e.preventDefault();
+        var $li = $(this).parent();
+        if ($li.hasClass('more')) {
+          page += 1;
+          fetch();
+          return;
+        }
+        var release = $(this).data('release');
+        var $option = $select.find('option[value="' + release.id + '"]');
+        if (!$option.length) {
+          $option = $('<option></option>').val(release.id).text(release.text)
+            .appendTo($select);
+        }
+        $option.attr('selected', 'selected');
+      });
+
+      $select.before($input).after($results);
+    });
+  });
+})(django.jQuery);
@@ -2,17 +2,75 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from datetime import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.color import no_style
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, router
+from django.db.models import get_models
 from django.db.models.query import EmptyQuerySet
-from django.test import TestCase
+from django.db.models.signals import post_delete, post_save
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
-from mock import Mock, patch
+from mock import Mock, call, patch
 from nose.tools import eq_, ok_
-
-from . import admin, clients, fields, filters, models, serializers, views
-from .management.commands import rnasync
+import requests
+from rest_framework.renderers import JSONRenderer
+from rest_framework import serializers as drf_serializers
+
+from . import (admin, benchmarks, clients, fields, filters, httpcache, images,
+               metrics, models, profiling, routers, serializers, snapshots,
+               utils, views)
+from .management.commands import rnabench, rnacompact, rnaimages, rnasync
+
+
+class ModelTablesMixin(object):
+    """
+    Create the tables of the rna models that the test databases lack,
+    since the test settings install the app under a label without its
+    models, for tests that need real rows. Tables created are dropped
+    again after each test.
+    """
+    databases = (DEFAULT_DB_ALIAS,)
+
+    def setUp(self):
+        super(ModelTablesMixin, self).setUp()
+        self.created_tables = {}
+        for using in self.databases:
+            connection = connections[using]
+            existing = connection.introspection.table_names()
+            cursor = connection.cursor()
+            seen = set()
+            created = self.created_tables[using] = []
+            for model in get_models(include_auto_created=True,
+                                    only_installed=False):
+                table = model._meta.db_table
+                if model._meta.app_label != 'rna' or table in existing:
+                    continue
+                sql, pending = connection.creation.sql_create_model(
+                    model, no_style(), seen)
+                for statement in sql:
+                    cursor.execute(statement)
+                created.append(table)
+
+    def tearDown(self):
+        for using, tables in self.created_tables.items():
+            connection = connections[using]
+            cursor = connection.cursor()
+            for table in tables:
+                cursor.execute('DROP TABLE %s' %
+                               connection.ops.quote_name(table))
+        super(ModelTablesMixin, self).tearDown()
 
 
 class TimeStampedModelTest(TestCase):
@@ -33,6 +91,186 @@ class TimeStampedModelTest(TestCase):
         mock_super_save.assert_called_once_with(db='test')
 
 
+class TimeStampedQuerySetTest(TestCase):
+    @patch('rna.rna.models.QuerySet.update')
+    def test_update_default_modified(self, mock_super_update):
+        """
+        Should stamp modified in the same update
+        """
+        start = datetime.now()
+        models.TimeStampedQuerySet(models.Tombstone).update(test=False)
+        kwargs = mock_super_update.call_args[1]
+        eq_(kwargs['test'], False)
+        ok_(kwargs['modified'] >= start)
+
+    @patch('rna.rna.models.QuerySet.update')
+    def test_update_unmodified(self, mock_super_update):
+        """
+        Should not stamp modified if modified=False
+        """
+        models.TimeStampedQuerySet(models.Tombstone).update(test=False, modified=False)
+        mock_super_update.assert_called_once_with(test=False)
+
+    @patch('rna.rna.models.QuerySet.update')
+    def test_update_explicit_modified(self, mock_super_update):
+        """
+        Should use an explicit modified datetime
+        """
+        space_odyssey = datetime(2001, 1, 1)
+        models.TimeStampedQuerySet(models.Tombstone).update(modified=space_odyssey)
+        mock_super_update.assert_called_once_with(modified=space_odyssey)
+
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.models.QuerySet.values_list')
+    @patch('rna.rna.models.QuerySet.update')
+    def test_update_records_changes(self, mock_super_update,
+                                    mock_values_list, mock_changes):
+        """
+        Should log a save of each updated release or note, unless
+        record=False
+        """
+        mock_values_list.return_value = [1, 2]
+        mock_super_update.return_value = 2
+        eq_(models.TimeStampedQuerySet(models.Release).update(), 2)
+        mock_values_list.assert_called_once_with('pk', flat=True)
+        mock_changes.record.assert_called_once_with(
+            'release', 'save', [1, 2], 'default')
+        models.TimeStampedQuerySet(models.Note).touch()
+        eq_(mock_changes.record.call_args[0][:3], ('note', 'save', [1, 2]))
+        mock_changes.record.reset_mock()
+        models.TimeStampedQuerySet(models.Note).update(record=False)
+        eq_(mock_changes.record.called, False)
+        ok_('record' not in mock_super_update.call_args[1])
+
+    @patch('rna.rna.models.transaction')
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.models.QuerySet.values_list')
+    @patch('rna.rna.models.QuerySet.update')
+    def test_update_transaction(self, mock_super_update, mock_values_list,
+                                mock_changes, mock_transaction):
+        """
+        Should update and record in the caller's transaction if there is
+        one, and in a transaction of its own otherwise
+        """
+        mock_transaction.is_managed.return_value = True
+        models.TimeStampedQuerySet(models.Release).update()
+        mock_transaction.is_managed.assert_called_once_with(using='default')
+        eq_(mock_transaction.commit_on_success.called, False)
+        mock_transaction.is_managed.return_value = False
+        models.TimeStampedQuerySet(models.Release).update()
+        mock_transaction.commit_on_success.assert_called_once_with(
+            using='default')
+        eq_(mock_changes.record.call_count, 2)
+
+    @patch('rna.rna.models.QuerySet.bulk_create')
+    def test_bulk_create(self, mock_super_bulk_create):
+        """
+        Should stamp modified on every object unless modified=False
+        """
+        space_odyssey = datetime(2001, 1, 1)
+        objs = [Mock(modified=space_odyssey), Mock(modified=None)]
+        models.TimeStampedQuerySet().bulk_create(objs, modified=False)
+        eq_([o.modified for o in objs], [space_odyssey, None])
+        models.TimeStampedQuerySet().bulk_create(objs, batch_size=10)
+        ok_(objs[0].modified > space_odyssey)
+        eq_(objs[0].modified, objs[1].modified)
+        mock_super_bulk_create.assert_called_with(objs, batch_size=10)
+
+
+class NoteReleasesChangedTest(TestCase):
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.models.Tombstone.objects')
+    def test_post_add(self, mock_tombstones, mock_changes):
+        """
+        Should stamp modified on the instance and the related objects,
+        log the links and delete tombstones for the links added
+        """
+        instance = Mock(pk=1)
+        model = Mock()
+        models.note_releases_changed('sender', instance, 'post_add', False,
+                                     model, set([2, 3]), 'default')
+        mock_changes.record.assert_called_once_with(
+            'note_releases', 'link', [(1, 2), (1, 3)], 'default')
+        tombstones = mock_tombstones.using.return_value.filter
+        tombstones.assert_called_once_with(kind='note_releases')
+        tombstones.return_value.filter.assert_called_once_with(
+            object_id=1, related_id__in=set([2, 3]))
+        ok_(tombstones.return_value.filter.return_value.delete.called)
+        instance._default_manager.using.return_value.filter.assert_called_once_with(pk=1)
+        model._default_manager.using.return_value.filter.assert_called_once_with(
+            pk__in=set([2, 3]))
+        model._default_manager.using.return_value.filter.return_value.update.assert_called_once_with(
+            modified=instance.modified, record=False)
+
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.models.Tombstone.objects')
+    def test_clear(self, mock_tombstones, mock_changes):
+        """
+        Should stamp the related objects collected before clearing, and
+        record an unlink and a tombstone for each link
+        """
+        instance = Mock(pk=1)
+        instance.note_set.values_list.return_value = [2]
+        model = Mock()
+        models.note_releases_changed('sender', instance, 'pre_clear', True,
+                                     model, None, 'default')
+        models.note_releases_changed('sender', instance, 'post_clear', True,
+                                     model, None, 'default')
+        instance.note_set.values_list.assert_called_once_with('pk', flat=True)
+        model._default_manager.using.return_value.filter.assert_called_once_with(
+            pk__in=[2])
+        tombstones = mock_tombstones.using.return_value.bulk_create.call_args[0][0]
+        eq_([(t.kind, t.object_id, t.related_id) for t in tombstones],
+            [('note_releases', 2, 1)])
+        mock_changes.record.assert_called_once_with(
+            'note_releases', 'unlink', [(2, 1)], 'default')
+
+    def test_preserve_modified(self):
+        """
+        Should not stamp anything within preserve_modified
+        """
+        instance = Mock()
+        with models.preserve_modified():
+            models.note_releases_changed('sender', instance, 'post_add',
+                                         False, Mock(), set([2]), 'default')
+        eq_(instance._default_manager.using.called, False)
+
+
+class RecordDeletionTest(TestCase):
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.models.Tombstone.objects')
+    def test_record_deletion(self, mock_tombstones, mock_changes):
+        """
+        Should create a tombstone and a change named after the sender model
+        """
+        models.record_deletion(models.Note, Mock(pk=42), 'default')
+        mock_tombstones.using.assert_called_once_with('default')
+        mock_tombstones.using.return_value.create.assert_called_once_with(
+            kind='note', object_id=42)
+        mock_changes.record.assert_called_once_with(
+            'note', 'delete', [42], 'default')
+
+    @patch('rna.rna.models.Change.objects')
+    def test_record_save(self, mock_changes):
+        """
+        Should log saves, but not fixture loading
+        """
+        models.record_save(models.Release, Mock(pk=42), False, 'default')
+        mock_changes.record.assert_called_once_with(
+            'release', 'save', [42], 'default')
+        models.record_save(models.Release, Mock(pk=42), True, 'default')
+        eq_(mock_changes.record.call_count, 1)
+
+    @patch('rna.rna.models.Tombstone.objects')
+    def test_preserve_modified(self, mock_tombstones):
+        """
+        Should not create a tombstone within preserve_modified
+        """
+        with models.preserve_modified():
+            models.record_deletion(models.Note, Mock(pk=42), 'default')
+        eq_(mock_tombstones.using.called, False)
+
+
 class NoteTest(TestCase):
     def test_unicode(self):
         """
@@ -71,6 +309,97 @@ class NoteTest(TestCase):
         eq_(note.is_known_issue_for(release), False)
 
 
+class NoteImageTest(TestCase):
+    def test_image_loaded(self):
+        """
+        Should remember the name of the image as loaded
+        """
+        eq_(models.Note(image='screenshot/1/shot.png', image_width=640,
+                        image_height=480)._image_name,
+            'screenshot/1/shot.png')
+        eq_(models.Note()._image_name, '')
+
+    def test_image_dimension_fields(self):
+        """
+        Should store the dimensions of the image in image_width and
+        image_height, without reading images whose dimensions are stored
+        """
+        field = models.Note._meta.get_field('image')
+        eq_(field.width_field, 'image_width')
+        eq_(field.height_field, 'image_height')
+        note = models.Note(image='screenshot/1/shot.png', image_width=640,
+                           image_height=480)
+        eq_((note.image_width, note.image_height), (640, 480))
+
+    @patch('rna.rna.models.models.ImageField.update_dimension_fields')
+    @patch('rna.rna.models.images')
+    def test_image_saved_changed(self, mock_images, mock_update_dimension_fields):
+        """
+        Should replace the variants of the previous image
+        """
+        note = models.Note(image='screenshot/1/shot.png', image_width=640,
+                           image_height=480)
+        note.image = 'screenshot/1/shot2.png'
+        models.note_image_saved(models.Note, note, False)
+        mock_images.delete_variants.assert_called_once_with(
+            note.image.storage, 'screenshot/1/shot.png')
+        mock_images.generate_variants.assert_called_once_with(note.image)
+        eq_(note._image_name, 'screenshot/1/shot2.png')
+
+    @patch('rna.rna.models.models.ImageField.update_dimension_fields')
+    @patch('rna.rna.models.images')
+    def test_image_saved_preserve_modified(self, mock_images, mock_update_dimension_fields):
+        """
+        Should leave variants alone while restoring synced notes
+        """
+        note = models.Note(image='screenshot/1/shot.png', image_width=640,
+                           image_height=480)
+        note.image = 'screenshot/1/shot2.png'
+        with models.preserve_modified():
+            models.note_image_saved(models.Note, note, False)
+        eq_(mock_images.generate_variants.called, False)
+
+
+class ImagesTest(TestCase):
+    def test_variant_name(self):
+        eq_(images.variant_name('screenshot/1/shot.png', 'thumbnail'),
+            'screenshot/1/variants/shot-thumbnail.png')
+        eq_(images.variant_name('shot.png', 'medium'),
+            'variants/shot-medium.png')
+
+    @override_settings(RNA={'IMAGE_VARIANTS': {'thumbnail': (1, 1)}})
+    def test_variant_urls(self):
+        image = Mock(**{'storage.url.side_effect': lambda name: '/' + name})
+        image.name = 'screenshot/1/shot.png'
+        eq_(images.variant_urls(image),
+            {'thumbnail': '/screenshot/1/variants/shot-thumbnail.png'})
+        eq_(images.variant_urls(None), {})
+
+    @override_settings(RNA={'IMAGE_VARIANTS': {'thumbnail': (1, 1)}})
+    def test_generate_variants_exists(self):
+        """
+        Should not open the image if its variants are already stored
+        """
+        image = Mock(**{'storage.exists.return_value': True})
+        image.name = 'shot.png'
+        images.generate_variants(image)
+        eq_(image.open.called, False)
+        eq_(image.storage.save.called, False)
+
+
+class AdminImageWidgetTest(TestCase):
+    @override_settings(RNA={'IMAGE_VARIANTS': {'thumbnail': (1, 1)}})
+    def test_render(self):
+        """
+        Should render stored dimensions and the thumbnail
+        """
+        note = models.Note(image='screenshot/1/shot.png', image_width=640,
+                           image_height=480)
+        html = admin.AdminImageWidget().render('image', note.image)
+        ok_('size: 640x480' in html)
+        ok_('screenshot/1/variants/shot-thumbnail.png' in html)
+
+
 class ReleaseTest(TestCase):
     def test_unicode(self):
         """
@@ -134,11 +463,15 @@ class ReleaseTest(TestCase):
 
         with patch.object(models.Release, 'note_set') as note_set:
             release = models.Release()
-            note_set.order_by.return_value = [
+            notes = note_set.select_related.return_value.prefetch_related
+            notes.return_value.order_by.return_value = [
                 new_feature_2, new_feature_1, dot_fix, known_issue_1,
                 known_issue_2]
             new_features, known_issues = release.notes()
-            note_set.order_by.assert_called_with('-sort_num')
+            note_set.select_related.assert_called_once_with(
+                'fixed_in_release')
+            notes.assert_called_once_with('releases')
+            notes.return_value.order_by.assert_called_with('-sort_num')
 
         eq_(new_features, [dot_fix, new_feature_2, new_feature_1])
         eq_(known_issues, [known_issue_1, known_issue_2])
@@ -150,8 +483,110 @@ class ReleaseTest(TestCase):
         with patch.object(models.Release, 'note_set') as note_set:
             release = models.Release()
             release.notes(public_only=True)
-            note_set.order_by.return_value.filter.assert_called_with(
-                is_public=True)
+            notes = note_set.select_related.return_value.prefetch_related
+            notes.return_value.order_by.return_value.filter\
+                .assert_called_with(is_public=True)
+
+    @patch('rna.rna.models.Note.objects')
+    def test_note_diff(self, mock_objects):
+        """
+        Should return added, removed and modified note querysets
+        """
+        release = models.Release(id=1, created=datetime(2001, 1, 1))
+        other = models.Release(id=2, created=datetime(2001, 1, 2))
+        notes = mock_objects.all.return_value
+        added, removed, modified = release.note_diff(other)
+        notes.filter.assert_any_call(releases=other)
+        notes.filter.assert_any_call(releases=release)
+        eq_(added, notes.filter.return_value.exclude.return_value)
+        eq_(removed, notes.filter.return_value.exclude.return_value)
+        notes.filter.return_value.exclude.assert_any_call(releases=release)
+        notes.filter.return_value.exclude.assert_any_call(releases=other)
+        notes.filter.return_value.filter.return_value.filter.assert_called_once_with(
+            content_modified__gt=datetime(2001, 1, 2))
+        eq_(modified,
+            notes.filter.return_value.filter.return_value.filter.return_value)
+
+    @patch('rna.rna.models.Note.objects')
+    def test_note_diff_etag(self, mock_objects):
+        """
+        Should change when either release is modified
+        """
+        mock_objects.filter.return_value.aggregate.return_value = {
+            'latest': datetime(2001, 1, 1)}
+        release = models.Release(id=1, modified=datetime(2001, 1, 1))
+        other = models.Release(id=2, modified=datetime(2001, 1, 1))
+        etag = release.note_diff_etag(other)
+        mock_objects.filter.assert_called_with(releases__in=[1, 2])
+        ok_(etag.startswith('"'))
+        other.modified = datetime(2001, 1, 2)
+        ok_(release.note_diff_etag(other) != etag)
+
+    def test_is_released(self):
+        """
+        Should be True for public releases whose date has passed
+        """
+        past = datetime.now() - timedelta(days=1)
+        future = datetime.now() + timedelta(days=1)
+        eq_(models.Release(is_public=True, release_date=past).is_released(),
+            True)
+        eq_(models.Release(is_public=False,
+                           release_date=past).is_released(), False)
+        eq_(models.Release(is_public=True,
+                           release_date=future).is_released(), False)
+
+    @patch('rna.rna.models.Release.equivalent_desktop_release',
+           return_value=None)
+    @patch('rna.rna.models.Release.equivalent_android_release')
+    def test_page(self, mock_android, mock_desktop):
+        """
+        Should group the notes with their relations fetched along
+        """
+        new_feature = Mock(**{'is_known_issue_for.return_value': False})
+        known_issue = Mock(**{'is_known_issue_for.return_value': True})
+        with patch.object(models.Release, 'note_set') as note_set:
+            release = models.Release(product='Firefox', version='42.0')
+            notes = note_set.select_related.return_value.prefetch_related
+            notes.return_value.order_by.return_value.filter.return_value = [
+                known_issue, new_feature]
+            page = release.page(public_only=True)
+            note_set.select_related.assert_called_once_with(
+                'fixed_in_release')
+            notes.assert_called_once_with('releases')
+        eq_(page['release'], release)
+        eq_(page['new_features'], [new_feature])
+        eq_(page['known_issues'], [known_issue])
+        eq_(page['equivalent_android_release'], mock_android.return_value)
+        eq_(page['equivalent_desktop_release'], None)
+        eq_(page['bug_search_url'], release.get_bug_search_url())
+
+    @patch('rna.rna.models.Release.equivalent_desktop_release',
+           return_value=None)
+    @patch('rna.rna.models.Release.equivalent_android_release',
+           return_value=None)
+    def test_page_etag(self, mock_android, mock_desktop):
+        """
+        Should change when a note is removed or an equivalent changes
+        """
+        with patch.object(models.Release, 'note_set') as note_set:
+            note_set.aggregate.return_value = {
+                'latest': datetime(2001, 1, 1), 'count': 2}
+            release = models.Release(id=1, modified=datetime(2001, 1, 1))
+            etag = release.page_etag()
+            ok_(etag.startswith('"'))
+            eq_(release.page_etag(), etag)
+            ok_(release.page_etag(public_only=True) != etag)
+            note_set.aggregate.return_value = {
+                'latest': datetime(2001, 1, 1), 'count': 1}
+            ok_(release.page_etag() != etag)
+            etag = release.page_etag()
+            mock_android.return_value = models.Release(
+                id=2, modified=datetime(2001, 1, 1))
+            ok_(release.page_etag() != etag)
+            etag = release.page_etag()
+            mock_desktop.return_value = models.Release(
+                id=3, modified=datetime(2001, 1, 1))
+            ok_(release.page_etag() != etag)
 
     @override_settings(DEV=True)
     def test_equivalent_release_for_product_dev(self):
@@ -264,6 +699,31 @@ class ReleaseTest(TestCase):
         eq_(release.equivalent_release_for_product.called, 0)
 
 
+class ReleaseNoteDiffDBTest(ModelTablesMixin, TestCase):
+    def test_copied_release(self):
+        """
+        Should find no modified notes between a release and its fresh copy,
+        and find a note edited after the copy
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        notes = [models.Note.objects.create(note='Note %s' % i)
+                 for i in range(2)]
+        for note in notes:
+            note.releases.add(release)
+        copy, = utils.copy_releases([release])
+
+        added, removed, modified = release.note_diff(copy)
+        eq_(list(added), [])
+        eq_(list(removed), [])
+        eq_(list(modified), [])
+
+        notes[0].note = 'Edited'
+        notes[0].save()
+        eq_(list(release.note_diff(copy)[2]), [notes[0]])
+
+
 class ISO8601DateTimeFieldTest(TestCase):
     @patch('rna.rna.fields.parse_datetime')
     def test_strptime(self, mock_parse_datetime):
@@ -339,7 +799,7 @@ class TimestampedFilterBackendTest(TestCase):
         eq_(filter_class.Meta.model, TimeStampedModelSubclass)
         eq_(filter_class.Meta.fields,
             ['created_before', 'created_after', 'modified_before',
-             'modified_after', 'id', 'test'])
+             'modified_after', 'ids', 'id', 'test'])
         ok_(not mock_super_get_filter_class.called)
 
     @patch('rna.rna.filters.DjangoFilterBackend.get_filter_class')
@@ -356,11 +816,27 @@ class TimestampedFilterBackendTest(TestCase):
             mock_view, queryset=queryset)
         eq_(filter_class.Meta.model, TimeStampedModelSubclass)
         eq_(filter_class.Meta.fields,
-            ['created_after', 'modified_before', 'modified_after', 'test'])
+            ['created_after', 'modified_before', 'modified_after', 'ids',
+             'test'])
         eq_(mock_super_get_filter_class.called, 0)
 
+    @patch('rna.rna.models.Note.objects.all')
+    def test_queryset_not_evaluated(self, mock_all):
+        """
+        Should not run the queryset to build the filter set class
+        """
+        queryset = mock_all.return_value
+        queryset.model = models.Note
+        queryset.__nonzero__ = Mock(side_effect=AssertionError('evaluated'))
+        filter_class = filters.TimestampedFilterBackend().get_filter_class(
+            'view', queryset=queryset)
+        eq_(filter_class.Meta.model, models.Note)
+
 
 class RestClientTest(TestCase):
+    def setUp(self):
+        clients._breakers.clear()
+
     def test_init_kwargs(self):
         """
         Should set base_url and token attr from kwargs
@@ -386,10 +862,11 @@ class RestClientTest(TestCase):
         """
 
         rc = clients.RestClient(base_url='http://thedu.de')
-        mock_request.return_value = 'response'
+        mock_request.return_value = Mock(status_code=200)
         response = rc.request('get', '/abides')
-        mock_request.assert_called_once_with('get', 'http://thedu.de/abides')
-        eq_(response, 'response')
+        mock_request.assert_called_once_with(
+            'get', 'http://thedu.de/abides', timeout=(5, 30))
+        eq_(response, mock_request.return_value)
 
     @patch('rna.rna.clients.requests.request')
     def test_request_redundant_url(self, mock_request):
@@ -398,23 +875,25 @@ class RestClientTest(TestCase):
         """
 
         rc = clients.RestClient(base_url='http://thedu.de')
-        mock_request.return_value = Mock(content='{"aggression": "not stand"}')
+        mock_request.return_value = Mock(
+            content='{"aggression": "not stand"}', status_code=200)
         response = rc.request('get', 'http://thedu.de/abides')
         eq_(response.content, '{"aggression": "not stand"}')
-        mock_request.assert_called_once_with('get', 'http://thedu.de/abides')
+        mock_request.assert_called_once_with(
+            'get', 'http://thedu.de/abides', timeout=(5, 30))
 
     @patch('rna.rna.clients.requests.request')
     def test_request_token(self, mock_request):
         """
         Should set Authorization header to expected format
         """
-        mock_request.return_value = 'this aggression will not stand!'
+        mock_request.return_value = Mock(status_code=200)
         rc = clients.RestClient(base_url='http://thedu.de', token='midnight')
         response = rc.request('get', '')
         mock_request.assert_called_once_with(
             'get', 'http://thedu.de',
-            headers={'Authorization': 'Token midnight'})
-        eq_(response, 'this aggression will not stand!')
+            headers={'Authorization': 'Token midnight'}, timeout=(5, 30))
+        eq_(response, mock_request.return_value)
 
     @patch('rna.rna.clients.requests.request')
     def test_request_token_preserves_headers(self, mock_request):
@@ -423,14 +902,15 @@ class RestClientTest(TestCase):
         other headers
         """
 
-        mock_request.return_value = 'this aggression will not stand!'
+        mock_request.return_value = Mock(status_code=200)
         rc = clients.RestClient(base_url='http://thedu.de', token='midnight')
 
         response = rc.request('get', '', headers={'White': 'Russian'})
         mock_request.assert_called_once_with(
             'get', 'http://thedu.de',
-            headers={'Authorization': 'Token midnight', 'White': 'Russian'})
-        eq_(response, 'this aggression will not stand!')
+            headers={'Authorization': 'Token midnight', 'White': 'Russian'},
+            timeout=(5, 30))
+        eq_(response, mock_request.return_value)
 
     @patch('rna.rna.clients.requests.request')
     def test_request_delete(self, mock_request):
@@ -441,7 +921,7 @@ class RestClientTest(TestCase):
         mock_request.return_value = Mock(status_code=204)
         response = rc.request('delete', '/aggression')
         mock_request.assert_called_once_with(
-            'delete', 'http://th.is/aggression')
+            'delete', 'http://th.is/aggression', timeout=(5, 30))
         eq_(response.status_code, 204)
 
     @patch('rna.rna.clients.RestClient.request')
@@ -556,6 +1036,292 @@ class RestClientTest(TestCase):
             'put', '/larry', data={'world': 'of pain'})
         eq_(response.content, 'Is this your homework, Larry?')
 
+    @override_settings(RNA={'BASE_URL': 'http://thedu.de/', 'RETRIES': 3})
+    @patch('rna.rna.clients.time.sleep')
+    @patch('rna.rna.clients.requests.request')
+    def test_request_retries(self, mock_request, mock_sleep):
+        """
+        Should retry idempotent requests after connection errors and
+        retryable statuses, honoring Retry-After
+        """
+        ok = Mock(status_code=200)
+        mock_request.side_effect = [
+            clients.ConnectionError('reset'),
+            Mock(status_code=429, headers={'Retry-After': '7'}),
+            Mock(status_code=503, headers={}), ok]
+        rc = clients.RestClient()
+        eq_(rc.request('get', 'notes/'), ok)
+        eq_(mock_request.call_count, 4)
+        eq_(mock_sleep.call_count, 3)
+        eq_(mock_sleep.call_args_list[1], call(7.0))
+
+    @override_settings(RNA={'BASE_URL': 'http://thedu.de/', 'RETRIES': 3})
+    @patch('rna.rna.clients.time.sleep')
+    @patch('rna.rna.clients.requests.request')
+    def test_request_gives_up(self, mock_request, mock_sleep):
+        """
+        Should raise the last error once the retries are used up, and
+        not retry POSTs or waits longer than RETRY_MAX_DELAY
+        """
+        mock_request.side_effect = clients.Timeout('slow')
+        rc = clients.RestClient()
+        with self.assertRaises(clients.Timeout):
+            rc.request('get', 'notes/')
+        eq_(mock_request.call_count, 4)
+
+        mock_request.reset_mock()
+        mock_request.side_effect = None
+        mock_request.return_value = Mock(status_code=503, headers={})
+        eq_(rc.request('post', 'notes/').status_code, 503)
+        eq_(mock_request.call_count, 1)
+
+        clients._breakers.clear()
+        mock_request.reset_mock()
+        mock_request.return_value = Mock(
+            status_code=429, headers={'Retry-After': '3600'})
+        eq_(rc.request('get', 'notes/').status_code, 429)
+        eq_(mock_request.call_count, 1)
+
+    @override_settings(RNA={'BASE_URL': 'http://thedu.de/'})
+    @patch('rna.rna.clients.requests.request')
+    def test_request_deadline(self, mock_request):
+        """
+        Should cap timeouts to the time left and fail once it is up
+        """
+        mock_request.return_value = Mock(status_code=200)
+        rc = clients.RestClient()
+        with clients.deadline(2):
+            rc.request('get', 'notes/')
+        ok_(all(1 < t <= 2 for t in mock_request.call_args[1]['timeout']))
+        with clients.deadline(0):
+            with self.assertRaises(clients.DeadlineExceeded):
+                rc.request('get', 'notes/')
+        eq_(clients.time_left(), None)
+
+    @override_settings(RNA={'BASE_URL': 'http://thedu.de/',
+                            'CIRCUIT_BREAKER_THRESHOLD': 2, 'RETRIES': 0})
+    @patch('rna.rna.clients.requests.request')
+    def test_request_circuit_open(self, mock_request):
+        """
+        Should fail fast without a request after repeated failures
+        """
+        mock_request.return_value = Mock(status_code=500)
+        rc = clients.RestClient()
+        rc.request('get', 'notes/')
+        rc.request('get', 'notes/')
+        with self.assertRaises(clients.CircuitOpen):
+            rc.request('get', 'notes/')
+        eq_(mock_request.call_count, 2)
+
+    @override_settings(RNA={'BASE_URL': 'http://thedu.de/',
+                            'CIRCUIT_BREAKER_THRESHOLD': 2, 'RETRIES': 3})
+    @patch('rna.rna.clients.time.sleep')
+    @patch('rna.rna.clients.requests.request')
+    def test_request_retries_one_failure(self, mock_request, mock_sleep):
+        """
+        Should count a request whose retries all failed as one failure
+        """
+        mock_request.return_value = Mock(status_code=503, headers={})
+        rc = clients.RestClient()
+        rc.request('get', 'notes/')
+        eq_(mock_request.call_count, 4)
+        ok_(clients.get_breaker('http://thedu.de/').allow())
+        rc.request('get', 'notes/')
+        with self.assertRaises(clients.CircuitOpen):
+            rc.request('get', 'notes/')
+
+    @patch('rna.rna.clients.time.time')
+    def test_circuit_breaker(self, mock_time):
+        """
+        Should open after threshold failures, let one request through
+        after the reset timeout and close again on success
+        """
+        mock_time.return_value = 100
+        breaker = clients.CircuitBreaker(2, 30)
+        breaker.record(False)
+        ok_(breaker.allow())
+        breaker.record(False)
+        ok_(not breaker.allow())
+        mock_time.return_value = 130
+        ok_(breaker.allow())
+        ok_(not breaker.allow())
+        breaker.record(True)
+        ok_(breaker.allow())
+
+    def test_retry_after(self):
+        """
+        Should read Retry-After in seconds or as an HTTP date
+        """
+        eq_(clients.retry_after(Mock(headers={})), None)
+        eq_(clients.retry_after(Mock(headers={'Retry-After': '120'})), 120)
+        eq_(clients.retry_after(Mock(headers={
+            'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0)
+
+
+class HTTPCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = httpcache.DiskCache(self.directory + '/cache.db',
+                                         max_size=12)
+
+    def response(self, body='abide', status=200, **headers):
+        response = requests.Response()
+        response.url = 'http://thedu.de/'
+        response.status_code = status
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response._content = body
+        return response
+
+    @override_settings(RNA={'HTTP_CACHE_MAX_AGE': 60})
+    def test_round_trip(self):
+        """
+        Should store responses with their validators and freshness
+        """
+        self.cache.set('a', self.response(ETag='"1"'))
+        cached = self.cache.get('a')
+        ok_(cached.fresh)
+        eq_(cached.validators(), {'If-None-Match': '"1"'})
+        response = cached.response()
+        eq_((response.status_code, response.content, response.headers['etag']),
+            (200, 'abide', '"1"'))
+        self.cache.set('b', self.response(**{'Cache-Control': 'max-age=0'}))
+        ok_(not self.cache.get('b').fresh)
+        self.cache.set('c', self.response(**{'Cache-Control': 'no-store'}))
+        eq_(self.cache.get('c'), None)
+        self.cache.set('d', self.response(**{
+            'etag': '"4"', 'last-modified': 'Sun, 06 Nov 1994 08:49:37 GMT'}))
+        eq_(self.cache.get('d').validators(), {
+            'If-None-Match': '"4"',
+            'If-Modified-Since': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+
+    @override_settings(RNA={'HTTP_CACHE_MAX_AGE': 60})
+    def test_refresh(self):
+        """
+        Should make a stale response fresh after a 304
+        """
+        self.cache.set('a', self.response(
+            ETag='"1"', **{'Cache-Control': 'max-age=0'}))
+        cached = self.cache.refresh('a', self.response(
+            '', 304, ETag='"2"', **{'Cache-Control': 'max-age=60'}))
+        ok_(cached.fresh)
+        eq_(self.cache.get('a').validators(), {'If-None-Match': '"2"'})
+        eq_(self.cache.get('a').body, 'abide')
+
+    @override_settings(RNA={})
+    @patch('rna.rna.httpcache.time.time')
+    def test_evict(self, mock_time):
+        """
+        Should evict the least recently used responses beyond max_size
+        """
+        for i, key in enumerate('abc'):
+            mock_time.return_value = i
+            self.cache.set(key, self.response('1234'))
+        mock_time.return_value = 3
+        self.cache.get('a')
+        mock_time.return_value = 4
+        self.cache.set('d', self.response('1234'))
+        eq_([k for k in 'abcd' if self.cache.get(k)], ['a', 'c', 'd'])
+        eq_(self.cache.size(), 12)
+
+    @override_settings(RNA={})
+    @patch('rna.rna.httpcache.DiskCache.evict')
+    def test_evict_threshold(self, mock_evict):
+        """
+        Should only add up the sizes once enough has been written
+        """
+        cache = httpcache.DiskCache(self.cache.path, max_size=1000)
+        for key in 'ab':
+            cache.set(key, self.response('1234'))
+        eq_(mock_evict.call_count, 0)
+        cache.set('c', self.response('1234'))
+        eq_(mock_evict.call_count, 1)
+        cache.set('d', self.response('1234'))
+        eq_(mock_evict.call_count, 1)
+
+    @override_settings(RNA={'HTTP_CACHE_MAX_AGE': 60})
+    def test_processes(self):
+        """
+        Should share responses with other processes
+        """
+        self.cache.get('a')
+        pid = os.fork()
+        if not pid:
+            try:
+                httpcache.DiskCache(self.cache.path).set(
+                    'a', self.response('from the child'))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        eq_(self.cache.get('a').body, 'from the child')
+
+    @patch('rna.rna.clients.RestClient.request')
+    def test_fetch(self, mock_request):
+        """
+        Should answer from fresh responses, revalidate stale ones and
+        store new ones
+        """
+        cache = Mock()
+        rc = clients.RestClient(base_url='http://thedu.de/', http_cache=cache)
+        cache.get.return_value = Mock(fresh=True)
+        eq_(rc.fetch('get', 'notes/'), cache.get.return_value.response())
+        ok_(not mock_request.called)
+
+        cached = cache.get.return_value = Mock(fresh=False)
+        cached.validators.return_value = {'If-None-Match': '"1"'}
+        mock_request.return_value = Mock(status_code=304)
+        eq_(rc.fetch('get', 'notes/'),
+            cache.refresh.return_value.response.return_value)
+        mock_request.assert_called_once_with(
+            'get', 'notes/', headers={'If-None-Match': '"1"'})
+
+        cache.refresh.return_value = None
+        eq_(rc.fetch('get', 'notes/'), cached.response.return_value)
+        cached.revalidate.assert_called_once_with(mock_request.return_value)
+        cache.set.assert_called_once_with(
+            rc.http_cache_key('get', 'notes/'), cached.response.return_value)
+        cache.set.reset_mock()
+
+        cache.get.return_value = None
+        mock_request.return_value = Mock(status_code=200)
+        eq_(rc.fetch('get', 'notes/'), mock_request.return_value)
+        cache.set.assert_called_once_with(
+            rc.http_cache_key('get', 'notes/'), mock_request.return_value)
+
+
+class IterJSONListTest(TestCase):
+    def chunks(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_chunked(self):
+        """
+        Should decode the same items whatever the chunk boundaries
+        """
+        items = [1234, 'a, b] c', {'d': [1, {'e': None}]}, -5.5e3, True,
+                 u'caf\xe9']
+        text = json.dumps(items, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 3, 7, len(text)):
+            eq_(list(clients.iter_json_list(self.chunks(text, size))), items)
+        eq_(list(clients.iter_json_list(['  [ ', ' ]'])), [])
+
+    def test_not_a_list(self):
+        """
+        Should yield a document that is not a list whole
+        """
+        eq_(list(clients.iter_json_list(['{"detail"', ': "Not found"}'])),
+            [{'detail': 'Not found'}])
+
+    def test_truncated(self):
+        """
+        Should raise ValueError for a truncated or missing list
+        """
+        with self.assertRaises(ValueError):
+            list(clients.iter_json_list(['[{"a": 1}, {"b"']))
+        with self.assertRaises(ValueError):
+            list(clients.iter_json_list(['[1, 2']))
+        with self.assertRaises(ValueError):
+            list(clients.iter_json_list(['', ' ']))
+
 
 class RestModelClientTest(TestCase):
     @patch('rna.rna.clients.RestClient.__init__')
@@ -567,7 +1333,8 @@ class RestModelClientTest(TestCase):
             base_url='http://thedu.de', token='midnight', model_class='super')
         eq_(rc.model_class, 'super')
         mock_super_init.assert_called_once_with(
-            base_url='http://thedu.de', cache=None, token='midnight')
+            base_url='http://thedu.de', cache=None, token='midnight',
+            session=None, http_cache=None)
 
     @patch('rna.rna.clients.RestModelClient.serializer')
     @patch('rna.rna.clients.RestModelClient.restore')
@@ -587,6 +1354,60 @@ class RestModelClientTest(TestCase):
         mock_restore.assert_called_once_with(
             'mock serializer', data, False, False)
 
+    @patch('rna.rna.clients.RestModelClient.serializer')
+    @patch('rna.rna.clients.RestModelClient.restore')
+    @patch('rna.rna.clients.RestModelClient.request')
+    def test_iter_model(self, mock_request, mock_restore, mock_serializer):
+        """
+        Should stream the response and restore each object as it is read
+        """
+        response = mock_request.return_value
+        response.iter_content.return_value = ['[{"a": 1},', ' {"b": 2}]']
+        mock_serializer.return_value = 'mock serializer'
+        mock_restore.side_effect = lambda serializer, data, save, modified: (
+            data)
+        rc = clients.RestModelClient()
+        instances = rc.iter_model(model_class='super', save=True,
+                                  params={'ids': '1,2'})
+        eq_(next(instances), {'a': 1})
+        eq_(mock_restore.call_count, 1)
+        eq_(list(instances), [{'b': 2}])
+        mock_request.assert_called_once_with(
+            'get', '', stream=True, params={'ids': '1,2'})
+        ok_(response.close.called)
+
+    def error_response(self):
+        response = requests.Response()
+        response.status_code = 503
+        response.url = 'https://nucleus.mozilla.org/rna/notes/'
+        response._content = '<html>Service Unavailable</html>'
+        return response
+
+    @patch('rna.rna.clients.RestModelClient.restore')
+    @patch('rna.rna.clients.RestModelClient.get')
+    def test_model_error(self, mock_get, mock_restore):
+        """
+        Should raise HTTPError for an error response rather than restore
+        its body
+        """
+        mock_get.return_value = self.error_response()
+        with self.assertRaises(requests.HTTPError):
+            clients.RestModelClient().model(model_class=models.Note)
+        eq_(mock_restore.called, False)
+
+    @patch('rna.rna.clients.RestModelClient.restore')
+    @patch('rna.rna.clients.RestModelClient.request')
+    def test_iter_model_error(self, mock_request, mock_restore):
+        """
+        Should raise HTTPError for an error response and close it
+        """
+        response = mock_request.return_value = self.error_response()
+        response.close = Mock()
+        with self.assertRaises(requests.HTTPError):
+            list(clients.RestModelClient().iter_model(model_class=models.Note))
+        eq_(mock_restore.called, False)
+        ok_(response.close.called)
+
     @patch('rna.rna.clients.RestModelClient.serializer')
     @patch('rna.rna.clients.RestModelClient.restore')
     @patch('rna.rna.clients.RestModelClient.get')
@@ -608,50 +1429,42 @@ class RestModelClientTest(TestCase):
     @patch('rna.rna.clients.RestModelClient.hypermodel')
     def test_restore(self, mock_hypermodel):
         """
-        Should return instance from serializer.restore_object
-        Should remove url field from data
-        Should use hypermodel method on FK and M2M fields
+        Should restore an unsaved instance from the data, without the url
+        and fields unknown to the model, parsing datetimes and using the
+        hypermodel method on FK and M2M fields
         """
-        mock_fk_field = Mock(spec=models.models.ForeignKey)
-        mock_fk_field.name = 'fk'
-        mock_fk_field.rel = Mock(to='to')
-
-        mock_fk_field_not_in_data = Mock(spec=models.models.ForeignKey)
-        mock_fk_field_not_in_data.name = 'no data'
-        mock_fk_field_not_in_data.rel = Mock(to='to')
-
-        mock_m2m_field = Mock(spec=models.models.ManyToManyField)
-        mock_m2m_field.name = 'm2m'
-        mock_m2m_field.rel = Mock(to='to2')
-
+        releases = dict((url, models.Release(id=i)) for i, url in enumerate(
+            ['http://thedu.de/3/', 'http://example.com/1/',
+             'http://example.com/2/'], 3))
+        mock_hypermodel.side_effect = lambda url, model, save: releases[url]
         mock_serializer = Mock()
-        mock_serializer.Meta.model._meta.fields = [
-            mock_fk_field,
-            'non_fk_field',
-            mock_fk_field_not_in_data
-        ]
-        mock_serializer.Meta.model._meta.many_to_many = [mock_m2m_field]
-
+        mock_serializer.Meta.model = models.Note
         data = {
             'url': 'http://remove.me',
-            'fk': 'http://thedu.de',
-            'm2m': ['http://example.com/foo', 'http://example.com/bar'],
+            'id': 7,
+            'note': 'abides',
+            'fixed_in_release': 'http://thedu.de/3/',
+            'releases': ['http://example.com/1/', 'http://example.com/2/'],
+            'created': '2013-10-22T22:29:03.718815',
+            'modified': '2013-10-22T22:29:04',
+            'read_only_extra': 'remove me',
         }
         rc = clients.RestModelClient()
         instance = rc.restore(mock_serializer, data)
 
-        eq_(instance, mock_serializer.restore_object.return_value)
-
-        mock_hypermodel.assert_any_call('http://thedu.de', 'to', False)
-        mock_hypermodel.assert_any_call('http://example.com/foo', 'to2', False)
-        mock_hypermodel.assert_any_call('http://example.com/bar', 'to2', False)
-
-        hyper_return = mock_hypermodel.return_value
-        mock_serializer.restore_object.assert_called_with({
-            'fk': hyper_return,
-            'm2m': [hyper_return, hyper_return],
-            'no data': hyper_return,
-        })
+        ok_(isinstance(instance, models.Note))
+        eq_((instance.id, instance.note), (7, 'abides'))
+        eq_(instance.fixed_in_release_id, 3)
+        eq_(instance.fixed_in_release, releases['http://thedu.de/3/'])
+        eq_(instance.created, datetime(2013, 10, 22, 22, 29, 3, 718815))
+        eq_(instance.modified, datetime(2013, 10, 22, 22, 29, 4))
+        ok_(instance.is_public)
+        eq_(instance._m2m_data, {'releases': [
+            releases['http://example.com/1/'],
+            releases['http://example.com/2/']]})
+        mock_hypermodel.assert_any_call(
+            'http://example.com/1/', models.Release, False)
+        ok_(not hasattr(instance, 'read_only_extra'))
         eq_(mock_serializer.save_object.called, 0)
 
     @patch('rna.rna.clients.RestModelClient.hypermodel')
@@ -660,14 +1473,13 @@ class RestModelClientTest(TestCase):
         Should pass instance to serializer.save_object
         """
         mock_serializer = Mock()
-        mock_serializer.Meta.model._meta.fields = []
-        mock_serializer.Meta.model._meta.many_to_many = []
+        mock_serializer.Meta.model = models.Release
 
         rc = clients.RestModelClient()
         instance = rc.restore(mock_serializer, {}, save=True, modified=True)
-        eq_(instance, mock_serializer.restore_object.return_value)
-        mock_serializer.restore_object.assert_called_once_with({})
-        mock_serializer.save_object.assert_called_once_with(instance, modified=True)
+        ok_(isinstance(instance, models.Release))
+        mock_serializer.save_object.assert_called_once_with(
+            instance, modified=True)
         eq_(mock_hypermodel.called, 0)
 
     @patch('rna.rna.clients.RestModelClient.serialize')
@@ -717,18 +1529,69 @@ class RestModelClientTest(TestCase):
         model_client = rc.model_client(model_class='amateur')
         ok_(isinstance(model_client, clients.RestModelClient))
         eq_(model_client.model_class, 'amateur')
-        eq_(rc.model_map['amateur'], model_client)
+        eq_(rc.model_client(model_class='amateur'), model_client)
+        eq_(rc.model_map, {})
 
+    @patch.dict(clients.RestModelClient.model_map, {'the_dude': 'abides'})
     @patch('rna.rna.clients.RestModelClient.get',
            return_value=Mock(json=lambda: {'the_dude': 'http://abid.es'}))
     def test_model_client_url_name(self, mock_get):
         rc = clients.RestModelClient()
-        rc.model_map['the_dude'] = 'abides'
         model_client = rc.model_client(url_name='the_dude')
         eq_(model_client.base_url, 'http://abid.es')
         eq_(model_client.model_class, 'abides')
-        eq_(rc.model_map['abides'], model_client)
-        mock_get.assert_called_once_with()
+        eq_(rc.model_client(model_class='abides', base_url='http://abid.es'),
+            model_client)
+        mock_get.assert_called_with()
+
+    def test_model_client_configuration(self):
+        """
+        Should share clients by configuration, not only by model
+        """
+        rc = clients.RestModelClient(token='midnight')
+        model_client = rc.model_client(model_class='abides',
+                                       base_url='http://abid.es/')
+        eq_(model_client.token, 'midnight')
+        ok_(rc.model_client(model_class='abides', base_url='http://thedu.de/')
+            is not model_client)
+        ok_(rc.model_client(model_class='abides', base_url='http://abid.es/',
+                            token='bowling') is not model_client)
+        ok_(clients.RestModelClient(token='midnight').model_client(
+            model_class='abides', base_url='http://abid.es/') is model_client)
+
+        def cached_client():
+            # a new session and HTTP cache for each parent
+            return clients.RestModelClient(
+                token='midnight', session=requests.Session(),
+                http_cache=httpcache.DiskCache('/tmp/cache.db')).model_client(
+                model_class='abides', base_url='http://abid.es/')
+
+        ok_(cached_client() is not model_client)
+        ok_(cached_client() is cached_client())
+
+    def test_clear_caches(self):
+        """
+        Should empty the response caches of the shared clients
+        """
+        model_client = clients.RestModelClient().model_client(
+            model_class='abides')
+        model_client.cache['http://abid.es/'] = 'response'
+        clients.clear_caches()
+        eq_(model_client.cache, {})
+
+    def test_model_client_threads(self):
+        """
+        Should give threads asking at the same time the same client
+        """
+        rc = clients.RestModelClient()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            rc.model_client(model_class='threaded'))) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(set(map(id, results))), 1)
 
     @patch('rna.rna.serializers.get_client_serializer_class')
     def test_serializer(self, mock_get_client_serializer_class):
@@ -768,6 +1631,62 @@ class RestModelClientTest(TestCase):
             token='midnight')
         mock_model.assert_called_once_with(url='42/', save=False)
 
+    def test_hypermodel_embedded_exists(self):
+        """
+        Should look up an object embedded with ?expand= by its id
+        """
+        mock_model_class = Mock()
+        mock_model_class.objects.get.return_value.modified = datetime(
+            2014, 1, 1)
+
+        rc = clients.RestModelClient()
+        instance = rc.hypermodel({'id': 42, 'url': 'http://the.answ.er/42/',
+                                  'modified': '2014-01-01T00:00:00'},
+                                 mock_model_class, False)
+        eq_(instance, mock_model_class.objects.get.return_value)
+        mock_model_class.objects.get.assert_called_once_with(pk=42)
+
+    @patch('rna.rna.clients.RestModelClient.restore',
+           return_value='what was the question?')
+    @patch('rna.rna.clients.RestModelClient.serializer')
+    def test_hypermodel_embedded_newer(self, mock_serializer, mock_restore):
+        """
+        Should restore an object embedded with ?expand= that was modified
+        since the one in the database
+        """
+        mock_model_class = Mock()
+        mock_model_class.objects.get.return_value.modified = datetime(
+            2014, 1, 1)
+        data = {'id': 42, 'url': 'http://the.answ.er/42/',
+                'modified': '2014-01-02T00:00:00'}
+
+        rc = clients.RestModelClient()
+        eq_(rc.hypermodel(data, mock_model_class, True),
+            'what was the question?')
+        mock_restore.assert_called_once_with(
+            mock_serializer.return_value, data, save=True)
+
+    @patch('rna.rna.clients.RestModelClient.restore',
+           return_value='what was the question?')
+    @patch('rna.rna.clients.RestModelClient.serializer')
+    def test_hypermodel_embedded_does_not_exist(self, mock_serializer,
+                                                mock_restore):
+        """
+        Should restore an object embedded with ?expand= without a request
+        """
+        mock_model_class = Mock()
+        mock_model_class.objects.get.side_effect = ObjectDoesNotExist
+        data = {'id': 42, 'url': 'http://the.answ.er/42/'}
+
+        rc = clients.RestModelClient()
+        rc.request = Mock()
+        eq_(rc.hypermodel(data, mock_model_class, True),
+            'what was the question?')
+        mock_serializer.assert_called_once_with(mock_model_class)
+        mock_restore.assert_called_once_with(
+            mock_serializer.return_value, data, save=True)
+        eq_(rc.request.called, False)
+
     def test_hypermodel_url_none(self):
         """
         Should return None when url is None without querying
@@ -808,6 +1727,192 @@ class RNASyncCommandTest(TestCase):
         eq_(params, {mock_model: {'modified_after': mock_isoformat()}})
         latest.assert_called_once_with('modified')
 
+    @patch('rna.rna.management.commands.rnasync.models')
+    def test_apply_tombstones(self, mock_models):
+        """
+        Should delete in bulk by kind and store the tombstones unmodified
+        """
+        mock_models.Tombstone.KINDS = models.Tombstone.KINDS
+        mock_models.Note._meta.module_name = 'note'
+        mock_models.Release._meta.module_name = 'release'
+        tombstones = [
+            models.Tombstone(id=1, kind='note', object_id=3),
+            models.Tombstone(id=2, kind='release', object_id=4),
+            models.Tombstone(id=3, kind='note_releases', object_id=5,
+                             related_id=6)]
+
+        rnasync.Command().apply_tombstones(tombstones)
+
+        mock_models.Note.objects.filter.assert_called_once_with(pk__in=[3])
+        mock_models.Release.objects.filter.assert_called_once_with(pk__in=[4])
+        through = mock_models.Note.releases.through
+        eq_(through.objects.filter.call_count, 1)
+        ok_(through.objects.filter.return_value.delete.called)
+        mock_models.Tombstone.objects.filter.assert_called_once_with(
+            pk__in=[1, 2, 3])
+        mock_models.Tombstone.objects.bulk_create.assert_called_once_with(
+            tombstones, modified=False)
+
+    @patch('rna.rna.management.commands.rnasync.models.Change.objects')
+    def test_sync_changes(self, mock_changes):
+        """
+        Should page through the feed from the latest local change
+        """
+        mock_changes.aggregate.return_value = {'latest': 3}
+        rc = Mock()
+        rc.get.return_value.json.side_effect = [
+            {'results': [{'id': 4}], 'next': 'next', 'last_seq': 4},
+            {'results': [], 'next': None, 'last_seq': 4}]
+        command = rnasync.Command()
+        command.apply_changes = Mock()
+        eq_(command.sync_changes(rc), 1)
+        eq_(rc.get.call_args_list, [
+            call('changes/', params={'since': 3}),
+            call('changes/', params={'since': 4})])
+        command.apply_changes.assert_called_once_with(rc, [{'id': 4}])
+
+    @patch('rna.rna.management.commands.rnasync.models')
+    def test_apply_changes(self, mock_models):
+        """
+        Should apply the last action of each object, fetching saved
+        objects by id, and store the changes
+        """
+        mock_models.Change = Mock(ACTIONS=models.Change.ACTIONS)
+        mock_models.Note._meta.module_name = 'note'
+        mock_models.Release._meta.module_name = 'release'
+        changes = [
+            {'id': 1, 'kind': 'note', 'action': 'save', 'object_id': 3,
+             'related_id': None, 'created': '2014-01-01T00:00:00'},
+            {'id': 2, 'kind': 'release', 'action': 'save', 'object_id': 4,
+             'related_id': None, 'created': '2014-01-01T00:00:00'},
+            {'id': 3, 'kind': 'note', 'action': 'delete', 'object_id': 3,
+             'related_id': None, 'created': '2014-01-01T00:00:00'}]
+        rc = Mock()
+
+        rnasync.Command().apply_changes(rc, changes)
+
+        mock_models.Note.objects.filter.assert_called_once_with(pk__in=[3])
+        eq_(rc.model_client.call_args_list,
+            [call('releases'), call('notes')])
+        rc.model_client.return_value.model.assert_called_once_with(
+            save=True, params={'ids': '4'})
+        mock_models.Change.objects.filter.assert_called_once_with(
+            pk__in=[1, 2, 3])
+        eq_(len(mock_models.Change.objects.bulk_create.call_args[0][0]), 3)
+
+    @override_settings(RNA={'SYNC_DEADLINE': 60})
+    @patch('rna.rna.management.commands.rnasync.clients.deadline')
+    def test_sync_deadline(self, mock_deadline):
+        """
+        Should make the requests of a sync under its deadline
+        """
+        command = rnasync.Command()
+        command.sync_modified = Mock(return_value=3)
+        eq_(command.sync('rc'), 3)
+        mock_deadline.assert_called_once_with(60)
+        command.deadline = 5
+        command.sync('rc')
+        mock_deadline.assert_called_with(5)
+
+    def test_next_interval(self):
+        """
+        Should poll at the minimum interval after changes and back off
+        up to the maximum while idle
+        """
+        command = rnasync.Command()
+        eq_(command.next_interval(40, 3, 5, 60), 5)
+        eq_(command.next_interval(5, 0, 5, 60), 10)
+        eq_(command.next_interval(40, 0, 5, 60), 60)
+
+    def test_backoff(self):
+        """
+        Should wait between half and all of an exponential delay, capped
+        """
+        command = rnasync.Command()
+        for i in range(20):
+            ok_(10 <= command.backoff(1, 10, 300) <= 20)
+            ok_(150 <= command.backoff(10, 10, 300) <= 300)
+
+    @patch('rna.rna.management.commands.rnasync.clients.clear_caches')
+    @patch('rna.rna.management.commands.rnasync.signal.signal')
+    @patch('rna.rna.management.commands.rnasync.threading.Event')
+    @patch('rna.rna.management.commands.rnasync.mail_admins')
+    @patch('rna.rna.management.commands.rnasync.connection')
+    @patch('rna.rna.management.commands.rnasync.transaction')
+    def test_daemon(self, mock_transaction, mock_connection, mock_mail_admins,
+                    mock_event, mock_signal, mock_clear_caches):
+        """
+        Should sync until stopped with emptied response caches, polling
+        faster after changes, backing off after failures, mailing admins
+        once per run of failures and restoring the signal handlers
+        """
+        rc = Mock()
+        stop = mock_event.return_value
+        stop.is_set.side_effect = [False] * 5 + [True]
+        command = rnasync.Command()
+        down = rnasync.RequestException('down')
+        command.sync = Mock(side_effect=[3, 0, down, down, 0])
+        command.backoff = Mock(return_value=7)
+
+        command.daemon(rc, {'min_interval': 5, 'max_interval': 60,
+                            'changes': True})
+
+        eq_(command.sync.call_args_list, [call(rc, True)] * 5)
+        eq_(rc.cache.clear.call_count, 5)
+        eq_(mock_clear_caches.call_count, 5)
+        eq_([c[0][0] for c in stop.wait.call_args_list], [5, 10, 7, 7, 20])
+        eq_(command.backoff.call_args_list,
+            [call(1, 5, 60), call(2, 5, 60)])
+        eq_(mock_mail_admins.call_count, 1)
+        eq_(mock_connection.close.call_count, 2)
+        eq_(mock_transaction.commit_unless_managed.call_count, 3)
+        eq_(mock_signal.call_count, 4)
+
+
+class RNACompactCommandTest(TestCase):
+    @override_settings(RNA={'TOMBSTONE_RETENTION_DAYS': 7})
+    @patch('rna.rna.management.commands.rnacompact.models.Change.objects')
+    @patch('rna.rna.management.commands.rnacompact.models.Tombstone.objects')
+    def test_handle(self, mock_tombstones, mock_changes):
+        """
+        Should compact tombstones older than the retention period and
+        superseded changes
+        """
+        mock_tombstones.compact.return_value = 42
+        mock_changes.compact.return_value = 7
+        command = rnacompact.Command()
+        command.stdout = Mock()
+        command.handle(days=None)
+        before = mock_tombstones.compact.call_args[0][0]
+        ok_(timedelta(days=7) <= datetime.now() - before < timedelta(days=8))
+        mock_changes.compact.assert_called_once_with()
+        eq_(command.stdout.write.call_args_list, [
+            call('Deleted 42 tombstones\n'),
+            call('Deleted 7 superseded changes\n')])
+
+
+class RNAImagesCommandTest(TestCase):
+    @patch('rna.rna.management.commands.rnaimages.images')
+    @patch('rna.rna.management.commands.rnaimages.models.Note.objects')
+    def test_handle(self, mock_objects, mock_images):
+        """
+        Should store the dimensions of images without stamping modified or
+        recording changes, and generate their variants
+        """
+        note = Mock(pk=1, id=1)
+        note.image.width, note.image.height = 640, 480
+        notes = mock_objects.exclude.return_value.order_by.return_value.only\
+            .return_value.filter.return_value
+        notes.filter.return_value.__getitem__ = Mock(side_effect=[[note], []])
+        command = rnaimages.Command()
+        command.stdout = Mock()
+        command.handle(all=False, batch_size=100)
+        mock_objects.filter.assert_called_once_with(pk=1)
+        mock_objects.filter.return_value.update.assert_called_once_with(
+            image_width=640, image_height=480, modified=False, record=False)
+        mock_images.generate_variants.assert_called_once_with(note.image)
+        command.stdout.write.assert_called_once_with('1 images\n')
+
 
 class GetClientSerializerClassTest(TestCase):
     def test_get_client_serializer_class(self):
@@ -857,55 +1962,1551 @@ class UnmodifiedTimestampSerializerTest(TestCase):
             'the dude', modified=False)
 
 
+def fake_reverse(view_name, kwargs=None, request=None, format=None):
+    return 'http://testserver/%ss/%s/' % (view_name.split('-')[0],
+                                          kwargs['pk'])
+
+
+class ValuesListSerializerTest(TestCase):
+    def queryset(self, model, rows):
+        queryset = Mock(model=model)
+        queryset.values.return_value.iterator.return_value = iter(rows)
+        return queryset
+
+    @patch('rna.rna.serializers.reverse', fake_reverse)
+    @patch('rest_framework.relations.reverse', fake_reverse)
+    def test_same_as_serializer(self):
+        """
+        Should render the same JSON as the serializer does for instances
+        """
+        class ReleaseSerializer(
+                serializers.HyperlinkedModelSerializerWithPkField):
+            class Meta:
+                model = models.Release
+
+        rows = [{'id': id, 'created': datetime(2014, 1, 2, 3, 4, 5, 678901),
+                 'modified': datetime(2014, 1, 2, 3, 4, 5, 678901),
+                 'product': 'Firefox', 'channel': 'Release',
+                 'version': '%s.0' % id, 'release_date': datetime(2014, 1, 2),
+                 'text': u'caf\xe9', 'is_public': True, 'bug_list': '',
+                 'bug_search_url': '', 'system_requirements': ''}
+                for id in (1, 2)]
+        context = {'request': RequestFactory().get('/releases/')}
+        expected = ReleaseSerializer(
+            [models.Release(**row) for row in rows], many=True,
+            context=context).data
+        data = serializers.ValuesListSerializer(
+            ReleaseSerializer(context=context),
+            self.queryset(models.Release, [dict(row) for row in rows])).data
+        eq_(JSONRenderer().render(data), JSONRenderer().render(expected))
+        eq_(data[1]['url'], 'http://testserver/releases/2/')
+
+    @patch('rna.rna.serializers.reverse', fake_reverse)
+    @patch('rna.rna.models.Note.releases.through.objects')
+    def test_hyperlinks(self, mock_objects):
+        """
+        Should fill in hyperlinks and query the many-to-many links once
+        """
+        links = mock_objects.filter.return_value.order_by.return_value
+        links.values_list.return_value = [(1, 3), (1, 2), (2, 3)]
+        rows = [{'id': 1, 'created': None, 'modified': None, 'bug': None,
+                 'note': '', 'is_known_issue': False,
+                 'fixed_in_release_id': 4, 'tag': '', 'sort_num': 0,
+                 'is_public': True, 'image': 'screenshot/1/shot.png',
+                 'image_width': None, 'image_height': None,
+                 'content_modified': None},
+                {'id': 2, 'created': None, 'modified': None, 'bug': None,
+                 'note': '', 'is_known_issue': False,
+                 'fixed_in_release_id': None, 'tag': '', 'sort_num': 0,
+                 'is_public': True, 'image': '', 'image_width': None,
+                 'image_height': None, 'content_modified': None}]
+        context = {'request': RequestFactory().get('/notes/')}
+        data = serializers.ValuesListSerializer(
+            serializers.NoteSerializer(context=context),
+            self.queryset(models.Note, rows)).data
+        eq_(data[0]['url'], 'http://testserver/notes/1/')
+        eq_(data[0]['releases'], ['http://testserver/releases/3/',
+                                  'http://testserver/releases/2/'])
+        eq_(data[0]['fixed_in_release'], 'http://testserver/releases/4/')
+        eq_(data[0]['image_variants'],
+            images.variant_urls(models.Note(image='screenshot/1/shot.png',
+                                            image_width=640,
+                                            image_height=480).image))
+        eq_(data[1]['releases'], ['http://testserver/releases/3/'])
+        eq_(data[1]['fixed_in_release'], None)
+        eq_(data[1]['image_variants'], {})
+        mock_objects.filter.assert_called_once_with(note__in=[1, 2])
+        mock_objects.filter.return_value.order_by.assert_called_once_with(
+            'release__product', '-release__version', 'release__channel')
+
+    def test_unsupported_field(self):
+        """
+        Should refuse a serializer with a field it can't reproduce
+        """
+        class NoteSerializer(serializers.NoteSerializer):
+            summary = drf_serializers.SerializerMethodField('get_summary')
+
+        try:
+            serializers.ValuesListSerializer(
+                NoteSerializer(context={}), self.queryset(models.Note, []))
+        except serializers.UnsupportedField:
+            pass
+        else:
+            ok_(False, 'UnsupportedField not raised')
+
+
+class ValuesListMixinTest(TestCase):
+    @patch('rna.rna.views.ModelViewSet.list', return_value='paginated')
+    def test_paginated(self, mock_list):
+        """
+        Should leave paginated lists to the serializer
+        """
+        view = views.NoteViewSet(paginate_by=10)
+        eq_(view.list('request'), 'paginated')
+        mock_list.assert_called_once_with('request')
+
+    @patch('rna.rna.views.serializers.ValuesListSerializer')
+    @patch('rna.rna.views.NoteViewSet.filter_queryset')
+    def test_list(self, mock_filter_queryset, mock_serializer):
+        """
+        Should list the filtered queryset with ValuesListSerializer
+        """
+        mock_filter_queryset.return_value = models.Note.objects.all()
+        mock_serializer.return_value.data = ['abides']
+        view = views.NoteViewSet(request=None, format_kwarg=None)
+        eq_(view.list('request').data, ['abides'])
+
+
+class ExpandMixinTest(TestCase):
+    def view(self, expand, method='GET', viewset=views.NoteViewSet):
+        view = viewset()
+        view.request = Mock(method=method, QUERY_PARAMS={'expand': expand})
+        return view
+
+    def test_get_expand(self):
+        """
+        Should parse the paths into a tree of relations
+        """
+        eq_(self.view('releases,fixed_in_release,releases.notes')
+            .get_expand(),
+            {'releases': {'notes': {}}, 'fixed_in_release': {}})
+        eq_(self.view('notes', viewset=views.ReleaseViewSet).get_expand(),
+            {'notes': {}})
+        eq_(self.view('').get_expand(), {})
+        eq_(self.view('releases', method='PUT').get_expand(), {})
+
+    def test_get_expand_invalid(self):
+        """
+        Should refuse unknown relations and paths that are too deep
+        """
+        for expand in ('bogus', 'notes', 'releases.bogus',
+                       'releases.notes.releases'):
+            try:
+                self.view(expand).get_expand()
+            except views.ParseError:
+                pass
+            else:
+                ok_(False, 'ParseError not raised for %s' % expand)
+
+    def test_expand_lookups(self):
+        """
+        Should prefetch the expanded relations and those they link to
+        """
+        eq_(views.expand_lookups(models.Release, {'notes': {'releases': {}}}),
+            ['note_set', 'note_set__fixed_in_release', 'note_set__releases'])
+        eq_(views.expand_lookups(models.Note, {'releases': {}}),
+            ['fixed_in_release', 'releases'])
+
+    def test_expanded_serializer_class(self):
+        """
+        Should nest the serializers of the expanded relations
+        """
+        serializer_class = views.expanded_serializer_class(
+            models.Release, drf_serializers.ModelSerializer,
+            {'notes': {'fixed_in_release': {}}})
+        notes = serializer_class.base_fields['notes']
+        ok_(isinstance(notes, serializers.NoteSerializer))
+        eq_((notes.source, notes.many, notes.read_only),
+            ('note_set', True, True))
+        fixed_in_release = notes.base_fields['fixed_in_release']
+        eq_(fixed_in_release.Meta.model, models.Release)
+        eq_(fixed_in_release.many, False)
+
+    @override_settings(RNA={'EXPAND_MAX_OBJECTS': 10})
+    @patch('rna.rna.views.NoteViewSet.filter_queryset')
+    def test_list_too_many(self, mock_filter_queryset):
+        """
+        Should refuse to expand lists that are too long
+        """
+        mock_filter_queryset.return_value.count.return_value = 11
+        view = self.view('releases')
+        try:
+            view.list(view.request)
+        except views.ParseError:
+            pass
+        else:
+            ok_(False, 'ParseError not raised')
+
+    @override_settings(RNA={'EXPAND_MAX_OBJECTS': 10})
+    @patch('rna.rna.views.ReleaseViewSet.filter_queryset')
+    def test_retrieve_too_many(self, mock_filter_queryset):
+        """
+        Should refuse to expand more related objects than the limit
+        """
+        queryset = mock_filter_queryset.return_value.filter.return_value
+        queryset.count.return_value = 1
+        queryset.aggregate.side_effect = [{'count': 6}, {'count': 4}]
+        view = self.view('notes.releases', viewset=views.ReleaseViewSet)
+        view.kwargs = {'pk': '1'}
+        try:
+            view.retrieve(view.request)
+        except views.ParseError:
+            pass
+        else:
+            ok_(False, 'ParseError not raised')
+        mock_filter_queryset.return_value.filter.assert_called_once_with(
+            pk='1')
+        eq_(queryset.aggregate.call_count, 2)
+
+    def test_expand_paths(self):
+        """
+        Should list the lookup of every expanded relation
+        """
+        eq_(views.expand_paths(models.Release, {'notes': {'releases': {}}}),
+            ['note', 'note__releases'])
+        eq_(views.expand_paths(models.Note, {'releases': {},
+                                             'fixed_in_release': {}}),
+            ['fixed_in_release', 'releases'])
+
+
+class ReleaseDiffViewTest(TestCase):
+    @patch('rna.rna.views.get_object_or_404')
+    def test_not_modified(self, mock_get_object_or_404):
+        """
+        Should return 304 without computing the diff when the ETag matches
+        """
+        release = mock_get_object_or_404.return_value
+        release.note_diff_etag.return_value = '"abides"'
+        request = Mock(META={'HTTP_IF_NONE_MATCH': '"abides"'})
+        response = views.ReleaseDiffView().get(request, pk=1, other_pk=2)
+        eq_(response.status_code, 304)
+        eq_(response['ETag'], '"abides"')
+        eq_(release.note_diff.called, False)
+
+
+class QueryCountTest(ModelTablesMixin, TestCase):
+    """
+    The number of queries of the list and nested views doesn't grow with
+    the number of notes.
+    """
+    urls = 'rna.rna.urls'
+
+    def setUp(self):
+        super(QueryCountTest, self).setUp()
+        notes = [models.Note.objects.create(
+            note='Note %s' % i, is_known_issue=i % 2 == 0) for i in range(10)]
+        self.release, self.other = [models.Release.objects.create(
+            product='Firefox', channel='Release', version=version,
+            release_date=datetime(2015, 11, 3)) for version in ('42.0', '43.0')]
+        for note in notes:
+            note.releases.add(self.release, self.other)
+        for note in notes[:2]:
+            note.save()
+        models.Note.objects.update(fixed_in_release=self.other)
+
+    def get(self, view, path, **kwargs):
+        # the test client's request_started resets the queries
+        response = view(RequestFactory().get(path), **kwargs)
+        return response.render().data
+
+    def test_note_list(self):
+        """
+        Should list notes and their release links in two queries
+        """
+        view = views.NoteViewSet.as_view({'get': 'list'})
+        with profiling.max_queries(2, '/notes/'):
+            data = self.get(view, '/notes/')
+        eq_(len(data), 10)
+
+    def test_release_list(self):
+        """
+        Should list releases in one query
+        """
+        view = views.ReleaseViewSet.as_view({'get': 'list'})
+        with profiling.max_queries(1, '/releases/'):
+            data = self.get(view, '/releases/')
+        eq_(len(data), 2)
+
+    def test_nested_notes(self):
+        """
+        Should fetch a release's notes with their releases
+        """
+        view = views.NestedNoteView.as_view()
+        with profiling.max_queries(3, 'NestedNoteView'):
+            data = self.get(view, '/releases/1/notes/', pk=self.release.pk)
+        eq_(len(data), 10)
+
+    def test_release_diff(self):
+        """
+        Should fetch the releases of the notes of each set along
+        """
+        view = views.ReleaseDiffView.as_view()
+        with profiling.max_queries(9, 'ReleaseDiffView'):
+            data = self.get(view, '/releases/1/diff/2/', pk=self.release.pk,
+                            other_pk=self.other.pk)
+        eq_(len(data['modified']), 2)
+
+    def test_release_notes(self):
+        """
+        Should fetch the fixed_in_release and releases of the notes
+        """
+        with profiling.max_queries(2, 'Release.notes'):
+            new_features, known_issues = self.release.notes()
+            for note in new_features + known_issues:
+                list(note.releases.all())
+                note.fixed_in_release
+        eq_(len(new_features + known_issues), 10)
+
+
+class ExpandSizeDBTest(ModelTablesMixin, TestCase):
+    urls = 'rna.rna.urls'
+
+    def setUp(self):
+        super(ExpandSizeDBTest, self).setUp()
+        releases = [models.Release.objects.create(
+            product='Firefox', channel='Release', version=version,
+            release_date=datetime(2015, 11, 3)) for version in ('42.0', '43.0')]
+        for i in range(10):
+            models.Note.objects.create(note='Note %s' % i).releases.add(
+                *releases)
+
+    def get(self, **initkwargs):
+        view = views.NoteViewSet.as_view({'get': 'list'}, **initkwargs)
+        request = RequestFactory().get('/notes/', {'expand': 'releases'})
+        return view(request).render()
+
+    @override_settings(RNA={'EXPAND_MAX_OBJECTS': 10})
+    def test_per_page(self):
+        """
+        Should count the objects of a page and those expanded in them,
+        rather than those of the whole list
+        """
+        eq_(self.get().status_code, 400)
+        response = self.get(paginate_by=2)
+        eq_(response.status_code, 200)
+        eq_(response.data['count'], 10)
+        eq_([len(note['releases']) for note in response.data['results']],
+            [2, 2])
+        eq_(self.get(paginate_by=4).status_code, 400)
+
+
+class ReleasePageViewTest(TestCase):
+    def request(self, **params):
+        return Mock(QUERY_PARAMS=params, META={})
+
+    @patch('rna.rna.views.get_object_or_404')
+    def test_not_modified(self, mock_get_object_or_404):
+        """
+        Should return 304 without building the page when the ETag matches
+        """
+        release = mock_get_object_or_404.return_value
+        release.page_etag.return_value = '"abides"'
+        request = Mock(QUERY_PARAMS={},
+                       META={'HTTP_IF_NONE_MATCH': '"abides"'})
+        response = views.ReleasePageView().get(request, pk=1)
+        eq_(response.status_code, 304)
+        eq_(response['ETag'], '"abides"')
+        eq_(release.page.called, False)
+
+    @patch('rna.rna.views.cache')
+    @patch('rna.rna.views.get_object_or_404')
+    def test_cached(self, mock_get_object_or_404, mock_cache):
+        """
+        Should serve the page cached under its ETag
+        """
+        release = mock_get_object_or_404.return_value
+        release.page_etag.return_value = '"abides"'
+        mock_cache.get.return_value = {'release': 'the dude'}
+        response = views.ReleasePageView().get(
+            self.request(public_only='1'), pk=1)
+        eq_(response.data, {'release': 'the dude'})
+        eq_(response['ETag'], '"abides"')
+        release.page_etag.assert_called_once_with(True)
+        eq_(release.page.called, False)
+
+    @patch('rna.rna.views.render_to_string', return_value='<p>abides</p>')
+    @patch('rna.rna.views.ReleasePageView.page_data')
+    @patch('rna.rna.views.cache')
+    @patch('rna.rna.views.get_object_or_404')
+    def test_html(self, mock_get_object_or_404, mock_cache, mock_page_data,
+                  mock_render_to_string):
+        """
+        Should build, cache and tag the page apart from the JSON only one
+        """
+        release = mock_get_object_or_404.return_value
+        release.page_etag.return_value = '"abides"'
+        mock_cache.get.return_value = None
+        response = views.ReleasePageView().get(self.request(html='1'), pk=1)
+        eq_(response['ETag'], '"abides-html"')
+        eq_(response.data, mock_page_data.return_value)
+        mock_page_data.assert_called_once_with(
+            release.page.return_value, True)
+        release.page.assert_called_once_with(False)
+        ok_(mock_cache.set.called)
+
+    def test_page_data(self):
+        """
+        Should include the rendered page only when asked
+        """
+        page = {'release': None, 'new_features': [], 'known_issues': [],
+                'equivalent_android_release': None,
+                'equivalent_desktop_release': None,
+                'bug_search_url': 'http://example.com/bugs'}
+        view = views.ReleasePageView(request=None, format_kwarg=None)
+        data = view.page_data(page, False)
+        eq_(data['bug_search_url'], 'http://example.com/bugs')
+        eq_(data['new_features'], [])
+        ok_('html' not in data)
+        with patch('rna.rna.views.render_to_string',
+                   return_value='<p>abides</p>') as mock_render_to_string:
+            eq_(view.page_data(page, True)['html'], '<p>abides</p>')
+            mock_render_to_string.assert_called_once_with(
+                'rna/release_page.html', page)
+
+
+class ReleasePayloadViewTest(TestCase):
+    digest = 'a' * 40
+
+    def view(self, **meta):
+        view = views.ReleasePayloadView()
+        view.request = Mock(META=meta)
+        view.payload = Mock(return_value=(self.digest, '{"abides": true}'))
+        return view
+
+    @patch('rna.rna.views.reverse',
+           return_value='http://testserver/releases/1/payload/aaa/')
+    @patch('rna.rna.views.get_object_or_404')
+    def test_redirect(self, mock_get_object_or_404, mock_reverse):
+        """
+        Should redirect to the URL with the current hash
+        """
+        release = mock_get_object_or_404.return_value
+        release.pk = 1
+        view = self.view()
+        for digest in (None, 'b' * 40):
+            response = view.get(view.request, pk=1, digest=digest)
+            eq_(response.status_code, 302)
+            eq_(response['Location'],
+                'http://testserver/releases/1/payload/aaa/')
+            eq_(response['Cache-Control'], 'max-age=60')
+        mock_reverse.assert_called_with(
+            'release-payload', kwargs={'pk': 1, 'digest': self.digest},
+            request=view.request)
+
+    @patch('rna.rna.views.get_object_or_404')
+    def test_immutable(self, mock_get_object_or_404):
+        """
+        Should serve the payload as immutable at the current hash
+        """
+        view = self.view()
+        response = view.get(view.request, pk=1, digest=self.digest)
+        eq_(response.status_code, 200)
+        eq_(response.content, '{"abides": true}')
+        eq_(response['ETag'], '"%s"' % self.digest)
+        eq_(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        view = self.view(HTTP_IF_NONE_MATCH='"%s"' % self.digest)
+        eq_(view.get(view.request, pk=1, digest=self.digest).status_code,
+            304)
+
+    @patch('rna.rna.views.get_object_or_404')
+    def test_not_released(self, mock_get_object_or_404):
+        """
+        Should 404 for releases that are not public or not out yet
+        """
+        mock_get_object_or_404.return_value.is_released.return_value = False
+        view = self.view()
+        try:
+            view.get(view.request, pk=1)
+        except views.Http404:
+            pass
+        else:
+            ok_(False, 'Http404 not raised')
+        eq_(view.payload.called, False)
+
+    @patch('rna.rna.views.ReleasePayloadView.page_data',
+           return_value={'abides': True})
+    @patch('rna.rna.views.cache')
+    def test_payload(self, mock_cache, mock_page_data):
+        """
+        Should hash the JSON of the public page and cache both
+        """
+        mock_cache.get.return_value = None
+        view = views.ReleasePayloadView()
+        view.request = Mock(**{'build_absolute_uri.return_value':
+                               'http://testserver/'})
+        release = Mock(**{'page_etag.return_value': '"abides"'})
+        digest, content = view.payload(release)
+        eq_(content, '{"abides": true}')
+        eq_(digest, hashlib.sha1(content).hexdigest())
+        release.page_etag.assert_called_once_with(public_only=True)
+        release.page.assert_called_once_with(public_only=True)
+        key = mock_cache.get.call_args[0][0]
+        eq_(mock_cache.set.call_args_list, [
+            call(key, (digest, content), 86400),
+            call(mock_cache.get.call_args_list[0][0][0], key, 60)])
+
+    @patch('rna.rna.views.cache')
+    def test_payload_current(self, mock_cache):
+        """
+        Should serve the payload remembered for the release's modified
+        timestamp without computing the page ETag
+        """
+        payloads = {'current': 'payload-key',
+                    'payload-key': (self.digest, '{"abides": true}')}
+        mock_cache.get.side_effect = lambda key: payloads.get(
+            'current' if key.startswith('rna:payload:current:') else key)
+        view = views.ReleasePayloadView()
+        view.request = Mock(**{'build_absolute_uri.return_value':
+                               'http://testserver/'})
+        release = Mock(pk=1, modified=datetime(2015, 11, 3))
+        eq_(view.payload(release), (self.digest, '{"abides": true}'))
+        eq_(release.page_etag.called, False)
+        eq_(mock_cache.set.called, False)
+
+
+class ChangeFeedViewTest(TestCase):
+    def request(self, **params):
+        return Mock(QUERY_PARAMS=params, build_absolute_uri=Mock(
+            return_value='http://testserver/changes/?since=0'))
+
+    @override_settings(RNA={'CHANGES_PAGE_SIZE': 2})
+    @patch('rna.rna.views.models.Change.objects')
+    def test_page(self, mock_changes):
+        """
+        Should return a page of changes after since with a next link
+        """
+        values = mock_changes.filter.return_value.values.return_value
+        changes = [{'id': 4, 'created': datetime(2014, 1, 1)},
+                   {'id': 6, 'created': datetime(2014, 1, 1)},
+                   {'id': 7, 'created': datetime(2014, 1, 1)}]
+        values.__getitem__ = Mock(return_value=changes)
+        response = views.ChangeFeedView().get(self.request(since='3'))
+        mock_changes.filter.assert_called_once_with(id__gt=3)
+        values.__getitem__.assert_called_once_with(slice(None, 3))
+        eq_(response.data, {'results': changes[:2],
+                            'next': 'http://testserver/changes/?since=6',
+                            'last_seq': 6})
+
+    @override_settings(RNA={'CHANGES_PAGE_SIZE': 5,
+                            'CHANGES_SETTLE_TIME': 60})
+    @patch('rna.rna.views.models.Change.objects')
+    def test_in_flight(self, mock_changes):
+        """
+        Should stop before a gap among recent changes, where an earlier
+        change may not be committed yet
+        """
+        values = mock_changes.filter.return_value.values.return_value
+        now = datetime.now()
+        changes = [{'id': 4, 'created': datetime(2014, 1, 1)},
+                   {'id': 6, 'created': now}, {'id': 7, 'created': now},
+                   {'id': 9, 'created': now}]
+        values.__getitem__ = Mock(return_value=changes)
+        response = views.ChangeFeedView().get(self.request(since='3'))
+        eq_(response.data, {'results': changes[:1], 'next': None,
+                            'last_seq': 4})
+        changes[1]['created'] = datetime(2014, 1, 1)
+        response = views.ChangeFeedView().get(self.request(since='3'))
+        eq_(response.data['last_seq'], 7)
+
+    @override_settings(RNA={'CHANGES_PAGE_SIZE': 2})
+    @patch('rna.rna.views.models.Change.objects')
+    def test_last_page(self, mock_changes):
+        """
+        Should return no next link and since as last_seq when up to date
+        """
+        values = mock_changes.filter.return_value.values.return_value
+        values.__getitem__ = Mock(return_value=[])
+        response = views.ChangeFeedView().get(self.request(since='7'))
+        eq_(response.data, {'results': [], 'next': None, 'last_seq': 7})
+
+    def test_bad_since(self):
+        """
+        Should return 400 for a since that is not a sequence number
+        """
+        response = views.ChangeFeedView().get(self.request(since='x'))
+        eq_(response.status_code, 400)
+
+
+class IdListFilterTest(TestCase):
+    def test_filter(self):
+        """
+        Should filter on the listed ids and match nothing for bad ones
+        """
+        qs = Mock()
+        id_filter = filters.IdListFilter(name='pk')
+        eq_(id_filter.filter(qs, ''), qs)
+        id_filter.filter(qs, '1,2')
+        qs.filter.assert_called_once_with(pk__in=[1, 2])
+        eq_(id_filter.filter(qs, '1,x'), qs.none.return_value)
+
+
 class URLsTest(TestCase):
     @patch('rest_framework.routers.DefaultRouter.register')
     @patch('rest_framework.routers.DefaultRouter.urls')
     def test_urls(self, mock_urls, mock_register):
         from . import urls
+        urls = reload(urls)
         mock_register.assert_any_call('notes', views.NoteViewSet)
         mock_register.assert_any_call('releases', views.ReleaseViewSet)
+        mock_register.assert_any_call('tombstones', views.TombstoneViewSet)
         ok_(set(mock_urls).issubset(urls.urlpatterns))
 
 
 class ReleaseAdminTest(TestCase):
     @patch('rna.rna.admin.ReleaseAdmin.message_user')
-    @patch('rna.rna.admin.datetime')
-    def test_copy_releases(self, mock_datetime, mock_message_user):
-        mock_release_model = Mock()
-        mock_release_model.objects.filter.return_value.count.return_value = 1
-        release_admin = admin.ReleaseAdmin(mock_release_model, 'admin_site')
-        mock_release = Mock(id=1, version='42.0', product='Firefox')
-        mock_release.note_set.all.return_value = ['note']
-
-        release_admin.copy_releases('request', [mock_release])
-
-        mock_release_model.objects.filter.assert_called_once_with(
-            version__endswith='42.0', product='Firefox')
-        eq_(mock_release.id, None)
-        eq_(mock_release.version, 'copy-42.0')
-        mock_release.save.assert_called_once_with()
-        mock_release.note_set.add.assert_called_once_with('note')
-        mock_release.note_set.update.assert_called_once_with(
-            modified=mock_datetime.now.return_value)
+    @patch('rna.rna.admin.utils.copy_releases', return_value=['copy'])
+    def test_copy_releases(self, mock_copy_releases, mock_message_user):
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        release_admin.copy_releases('request', 'queryset')
+        mock_copy_releases.assert_called_once_with('queryset')
         mock_message_user.assert_called_once_with('request', 'Copied Release')
 
     @patch('rna.rna.admin.ReleaseAdmin.message_user')
-    @patch('rna.rna.admin.datetime')
-    def test_2nd_copy_releases(self, mock_datetime, mock_message_user):
-        mock_release_model = Mock()
-        mock_release_model.objects.filter.return_value.count.return_value = 2
-        release_admin = admin.ReleaseAdmin(mock_release_model, 'admin_site')
-        mock_release = Mock(id=1, version='42.0', product='Firefox')
-        mock_release.note_set.all.return_value = ['note']
-
-        release_admin.copy_releases('request', [mock_release])
-
-        mock_release_model.objects.filter.assert_called_once_with(
-            version__endswith='42.0', product='Firefox')
-        eq_(mock_release.id, None)
-        eq_(mock_release.version, 'copy2-42.0')
-        mock_release.save.assert_called_once_with()
-        mock_release.note_set.add.assert_called_once_with('note')
-        mock_release.note_set.update.assert_called_once_with(
-            modified=mock_datetime.now.return_value)
-        mock_message_user.assert_called_once_with('request', 'Copied Release')
+    @patch('rna.rna.admin.utils.copy_releases', return_value=['copy', 'copy'])
+    def test_copy_many_releases(self, mock_copy_releases, mock_message_user):
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        release_admin.copy_releases('request', 'queryset')
+        mock_message_user.assert_called_once_with(
+            'request', 'Copied 2 Releases')
+
+
+class ReleaseAutocompleteTest(TestCase):
+    @patch('rna.rna.admin.search_releases')
+    def test_autocomplete(self, mock_search_releases):
+        """
+        Should fetch one row beyond the page and report that there are more
+        """
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        release_admin.autocomplete_per_page = 1
+        values_list = mock_search_releases.return_value.values_list
+        values_list.return_value.__getitem__ = Mock(return_value=[
+            (3, 'Firefox', '27.0', 'Release'),
+            (4, 'Firefox', '27.0', 'Beta')])
+        request = Mock(GET={'q': 'firefox 27', 'page': '2'})
+        response = release_admin.autocomplete(request)
+        mock_search_releases.assert_called_once_with('firefox 27')
+        values_list.return_value.__getitem__.assert_called_once_with(
+            slice(1, 3))
+        eq_(json.loads(response.content),
+            {'results': [{'id': 3, 'text': 'Firefox 27.0 Release'}],
+             'more': True})
+
+    @patch('rna.rna.admin.models.Release.objects')
+    def test_search_releases(self, mock_objects):
+        """
+        Should filter once per search term
+        """
+        admin.search_releases('firefox 27')
+        releases = mock_objects.all.return_value
+        eq_(releases.filter.call_count, 1)
+        eq_(releases.filter.return_value.filter.call_count, 1)
+
+    @patch('rna.rna.admin.reverse', return_value='/autocomplete/')
+    @patch('rna.rna.admin.models.Release.objects')
+    def test_widget_renders_selected(self, mock_objects, mock_reverse):
+        """
+        Should only render the selected releases as choices
+        """
+        release = Mock()
+        release.pk = 1
+        release.__unicode__ = Mock(return_value=u'Firefox 27.0 Release')
+        mock_objects.filter.return_value = [release]
+        html = admin.ReleaseAutocompleteWidget().render('releases', [1])
+        mock_objects.filter.assert_called_once_with(pk__in=[1])
+        ok_('data-autocomplete-url="/autocomplete/"' in html)
+        ok_('<option value="1" selected="selected">Firefox 27.0 Release'
+            in html)
+
+
+class CachedCountTest(TestCase):
+    @override_settings(RNA={'ADMIN_COUNT_THRESHOLD': 10,
+                            'ADMIN_COUNT_TIMEOUT': 60})
+    @patch('rna.rna.admin.cache')
+    def test_cache_large_count(self, mock_cache):
+        """
+        Should cache counts at or above the threshold
+        """
+        mock_cache.get.return_value = None
+        queryset = Mock(**{'count.return_value': 10})
+        eq_(admin.cached_count(queryset), 10)
+        key = mock_cache.get.call_args[0][0]
+        mock_cache.set.assert_called_once_with(key, 10, 60)
+
+    @override_settings(RNA={'ADMIN_COUNT_THRESHOLD': 10})
+    @patch('rna.rna.admin.cache')
+    def test_small_count(self, mock_cache):
+        """
+        Should not cache counts below the threshold
+        """
+        mock_cache.get.return_value = None
+        queryset = Mock(**{'count.return_value': 9})
+        eq_(admin.cached_count(queryset), 9)
+        eq_(mock_cache.set.called, False)
+
+    @patch('rna.rna.admin.cache')
+    def test_cached(self, mock_cache):
+        """
+        Should return a cached count without counting
+        """
+        mock_cache.get.return_value = 42
+        queryset = Mock()
+        eq_(admin.cached_count(queryset), 42)
+        eq_(queryset.count.called, False)
+
+
+class HighVolumeAdminMixinTest(TestCase):
+    def test_preview_queryset(self):
+        """
+        Should select previews in SQL and defer the full text
+        """
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        mock_qs = Mock()
+        qs = release_admin.preview_queryset(mock_qs)
+        select = mock_qs.extra.call_args[1]['select']
+        eq_(select.keys(), ['text_preview'])
+        ok_(select['text_preview'].startswith('SUBSTR('))
+        mock_qs.extra.return_value.defer.assert_called_once_with('text')
+        eq_(qs, mock_qs.extra.return_value.defer.return_value)
+
+    @patch('rna.rna.admin.admin.ModelAdmin.queryset')
+    def test_queryset(self, mock_super_queryset):
+        """
+        Should leave the queryset of the other views whole
+        """
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        eq_(release_admin.queryset('request'), mock_super_queryset.return_value)
+        eq_(mock_super_queryset.return_value.extra.called, False)
+        eq_(mock_super_queryset.return_value.defer.called, False)
+
+    @patch('rna.rna.models.Tombstone.objects')
+    @patch('rna.rna.models.Change.objects')
+    @patch('rna.rna.admin.admin.ModelAdmin.queryset')
+    def test_get_object_records_changes(self, mock_super_queryset,
+                                        mock_changes, mock_tombstones):
+        """
+        Should record a change and a tombstone for an object saved and
+        deleted through get_object
+        """
+        mock_super_queryset.return_value.get.return_value = models.Release(
+            id=1, product='Firefox', version='42.0')
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        obj = release_admin.get_object('request', '1')
+        eq_(type(obj), models.Release)
+        post_save.send(sender=type(obj), instance=obj, created=False,
+                       raw=False, using='default')
+        post_delete.send(sender=type(obj), instance=obj, using='default')
+        mock_changes.record.assert_any_call('release', 'save', [1], 'default')
+        mock_changes.record.assert_any_call('release', 'delete', [1],
+                                            'default')
+        mock_tombstones.using.return_value.create.assert_called_once_with(
+            kind='release', object_id=1)
+
+    def test_preview(self):
+        release_admin = admin.ReleaseAdmin(models.Release, 'admin_site')
+        eq_(release_admin.text_preview(Mock(text_preview='abides')), 'abides')
+
+
+class ReleaseVersionListFilterTest(TestCase):
+    @patch('rna.rna.admin.models.Release.objects')
+    def test_lookups(self, mock_objects):
+        """
+        Should offer distinct recent versions and the current value
+        """
+        mock_objects.order_by.return_value.values_list.return_value = [
+            '42.0', '42.0', '41.0']
+        request = Mock(GET={'release_version': '33.1'})
+        list_filter = admin.ReleaseVersionListFilter(
+            request, {'release_version': '33.1'}, models.Note, 'admin')
+        eq_(list_filter.lookup_choices,
+            [('33.1', '33.1'), ('42.0', '42.0'), ('41.0', '41.0')])
+        mock_objects.order_by.assert_called_once_with('-release_date')
+
+
+class CopyReleasesTest(TestCase):
+    @patch('rna.rna.utils.Change.objects')
+    @patch('rna.rna.utils.Note')
+    @patch('rna.rna.utils.Release.objects')
+    def test_copy_releases(self, mock_objects, mock_note, mock_changes):
+        """
+        Should bulk create renamed, non-public copies and their note links
+        """
+        mock_objects.filter.return_value.values_list.side_effect = [
+            [('Firefox', '42.0'), ('Firefox', 'copy-42.0')],
+            [(7, 'Firefox', 'copy2-42.0')]]
+        through = mock_note.releases.through
+        through.objects.filter.return_value.values_list.return_value = [
+            (1, 3)]
+        release = models.Release(id=1, product='Firefox', version='42.0',
+                                 channel='Release', is_public=True)
+
+        copies = utils.copy_releases([release])
+
+        eq_(len(copies), 1)
+        eq_(copies[0].id, 7)
+        eq_(copies[0].version, 'copy2-42.0')
+        eq_(copies[0].channel, 'Release')
+        eq_(copies[0].is_public, False)
+        eq_(release.version, '42.0')
+        mock_objects.bulk_create.assert_called_once_with(copies)
+        through.objects.filter.assert_called_once_with(release__in=[1])
+        through.assert_called_once_with(note_id=3, release_id=7)
+        through.objects.bulk_create.assert_called_once_with(
+            [through.return_value])
+        ok_(mock_note.objects.filter.return_value.touch.called)
+        mock_changes.record.assert_any_call('release', 'save', [7])
+        mock_changes.record.assert_any_call(
+            'note_releases', 'link', [(through.return_value.note_id,
+                                       through.return_value.release_id)])
+
+
+class CopyReleasesTransactionTest(ModelTablesMixin, TransactionTestCase):
+    def test_failure_commits_nothing(self):
+        """
+        Should roll back the copies, links and touched notes if a later
+        step fails, even though touching the notes updates in between
+        """
+        release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        note = models.Note.objects.create(note='Note')
+        note.releases.add(release)
+        note = models.Note.objects.get(pk=note.pk)
+        record = models.Change.objects.record
+
+        def fail_on_releases(kind, *args):
+            if kind == 'release':
+                raise DatabaseError('failed')
+            return record(kind, *args)
+
+        with patch.object(models.Change.objects, 'record',
+                          side_effect=fail_on_releases) as mock_record:
+            with self.assertRaises(DatabaseError):
+                utils.copy_releases([release])
+            ok_(call('note', 'save', [note.pk], 'default') in
+                mock_record.call_args_list)
+        eq_(list(models.Release.objects.values_list('version', flat=True)),
+            ['42.0'])
+        eq_(models.Note.releases.through.objects.count(), 1)
+        eq_(models.Note.objects.get(pk=note.pk).modified, note.modified)
+
+
+class GenerateDataTest(TestCase):
+    def test_generate_versions(self):
+        """
+        Should follow each product's version pattern
+        """
+        eq_([v for c, v, d in islice(utils.generate_versions('Firefox'), 6)],
+            ['4.0a1', '4.0a2', '4.0beta', '4.0', '4.0.1', '5.0a1'])
+        eq_([(c, v) for c, v, d in islice(
+            utils.generate_versions('Firefox OS'), 2)],
+            [('Release', '1.0'), ('Release', '1.1')])
+        eq_([v for c, v, d in islice(utils.generate_versions(
+            'Firefox Extended Support Release'), 7)],
+            ['4.0.0', '4.1.0', '4.2.0', '4.3.0', '4.4.0', '4.5.0', '5.0.0'])
+        eq_([v for c, v, d in islice(
+            utils.generate_versions('Firefox', 30), 2)], ['30.0a1', '30.0a2'])
+
+    def generate(self, existing=None, **kwargs):
+        with patch('rna.rna.utils.Release.objects') as mock_releases, patch(
+                'rna.rna.utils.Note.objects') as mock_notes, patch.object(
+                models.Note.releases.through, 'objects') as mock_links, patch(
+                'rna.rna.utils.Change.objects'):
+            mock_releases.aggregate.return_value = {'id': 10}
+            mock_releases.values_list.return_value.iterator.return_value = (
+                existing or [])
+            mock_notes.aggregate.return_value = {'id': None}
+            counts = utils.generate_data(**kwargs)
+        releases = [r for c in mock_releases.bulk_create.call_args_list
+                    for r in c[0][0]]
+        notes = [n for c in mock_notes.bulk_create.call_args_list
+                 for n in c[0][0]]
+        links = [link for c in mock_links.bulk_create.call_args_list
+                 for link in c[0][0]]
+        return counts, releases, notes, links
+
+    def test_generate_data(self):
+        """
+        Should bulk create releases, notes and links in batches with ids
+        following the existing ones
+        """
+        counts, releases, notes, links = self.generate(
+            releases=10, notes_per_release=3, batch_size=4)
+        eq_(counts, {'releases': 10, 'notes': 30, 'links': len(links)})
+        eq_([r.id for r in releases], range(11, 21))
+        eq_([n.id for n in notes], range(1, 31))
+        eq_(len(set((r.product, r.version) for r in releases)), 10)
+        ok_(set(link.release_id for link in links) <= set(range(11, 21)))
+        ok_(set(n.fixed_in_release_id for n in notes) <=
+            set([None] + range(11, 21)))
+        ok_(len(links) >= 30)
+
+    def test_generate_data_again(self):
+        """
+        Should start after the highest existing major version
+        """
+        releases = self.generate(
+            existing=[('Firefox', '29.0.1'), ('Firefox OS', '1.30'),
+                      ('Thunderbird', 'abides')],
+            releases=10, notes_per_release=1)[1]
+        eq_(releases[0].version, '35.0a1')
+        ok_(all(utils.generated_major(r.product, r.version) >= 35
+                for r in releases))
+
+    def test_generate_data_deterministic(self):
+        """
+        Should generate the same data for the same seed
+        """
+        def fields(notes):
+            return [(n.bug, n.note, n.tag, n.fixed_in_release_id)
+                    for n in notes]
+
+        eq_(fields(self.generate(releases=5, notes_per_release=4)[2]),
+            fields(self.generate(releases=5, notes_per_release=4)[2]))
+        ok_(fields(self.generate(releases=5, notes_per_release=4)[2]) !=
+            fields(self.generate(releases=5, notes_per_release=4,
+                                 seed=1)[2]))
+
+
+class MigrateVersionsTest(TestCase):
+    @patch('rna.rna.utils.update_versions')
+    @patch('rna.rna.utils.Release.objects')
+    def test_migrate_versions(self, mock_objects, mock_update_versions):
+        """
+        Should rewrite versions per channel, one update per batch
+        """
+        releases = mock_objects.filter.return_value.order_by.return_value
+        releases.filter.return_value.values_list.return_value.__getitem__ = Mock(
+            side_effect=[[(1, 'Release', '42.0.0'), (2, 'Aurora', '43.0.0')],
+                         [(3, 'Beta', '44.0.0')], []])
+        progress = Mock()
+
+        eq_(utils.migrate_versions(batch_size=2, progress=progress), 3)
+
+        releases.filter.assert_any_call(id__gt=0)
+        releases.filter.assert_any_call(id__gt=2)
+        releases.filter.assert_any_call(id__gt=3)
+        mock_update_versions.assert_any_call({1: '42.0', 2: '43.0a2'})
+        mock_update_versions.assert_any_call({3: '44.0beta'})
+        progress.assert_called_with(3, {3: '44.0beta'})
+
+    @patch('rna.rna.utils.update_versions')
+    @patch('rna.rna.utils.Release.objects')
+    def test_migrate_versions_dry_run(self, mock_objects,
+                                      mock_update_versions):
+        """
+        Should count without updating
+        """
+        releases = mock_objects.filter.return_value.order_by.return_value
+        releases.filter.return_value.values_list.return_value.__getitem__ = Mock(
+            side_effect=[[(1, 'Release', '42.0.0')], []])
+        eq_(utils.migrate_versions(dry_run=True), 1)
+        eq_(mock_update_versions.called, False)
+
+
+class GetDuplicateProductVersionsTest(TestCase):
+    @patch('rna.rna.utils.Release.objects')
+    def test_get_duplicate_product_versions(self, mock_objects):
+        """
+        Should group in SQL and then read only the duplicated releases
+        """
+        mock_objects.values.return_value.annotate.return_value.filter.return_value.order_by.return_value = [
+            {'product': 'Firefox', 'version': '42.0'}]
+        mock_objects.filter.return_value.order_by.return_value.values_list.return_value = [
+            (1, 'Firefox', '42.0'), (5, 'Firefox', '42.0')]
+
+        eq_(utils.get_duplicate_product_versions(),
+            {('Firefox', '42.0'): [1, 5]})
+        mock_objects.values.assert_called_once_with('product', 'version')
+        mock_objects.values.return_value.annotate.return_value.filter.assert_called_once_with(
+            count__gt=1)
+
+
+class ReleaseCopyViewTest(TestCase):
+    @patch('rna.rna.views.ReleaseCopyView.get_serializer')
+    @patch('rna.rna.views.utils.copy_releases')
+    @patch('rna.rna.views.models.Release.objects')
+    def test_post(self, mock_objects, mock_copy_releases,
+                  mock_get_serializer):
+        """
+        Should copy the releases with the posted ids
+        """
+        request = Mock(DATA={'ids': [1, 2]})
+        response = views.ReleaseCopyView().post(request)
+        mock_objects.filter.assert_called_once_with(pk__in=[1, 2])
+        mock_copy_releases.assert_called_once_with(
+            mock_objects.filter.return_value)
+        mock_get_serializer.assert_called_once_with(
+            mock_copy_releases.return_value, many=True)
+        eq_(response.status_code, 201)
+
+
+class BenchmarksTest(TestCase):
+    @patch('rna.rna.benchmarks.profiling.query_stats')
+    @patch('rna.rna.benchmarks.time.time')
+    def test_measure(self, mock_time, mock_query_stats):
+        """
+        Should report the minimum and median of the timed calls and the
+        queries made by the last one
+        """
+        mock_time.side_effect = [0, 3, 10, 11, 20, 22]
+        mock_query_stats.return_value.__enter__.return_value.count = 2
+        func = Mock()
+        eq_(benchmarks.measure(lambda: func, repeat=3),
+            {'min': 1, 'median': 2, 'queries': 2})
+        eq_(func.call_count, 3)
+        eq_(mock_query_stats.call_count, 3)
+
+    def test_compare(self):
+        """
+        Should report time and query regressions beyond the thresholds
+        """
+        baseline = {'a': {'median': 1.0, 'queries': 10},
+                    'b': {'median': 1.0, 'queries': 10}}
+        results = {'a': {'median': 1.2, 'queries': 11},
+                   'b': {'median': 1.3, 'queries': 12},
+                   'c': {'median': 5.0, 'queries': 50}}
+        eq_(benchmarks.compare(results, baseline, time_threshold=0.25,
+                               query_threshold=1),
+            ['b: 1.3000s against 1.0000s', 'b: 12 queries against 10'])
+
+    @override_settings(RNA={})
+    def test_compare_default_thresholds(self):
+        """
+        Should allow a 25% slowdown and no extra queries by default
+        """
+        baseline = {'a': {'median': 1.0, 'queries': 10}}
+        eq_(benchmarks.compare({'a': {'median': 1.25, 'queries': 10}},
+                               baseline), [])
+        eq_(len(benchmarks.compare({'a': {'median': 1.0, 'queries': 11}},
+                                   baseline)), 1)
+
+    def test_unknown_benchmark(self):
+        """
+        Should refuse benchmark names that do not exist
+        """
+        with self.assertRaises(rnabench.CommandError):
+            rnabench.Command().handle('nope')
+
+
+class ProfilingTest(TestCase):
+    def mock_connection(self, use_debug_cursor=False):
+        return Mock(use_debug_cursor=use_debug_cursor, queries=[
+            {'sql': 'SELECT 0', 'time': '0.001'}])
+
+    def record(self, connection):
+        connection.queries.extend([{'sql': 'SELECT 1', 'time': '0.002'},
+                                   {'sql': 'SELECT 2', 'time': '0.010'}])
+
+    @override_settings(DEBUG=False, RNA={'SLOW_QUERY_COUNT': 1})
+    @patch('rna.rna.profiling.connections')
+    def test_query_stats(self, mock_connections):
+        """
+        Should count and time only the queries made in the block on the
+        alias's connection, and drop them afterwards if nobody else
+        wanted them
+        """
+        connection = mock_connections.__getitem__.return_value = \
+            self.mock_connection()
+        with profiling.query_stats('replica') as stats:
+            mock_connections.__getitem__.assert_called_once_with('replica')
+            ok_(connection.use_debug_cursor)
+            self.record(connection)
+        eq_(stats.count, 2)
+        eq_(round(stats.time, 3), 0.012)
+        eq_(stats.slowest, [{'sql': 'SELECT 2', 'time': '0.010'}])
+        eq_(connection.use_debug_cursor, False)
+        eq_(len(connection.queries), 1)
+
+    @override_settings(DEBUG=False, RNA={})
+    @patch('rna.rna.profiling.connections')
+    def test_query_stats_all_connections(self, mock_connections):
+        """
+        Should count the queries of every connection by default
+        """
+        default = self.mock_connection()
+        replica = self.mock_connection()
+        mock_connections.all.return_value = [default, replica]
+        with profiling.query_stats() as stats:
+            ok_(default.use_debug_cursor and replica.use_debug_cursor)
+            self.record(default)
+            self.record(replica)
+        eq_(stats.count, 4)
+        eq_(replica.use_debug_cursor, False)
+        eq_(len(replica.queries), 1)
+
+    @override_settings(DEBUG=False, RNA={})
+    @patch('rna.rna.profiling.connections')
+    def test_query_stats_nested(self, mock_connections):
+        """
+        Should leave the queries for an enclosing block
+        """
+        connection = mock_connections.__getitem__.return_value = \
+            self.mock_connection(use_debug_cursor=True)
+        with profiling.query_stats('default'):
+            self.record(connection)
+        eq_(len(connection.queries), 3)
+        ok_(connection.use_debug_cursor)
+
+    @override_settings(RNA={})
+    @patch('rna.rna.profiling.connections')
+    def test_max_queries(self, mock_connections):
+        """
+        Should raise listing the statements when over budget
+        """
+        connection = mock_connections.__getitem__.return_value = \
+            self.mock_connection()
+        with self.assertRaises(profiling.QueryBudgetExceeded) as cm:
+            with profiling.max_queries(1, 'notes', 'default'):
+                self.record(connection)
+        ok_('SELECT 2' in str(cm.exception))
+        with profiling.max_queries(2, 'notes', 'default'):
+            self.record(connection)
+
+    @override_settings(RNA={})
+    @patch('rna.rna.profiling.logger')
+    @patch('rna.rna.profiling.QueryStats')
+    def test_log_query_stats(self, mock_query_stats, mock_logger):
+        """
+        Should log the queries of a command under its module name
+        """
+        class Command(object):
+            __module__ = 'rna.management.commands.rnasync'
+
+            @profiling.log_query_stats
+            def handle(self, *args, **options):
+                return 'handled'
+
+        eq_(Command().handle(), 'handled')
+        stats = mock_query_stats.return_value.start.return_value
+        stats.log.assert_called_once_with('rnasync')
+
+    @override_settings(DEBUG=True, RNA={'QUERY_BUDGETS': {'NoteViewSet': 5}})
+    @patch('rna.rna.profiling.QueryStats')
+    def test_middleware(self, mock_query_stats):
+        """
+        Should add the query headers in DEBUG mode and log against the
+        view's budget
+        """
+        stats = mock_query_stats.return_value.start.return_value
+        stats.count = 3
+        stats.time = 0.25
+        middleware = profiling.QueryStatsMiddleware()
+        request = Mock(path='/notes/')
+        middleware.process_request(request)
+        middleware.process_view(request, Mock(__name__='NoteViewSet'), (), {})
+        response = middleware.process_response(request, {})
+        eq_(response, {'X-RNA-Query-Count': '3', 'X-RNA-Query-Time': '0.250'})
+        stats.log.assert_called_once_with('NoteViewSet', 5)
+        stats.check.assert_called_once_with('NoteViewSet', 5)
+
+    @override_settings(DEBUG=False, RNA={'QUERY_BUDGETS': {'/notes/': 1},
+                                         'ENFORCE_QUERY_BUDGETS': True})
+    @patch('rna.rna.profiling.QueryStats.stop')
+    def test_middleware_enforces_budget(self, mock_stop):
+        """
+        Should raise when over budget if budgets are enforced
+        """
+        middleware = profiling.QueryStatsMiddleware()
+        request = Mock(path='/notes/', _rna_view_name=None)
+        middleware.process_request(request)
+        request._rna_query_stats.count = 2
+        with self.assertRaises(profiling.QueryBudgetExceeded):
+            middleware.process_response(request, {})
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics._values.clear()
+
+    def tearDown(self):
+        metrics._values.clear()
+
+    @override_settings(RNA={})
+    def test_render(self):
+        """
+        Should render counters, gauges and cumulative histogram buckets
+        """
+        metrics.inc('rna_requests_total', view='NoteViewSet', method='GET',
+                    status=200)
+        metrics.inc('rna_requests_total', view='NoteViewSet', method='GET',
+                    status=200)
+        metrics.set_gauge('rna_sync_records', 7, model='note')
+        metrics.observe('rna_response_size_bytes', 50, view='NoteViewSet')
+        metrics.observe('rna_response_size_bytes', 500, view='NoteViewSet')
+        text = metrics.render(metrics.collect())
+        ok_('# TYPE rna_requests_total counter\n' in text)
+        ok_('rna_requests_total{method="GET",status="200",'
+            'view="NoteViewSet"} 2.0\n' in text)
+        ok_('rna_sync_records{model="note"} 7.0\n' in text)
+        ok_('rna_response_size_bytes_bucket{view="NoteViewSet",le="100"} 1\n'
+            in text)
+        ok_('rna_response_size_bytes_bucket{view="NoteViewSet",le="1000"} 2\n'
+            in text)
+        ok_('rna_response_size_bytes_bucket{view="NoteViewSet",le="+Inf"} '
+            '2\n' in text)
+        ok_('rna_response_size_bytes_sum{view="NoteViewSet"} 550.0\n' in text)
+        ok_('rna_response_size_bytes_count{view="NoteViewSet"} 2\n' in text)
+        ok_('rna_token_auth_total' not in text)
+
+    def test_merge(self):
+        """
+        Should add counters and histograms and keep the latest gauge
+        """
+        key = ('rna_sync_records', ())
+        histogram = ('rna_request_duration_seconds', ())
+        into = {('rna_requests_total', ()): 1, key: [1, 100],
+                histogram: {'buckets': [1, 0], 'sum': 0.1, 'count': 1}}
+        metrics.merge(into, {
+            ('rna_requests_total', ()): 2, key: [2, 50],
+            histogram: {'buckets': [0, 1], 'sum': 0.2, 'count': 1}})
+        eq_(into[('rna_requests_total', ())], 3)
+        eq_(into[key], [1, 100])
+        eq_(into[histogram]['buckets'], [1, 1])
+        eq_(into[histogram]['count'], 2)
+
+    def test_multiprocess(self):
+        """
+        Should add up the values written by every process
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(metrics._path(directory, 1), 'w') as f:
+            json.dump([['rna_requests_total', [['view', 'NoteViewSet']], 2]],
+                      f)
+        with override_settings(RNA={'METRICS_DIR': directory}):
+            metrics.inc('rna_requests_total', view='NoteViewSet')
+            eq_(metrics.collect(),
+                {('rna_requests_total', (('view', 'NoteViewSet'),)): 3})
+
+    @override_settings(RNA={})
+    def test_metrics_view_disabled(self):
+        """
+        Should not be served unless enabled
+        """
+        with self.assertRaises(metrics.Http404):
+            metrics.metrics_view(Mock())
+
+    @override_settings(RNA={'METRICS': True})
+    def test_metrics_view(self):
+        metrics.inc('rna_token_auth_total', result='success')
+        response = metrics.metrics_view(Mock())
+        ok_('rna_token_auth_total{result="success"} 1.0' in response.content)
+        eq_(response['Content-Type'], 'text/plain; version=0.0.4')
+
+    @override_settings(RNA={})
+    @patch('rna.rna.metrics.profiling.QueryStats')
+    def test_middleware(self, mock_query_stats):
+        """
+        Should count the request by view and record its timings
+        """
+        stats = mock_query_stats.return_value.start.return_value
+        stats.count = 3
+        stats.time = 0.5
+        middleware = metrics.MetricsMiddleware()
+        request = Mock(method='GET')
+        middleware.process_request(request)
+        middleware.process_view(request, Mock(__name__='NoteViewSet'), (), {})
+        middleware.process_response(request, Mock(
+            status_code=200, content='x' * 10, streaming=False))
+        values = metrics.collect()
+        eq_(values[('rna_requests_total', (
+            ('method', 'GET'), ('status', '200'), ('view', 'NoteViewSet')))],
+            1)
+        eq_(values[('rna_db_queries_total', (('view', 'NoteViewSet'),))], 3)
+        eq_(values[('rna_response_size_bytes', (
+            ('view', 'NoteViewSet'),))]['sum'], 10)
+
+    @patch('rna.rna.metrics.authentication.TokenAuthentication.'
+           'authenticate_credentials')
+    def test_token_authentication(self, mock_authenticate_credentials):
+        """
+        Should count successful and failed token lookups
+        """
+        mock_authenticate_credentials.side_effect = [
+            ('user', 'token'), metrics.exceptions.AuthenticationFailed('no')]
+        auth = metrics.TokenAuthentication()
+        auth.authenticate_credentials('key')
+        with self.assertRaises(metrics.exceptions.AuthenticationFailed):
+            auth.authenticate_credentials('bad')
+        values = metrics.collect()
+        eq_(values[('rna_token_auth_total', (('result', 'success'),))], 1)
+        eq_(values[('rna_token_auth_total', (('result', 'failure'),))], 1)
+
+    def test_sync_record_metrics(self):
+        """
+        Should report the record count and how far upstream was ahead
+        """
+        command = rnasync.Command()
+        command.record_metrics(models.Note, {
+            'modified_after': '2014-01-01T00:00:00'}, 2,
+            datetime(2014, 1, 1, 0, 2))
+        command.record_metrics(models.Release, {}, 0)
+        values = metrics.collect()
+        eq_(values[('rna_sync_records', (('model', 'note'),))][0], 2)
+        eq_(values[('rna_sync_lag_seconds', (('model', 'note'),))][0], 120)
+        eq_(values[('rna_sync_lag_seconds', (('model', 'release'),))][0], 0)
+
+
+class RoutersTest(TestCase):
+    def setUp(self):
+        routers._lag_checks.clear()
+
+    def tearDown(self):
+        routers._lag_checks.clear()
+
+    @override_settings(RNA={'REPLICAS': ['replica1', 'replica2'],
+                            'REPLICA_MAX_LAG': 60})
+    @patch('rna.rna.routers.replica_lag')
+    def test_use_replica(self, mock_replica_lag):
+        """
+        Should route reads in the block to a replica within the lag limit
+        """
+        mock_replica_lag.side_effect = lambda alias: {
+            'replica1': 61, 'replica2': 60}[alias]
+        router = routers.ReplicaRouter()
+        eq_(router.db_for_read(models.Note), None)
+        with routers.use_replica() as alias:
+            eq_(alias, 'replica2')
+            eq_(router.db_for_read(models.Note), 'replica2')
+            eq_(router.db_for_write(models.Note), 'default')
+        eq_(router.db_for_read(models.Note), None)
+
+    @override_settings(RNA={'REPLICAS': ['replica'],
+                            'REPLICA_LAG_CHECK_INTERVAL': 5})
+    @patch('rna.rna.routers.replica_lag', return_value=None)
+    def test_lag_checked_periodically(self, mock_replica_lag):
+        """
+        Should reuse a recent lag check and skip unreadable replicas
+        """
+        eq_(routers.healthy_replicas(), [])
+        eq_(routers.healthy_replicas(), [])
+        eq_(mock_replica_lag.call_count, 1)
+
+    def test_allow_relation(self):
+        """
+        Should allow relations between the default database and replicas
+        """
+        router = routers.ReplicaRouter()
+        obj1, obj2 = Mock(), Mock()
+        obj1._state.db = 'default'
+        obj2._state.db = 'replica'
+        with override_settings(RNA={'REPLICAS': ['replica']}):
+            ok_(router.allow_relation(obj1, obj2))
+        with override_settings(RNA={}):
+            eq_(router.allow_relation(obj1, obj2), None)
+
+    def dispatch(self, method, status_code=200):
+        class View(object):
+            def dispatch(self, request, *args, **kwargs):
+                self.replica = getattr(routers._local, 'replica', None)
+                return Mock(status_code=status_code)
+
+        class ReplicaView(routers.ReplicaReadMixin, View):
+            pass
+
+        view = ReplicaView()
+        view.dispatch(Mock(method=method, META={}, COOKIES={}))
+        return view.replica
+
+    @override_settings(RNA={'REPLICAS': ['replica']})
+    @patch('rna.rna.routers.cache')
+    @patch('rna.rna.routers.healthy_replicas', return_value=['replica'])
+    def test_mixin(self, mock_healthy_replicas, mock_cache):
+        """
+        Should read from a replica until the client writes, and from the
+        default database for a while after
+        """
+        mock_cache.get.return_value = None
+        eq_(self.dispatch('GET'), 'replica')
+        eq_(self.dispatch('POST'), None)
+        eq_(mock_cache.set.call_count, 1)
+        eq_(self.dispatch('POST', status_code=400), None)
+        eq_(mock_cache.set.call_count, 1)
+        mock_cache.get.return_value = True
+        eq_(self.dispatch('GET'), None)
+
+    @patch('rna.rna.views.Token.objects')
+    def test_auth_token_reads(self, mock_tokens):
+        """
+        Should read existing tokens and only create missing ones
+        """
+        request = Mock()
+        mock_tokens.get.return_value = Mock(key='abc')
+        response = views.auth_token(request)
+        eq_(json.loads(response.content), {'token': 'abc'})
+        ok_(not mock_tokens.get_or_create.called)
+
+
+@override_settings(RNA={'REPLICAS': ['replica'], 'REPLICA_MAX_LAG': 60})
+class ReplicaRoutingDBTest(ModelTablesMixin, TestCase):
+    """
+    ReplicaRouter on the default and replica SQLite databases of the test
+    settings, with a release whose version differs between the two so
+    that reads show where they went.
+    """
+    multi_db = True
+    databases = (DEFAULT_DB_ALIAS, 'replica')
+
+    def setUp(self):
+        super(ReplicaRoutingDBTest, self).setUp()
+        routers._lag_checks.clear()
+        self.routers = patch.object(router, 'routers',
+                                    [routers.ReplicaRouter()])
+        self.routers.start()
+        self.release = models.Release.objects.create(
+            product='Firefox', channel='Release', version='42.0',
+            release_date=datetime(2015, 11, 3))
+        self.release.version = '41.0'
+        self.release.save(using='replica', modified=False)
+        self.request = RequestFactory().get('/releases/', REMOTE_ADDR='1.2.3.4')
+        cache.delete(routers._sticky_key(self.request))
+
+    def tearDown(self):
+        cache.delete(routers._sticky_key(self.request))
+        self.routers.stop()
+        routers._lag_checks.clear()
+        super(ReplicaRoutingDBTest, self).tearDown()
+
+    def version(self):
+        return models.Release.objects.get(pk=self.release.pk).version
+
+    def test_reads_and_writes(self):
+        """
+        Should read from the replica in use_replica() and write to the
+        default database
+        """
+        eq_(self.version(), '42.0')
+        with routers.use_replica() as alias:
+            eq_(alias, 'replica')
+            eq_(self.version(), '41.0')
+            release = models.Release.objects.create(
+                product='Firefox', channel='Beta', version='43.0beta',
+                release_date=datetime(2015, 11, 3))
+        ok_(models.Release.objects.using('default').filter(
+            pk=release.pk).exists())
+        ok_(not models.Release.objects.using('replica').filter(
+            version='43.0beta').exists())
+
+    def test_read_your_writes(self):
+        """
+        Should read from the default database after the client wrote
+        """
+        class View(object):
+            def dispatch(view, request, *args, **kwargs):
+                view.version = self.version()
+                return Mock(status_code=200)
+
+        class ReplicaView(routers.ReplicaReadMixin, View):
+            pass
+
+        view = ReplicaView()
+        view.dispatch(self.request)
+        eq_(view.version, '41.0')
+        self.request.method = 'POST'
+        view.dispatch(self.request)
+        self.request.method = 'GET'
+        view.dispatch(self.request)
+        eq_(view.version, '42.0')
+
+
+class SnapshotsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = self.directory + '/snapshot.gz'
+
+    def write(self, *lines):
+        with gzip.open(self.path, 'wb') as f:
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
+
+    def header(self, version=snapshots.VERSION):
+        return {'format': snapshots.FORMAT, 'version': version,
+                'watermark': '2014-01-01T00:00:00'}
+
+    def counts(self, **counts):
+        return {'counts': dict({'release': 0, 'note': 0, 'note_releases': 0,
+                                'tombstone': 0, 'change': 0}, **counts)}
+
+    def test_read(self):
+        """
+        Should yield the header and then each row
+        """
+        self.write(self.header(), ['release', [1]], ['note', [2]],
+                   self.counts(release=1, note=1))
+        rows = list(snapshots.read(self.path))
+        eq_(rows[0]['watermark'], '2014-01-01T00:00:00')
+        eq_(rows[1:], [('release', [1]), ('note', [2])])
+
+    def test_read_incomplete(self):
+        """
+        Should refuse a snapshot without its counts or with wrong ones
+        """
+        self.write(self.header(), ['release', [1]])
+        with self.assertRaises(snapshots.SnapshotError):
+            list(snapshots.read(self.path))
+        self.write(self.header(), ['release', [1]], self.counts(release=2))
+        with self.assertRaises(snapshots.SnapshotError):
+            list(snapshots.read(self.path))
+
+    def test_read_other_version(self):
+        """
+        Should refuse snapshots of another version or format
+        """
+        self.write(self.header(version=snapshots.VERSION + 1))
+        with self.assertRaises(snapshots.SnapshotError):
+            list(snapshots.read(self.path))
+        self.write(['release', [1]])
+        with self.assertRaises(snapshots.SnapshotError):
+            list(snapshots.read(self.path))
+
+    @patch('rna.rna.snapshots.connection')
+    @patch('rna.rna.snapshots.models.Change.objects')
+    @patch('rna.rna.snapshots._kinds')
+    def test_dump(self, mock_kinds, mock_changes, mock_connection):
+        """
+        Should write rows by id in batches from a single snapshot, with the
+        watermark as the modified time of rows modified since the dump
+        started
+        """
+        mock_connection.vendor = 'postgresql'
+        model = Mock()
+        id_field, modified_field = Mock(attname='id'), Mock(
+            attname='modified')
+        model._meta.fields = [id_field, modified_field]
+        rows = model.objects.order_by.return_value.values_list.return_value
+        rows.filter.return_value.__getitem__ = Mock(side_effect=[
+            [(1, datetime(2013, 1, 1)), (2, datetime(2999, 1, 1))], []])
+        mock_kinds.return_value = (('release', model),)
+        mock_changes.aggregate.return_value = {'latest': None}
+
+        eq_(snapshots.dump(self.path, batch_size=2), {'release': 2})
+        rows.filter.assert_called_with(id__gt=2)
+        mock_connection.cursor.return_value.execute.assert_called_once_with(
+            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        with gzip.open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        eq_(lines[1:], [['release', [1, '2013-01-01T00:00:00']],
+                        ['release', [2, lines[0]['watermark']]],
+                        {'counts': {'release': 2}}])
+
+    @patch('rna.rna.snapshots._kinds')
+    def test_load_refuses_existing_data(self, mock_kinds):
+        """
+        Should only load into a database without RNA data
+        """
+        model = Mock()
+        model.objects.exists.return_value = True
+        mock_kinds.return_value = (('release', model),)
+        with self.assertRaises(snapshots.SnapshotError):
+            snapshots.load(self.path)
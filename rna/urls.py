@@ -4,14 +4,28 @@
 from django.conf.urls import patterns, url
 from rest_framework import routers
 
-from . import views
+from . import metrics, views
 
 
 router = routers.DefaultRouter()
 router.register('notes', views.NoteViewSet)
 router.register('releases', views.ReleaseViewSet)
+router.register('tombstones', views.TombstoneViewSet)
 
-urlpatterns = router.urls + patterns(
+urlpatterns = patterns(
+    '',
+    # before the router's releases/<pk>/ so copy is not taken as a pk
+    url(r'^releases/copy/$', views.ReleaseCopyView.as_view()),
+) + router.urls + patterns(
     '',
     url(r'^releases/(?P<pk>\d+)/notes/$', views.NestedNoteView.as_view()),
-    url(r'^auth_token/$', views.auth_token))
+    url(r'^releases/(?P<pk>\d+)/page/$', views.ReleasePageView.as_view()),
+    url(r'^releases/(?P<pk>\d+)/payload/$',
+        views.ReleasePayloadView.as_view()),
+    url(r'^releases/(?P<pk>\d+)/payload/(?P<digest>[0-9a-f]{40})/$',
+        views.ReleasePayloadView.as_view(), name='release-payload'),
+    url(r'^releases/(?P<pk>\d+)/diff/(?P<other_pk>\d+)/$',
+        views.ReleaseDiffView.as_view()),
+    url(r'^changes/$', views.ChangeFeedView.as_view()),
+    url(r'^auth_token/$', views.auth_token),
+    url(r'^metrics/$', metrics.metrics_view))
@@ -1,26 +1,291 @@
-from .models import Release
+from datetime import datetime, timedelta
+from itertools import count, islice
+import random
 
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q
 
-def migrate_versions():
-    for r in Release.objects.filter(version__endswith='.0.0').only(
-            'channel', 'version'):
-        if r.channel == 'Release':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2])
-        elif r.channel == 'Aurora':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2] + 'a2')
-        elif r.channel == 'Beta':
-            Release.objects.filter(id=r.id).update(version=r.version[:-2] + 'beta')
+from .models import Change, Note, Release
 
 
-def get_duplicate_product_versions():
-    version_ids = {}
+def batches(items, size=200):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+@transaction.commit_on_success
+def copy_releases(releases):
+    """
+    Copy releases and their note links in a single transaction, using a
+    handful of bulk queries however many releases there are. Copies are
+    named copy-<version>, or copy<n>-<version> if n releases of the same
+    product already end with the version, and are not public so they can
+    be reviewed before going live. Returns the saved copies.
+    """
+    releases = list(releases)
+    existing = []
+    for batch in batches(releases):
+        q = Q()
+        for r in batch:
+            q |= Q(product=r.product, version__endswith=r.version)
+        existing.extend(Release.objects.filter(q).values_list(
+            'product', 'version'))
+
+    copies = []
+    skip = ('id', 'created', 'modified')
+    for r in releases:
+        copy_count = len([v for p, v in existing
+                          if p == r.product and v.endswith(r.version)])
+        copy = Release(**dict((f.attname, getattr(r, f.attname))
+                              for f in Release._meta.fields
+                              if f.attname not in skip))
+        if copy_count > 1:
+            copy.version = 'copy%s-%s' % (copy_count, r.version)
+        else:
+            copy.version = 'copy-' + r.version
+        copy.is_public = False
+        copies.append(copy)
+    Release.objects.bulk_create(copies)
+
+    # bulk_create does not set autoincrement pks, so look them up
+    copy_ids = {}
+    for batch in batches(copies):
+        q = Q()
+        for c in batch:
+            q |= Q(product=c.product, version=c.version)
+        copy_ids.update(((p, v), pk) for pk, p, v in Release.objects.filter(
+            q).values_list('id', 'product', 'version'))
+    for c in copies:
+        c.id = copy_ids[(c.product, c.version)]
+
+    through = Note.releases.through
+    copy_for = dict((r.id, c.id) for r, c in zip(releases, copies))
+    links = []
+    for batch in batches(copy_for):
+        links.extend(through(note_id=note_id, release_id=copy_for[release_id])
+                     for release_id, note_id in through.objects.filter(
+                         release__in=batch).values_list('release', 'note'))
+    through.objects.bulk_create(links)
+    for batch in batches(set(link.note_id for link in links)):
+        Note.objects.filter(pk__in=batch).touch()
+    Change.objects.record('release', 'save', [c.id for c in copies])
+    Change.objects.record('note_releases', 'link',
+                          [(link.note_id, link.release_id) for link in links])
+    return copies
+
+
+VERSION_SUFFIXES = {'Release': '', 'Aurora': 'a2', 'Beta': 'beta'}
+
+
+@transaction.commit_on_success
+def update_versions(versions):
+    """
+    Set the version of each release in a mapping of id to version, and
+    stamp modified, with a single conditional UPDATE.
+    """
+    qn = connection.ops.quote_name
+    ids = versions.keys()
+    sql = ('UPDATE {table} SET {version} = CASE {id} {cases} END, '
+           '{modified} = %s WHERE {id} IN ({ids})').format(
+        table=qn(Release._meta.db_table), version=qn('version'),
+        id=qn('id'), modified=qn('modified'),
+        cases=' '.join(['WHEN %s THEN %s'] * len(ids)),
+        ids=', '.join(['%s'] * len(ids)))
+    params = []
+    for pk in ids:
+        params.extend([pk, versions[pk]])
+    params.append(connection.ops.value_to_db_datetime(datetime.now()))
+    params.extend(ids)
+    connection.cursor().execute(sql, params)
+    transaction.set_dirty()
+    Change.objects.record('release', 'save', ids)
+
+
+def migrate_versions(batch_size=1000, dry_run=False, progress=None):
+    """
+    Rewrite X.0.0 versions to X.0, X.0a2 or X.0beta for the Release,
+    Aurora and Beta channels, reading releases in batches by id and
+    writing each batch with one UPDATE in its own transaction, so that
+    locks are only held briefly. progress, if given, is called with the
+    running count and the batch's mapping of id to new version. Returns
+    the number of releases rewritten, or that would be with dry_run.
+    """
+    releases = Release.objects.filter(
+        version__endswith='.0.0',
+        channel__in=VERSION_SUFFIXES.keys()).order_by('id')
+    count = last_id = 0
+    while True:
+        batch = list(releases.filter(id__gt=last_id).values_list(
+            'id', 'channel', 'version')[:batch_size])
+        if not batch:
+            return count
+        last_id = batch[-1][0]
+        versions = dict((pk, version[:-2] + VERSION_SUFFIXES[channel])
+                        for pk, channel, version in batch)
+        if not dry_run:
+            update_versions(versions)
+        count += len(versions)
+        if progress:
+            progress(count, versions)
+
+
+def get_duplicate_product_versions(batch_size=200):
+    """
+    Return a mapping of (product, version) to the ids of the releases
+    that share it, finding the duplicated pairs with GROUP BY ... HAVING
+    and then reading only those releases, in batches.
+    """
+    pairs = Release.objects.values('product', 'version').annotate(
+        count=Count('id')).filter(count__gt=1).order_by()
     duplicates = {}
-    for product in Release.PRODUCTS:
-        version_ids[product] = {}
-        for r in Release.objects.filter(product=product):
-            version_ids[product].setdefault(r.version, [])
-            version_ids[product][r.version].append(r.id)
-            if len(version_ids[product][r.version]) > 1:
-                duplicates[(product, r.version)] = version_ids[product][
-                    r.version]
+    for batch in batches(pairs, batch_size):
+        q = Q()
+        for pair in batch:
+            q |= Q(product=pair['product'], version=pair['version'])
+        for pk, product, version in Release.objects.filter(q).order_by(
+                'id').values_list('id', 'product', 'version'):
+            duplicates.setdefault((product, version), []).append(pk)
     return duplicates
+
+
+def generate_versions(product, start=4):
+    """
+    Yield (channel, version, release_date) for successive releases of a
+    product from major version start, following the version pattern of
+    each channel.
+    """
+    first = datetime(2011, 3, 22)
+    for major in count(start):
+        date = first + timedelta(weeks=6 * (major - 4))
+        if product == 'Firefox OS':
+            yield 'Release', '1.%s' % (major - 4), date
+        elif product == 'Firefox Extended Support Release':
+            for minor in range(6):
+                yield ('ESR', '%s.%s.0' % (major, minor),
+                       date + timedelta(weeks=6 * minor))
+        else:
+            yield 'Nightly', '%s.0a1' % major, date - timedelta(weeks=18)
+            yield 'Aurora', '%s.0a2' % major, date - timedelta(weeks=12)
+            yield 'Beta', '%s.0beta' % major, date - timedelta(weeks=6)
+            yield 'Release', '%s.0' % major, date
+            yield 'Release', '%s.0.1' % major, date + timedelta(weeks=2)
+
+
+def generated_major(product, version):
+    """
+    Return the major version that generate_versions() gives version for
+    product, or None if it doesn't follow the pattern.
+    """
+    try:
+        if product == 'Firefox OS':
+            return int(version.split('.')[1]) + 4
+        return int(version.split('.')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+NOTE_TEXTS = (
+    'Improved performance of {thing}',
+    'Support for {thing}',
+    '{thing} no longer crashes on startup',
+    'Updated {thing} to the latest specification',
+    'Fixed a memory leak in {thing}',
+    '{thing} may be slow on some hardware',
+)
+NOTE_THINGS = ('tabs', 'the download manager', 'WebRTC', 'IndexedDB',
+               'the JavaScript engine', 'add-ons', 'sync', 'private browsing',
+               'the PDF viewer', 'CSS animations', 'Web Audio', 'bookmarks')
+
+
+def generate_data(releases=1000, notes_per_release=20, seed=0,
+                  batch_size=1000, progress=None):
+    """
+    Create releases of every product and channel with realistic versions,
+    and notes_per_release notes for each, some of which are known issues
+    fixed in a later release or are carried over to the product's next
+    release. The data only depends on the arguments. Rows are given
+    explicit ids following the existing ones, so they are written with
+    bulk_create alone and committed a batch at a time, and versions
+    follow the highest existing major version so that the command can be
+    run again. progress, if
+    given, is called with each model name and its running count.
+    Returns the number of releases, notes and release links created.
+    """
+    rand = random.Random(seed)
+    products = len(Release.PRODUCTS)
+    start = 4
+    for product, version in Release.objects.values_list(
+            'product', 'version').iterator():
+        major = generated_major(product, version)
+        if major is not None:
+            start = max(start, major + 1)
+    versions = [generate_versions(p, start) for p in Release.PRODUCTS]
+    release_id = (Release.objects.aggregate(id=Max('id'))['id'] or 0) + 1
+    note_id = (Note.objects.aggregate(id=Max('id'))['id'] or 0) + 1
+    Through = Note.releases.through
+    counts = {'releases': 0, 'notes': 0, 'links': 0}
+
+    def create(model, objs, key):
+        with transaction.commit_on_success():
+            model.objects.bulk_create(objs)
+            if model is Through:
+                Change.objects.record('note_releases', 'link', [
+                    (link.note_id, link.release_id) for link in objs])
+            else:
+                Change.objects.record(model._meta.module_name, 'save',
+                                      [o.id for o in objs])
+        counts[key] += len(objs)
+        if progress:
+            progress(key, counts[key])
+
+    # all releases go in first so that notes can refer to later releases
+    for batch in batches(xrange(releases), batch_size):
+        objs = []
+        for i in batch:
+            channel, version, release_date = next(versions[i % products])
+            objs.append(Release(
+                id=release_id + i, product=Release.PRODUCTS[i % products],
+                channel=channel, version=version, release_date=release_date,
+                is_public=rand.random() < 0.95))
+        create(Release, objs, 'releases')
+
+    notes = ((i, j) for i in xrange(releases)
+             for j in xrange(notes_per_release))
+    for batch in batches(notes, batch_size):
+        objs, links = [], []
+        for i, j in batch:
+            # the release of the same product after release i, if any
+            later = (release_id + i + products
+                     if i + products < releases else None)
+            known_issue = rand.random() < 0.1
+            text = rand.choice(NOTE_TEXTS).format(
+                thing=rand.choice(NOTE_THINGS))
+            note = Note(
+                id=note_id + i * notes_per_release + j,
+                bug=rand.randint(600000, 1100000),
+                note=text[0].upper() + text[1:],
+                is_known_issue=known_issue,
+                fixed_in_release_id=(
+                    later if known_issue and rand.random() < 0.5 else None),
+                tag='' if known_issue else rand.choice(Note.TAGS),
+                sort_num=rand.randint(0, 100),
+                is_public=rand.random() < 0.98)
+            objs.append(note)
+            links.append(Through(note_id=note.id,
+                                 release_id=release_id + i))
+            if later and rand.random() < 0.3:
+                links.append(Through(note_id=note.id, release_id=later))
+        create(Note, objs, 'notes')
+        create(Through, links, 'links')
+
+    # the explicit ids went past the sequences of backends that have them
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), [Release, Note]):
+        cursor.execute(sql)
+    transaction.commit_unless_managed()
+    return counts
@@ -2,21 +2,38 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from datetime import datetime, timedelta
+import hashlib
 from itertools import chain
 import json
 
-from django.http import HttpResponse, HttpResponseForbidden
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.query import QuerySet
+from django.http import (Http404, HttpResponse, HttpResponseForbidden,
+                         HttpResponseRedirect)
 from django.shortcuts import get_object_or_404
-from rest_framework import generics
+from django.template.loader import render_to_string
+from rest_framework import generics, status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.authtoken.models import Token
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.templatetags.rest_framework import replace_query_param
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from . import models
+from . import metrics, models, routers, serializers, utils
 
 
 def auth_token(request):
     if request.user.is_active and request.user.is_staff:
-        token, created = Token.objects.get_or_create(user=request.user)
+        try:
+            with routers.use_replica():
+                token = Token.objects.get(user=request.user)
+        except Token.DoesNotExist:
+            token, created = Token.objects.get_or_create(user=request.user)
         return HttpResponse(
             content=json.dumps({'token': token.key}),
             content_type='application/json')
@@ -24,17 +41,430 @@ def auth_token(request):
         return HttpResponseForbidden()
 
 
-class NoteViewSet(ModelViewSet):
+class ValuesListMixin(object):
+    """
+    List with serializers.ValuesListSerializer, which gives the same data
+    without building model instances, unless the list is paginated or
+    the serializer has a field it can't reproduce.
+    """
+    def list(self, request, *args, **kwargs):
+        if self.get_paginate_by() or not self.allow_empty:
+            return super(ValuesListMixin, self).list(
+                request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        if not isinstance(queryset, QuerySet):
+            return super(ValuesListMixin, self).list(
+                request, *args, **kwargs)
+        try:
+            serializer = serializers.ValuesListSerializer(
+                self.get_serializer(), queryset)
+        except serializers.UnsupportedField:
+            return super(ValuesListMixin, self).list(
+                request, *args, **kwargs)
+        self.object_list = queryset
+        return Response(serializer.data)
+
+
+class ExpandMixin(object):
+    """
+    Embed the related objects named in ?expand=, a comma separated list
+    of paths through the relations in EXPANSIONS, such as
+    ?expand=releases,notes.releases, in safe requests. Paths can be at
+    most RNA['EXPAND_MAX_DEPTH'] relations long, the objects are fetched
+    with prefetch_related, and responses of more than
+    RNA['EXPAND_MAX_OBJECTS'] objects, counting the embedded ones, can't
+    be expanded. Paginated lists are counted a page at a time.
+    """
+    def get_expand(self):
+        """
+        Return the requested relations as a tree of {name: {name: ...}}.
+        """
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in routers.SAFE_METHODS:
+            return {}
+        max_depth = settings.RNA.get('EXPAND_MAX_DEPTH', 2)
+        tree = {}
+        for path in request.QUERY_PARAMS.get('expand', '').split(','):
+            if not path:
+                continue
+            names = path.split('.')
+            if len(names) > max_depth:
+                raise ParseError('Can not expand %s, which is more than %s '
+                                 'relations deep' % (path, max_depth))
+            node, model = tree, self.model
+            for name in names:
+                if name not in EXPANSIONS.get(model, {}):
+                    raise ParseError('Can not expand %s' % path)
+                model = EXPANSIONS[model][name][1].model
+                node = node.setdefault(name, {})
+        return tree
+
+    def get_queryset(self):
+        queryset = super(ExpandMixin, self).get_queryset()
+        expand = self.get_expand()
+        if expand:
+            queryset = queryset.prefetch_related(
+                *expand_lookups(self.model, expand))
+        return queryset
+
+    def get_serializer_class(self):
+        serializer_class = super(ExpandMixin, self).get_serializer_class()
+        expand = self.get_expand()
+        if expand:
+            serializer_class = expanded_serializer_class(
+                self.model, serializer_class, expand)
+        return serializer_class
+
+    def check_expand_size(self, queryset):
+        """
+        Raise ParseError if the objects of queryset and those expanded in
+        them add up to more than RNA['EXPAND_MAX_OBJECTS'], counting them
+        with a query per relation before any is fetched.
+        """
+        max_objects = settings.RNA.get('EXPAND_MAX_OBJECTS', 1000)
+        count = queryset.count()
+        for path in expand_paths(self.model, self.get_expand()):
+            if count > max_objects:
+                break
+            # one per row of the join, as many as are embedded
+            count += queryset.aggregate(count=Count(path))['count']
+        if count > max_objects:
+            raise ParseError('Can not expand more than %s objects, filter '
+                             'them first' % max_objects)
+
+    def paginate_queryset(self, queryset, page_size=None):
+        page = super(ExpandMixin, self).paginate_queryset(
+            queryset, page_size=page_size)
+        if page is not None and self.get_expand():
+            # only the objects of the page are expanded
+            pks = list(page.object_list.prefetch_related(None).values_list(
+                'pk', flat=True))
+            self.check_expand_size(queryset.filter(pk__in=pks))
+        return page
+
+    def list(self, request, *args, **kwargs):
+        if self.get_expand() and not self.get_paginate_by():
+            self.check_expand_size(self.filter_queryset(self.get_queryset()))
+        return super(ExpandMixin, self).list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        if self.get_expand():
+            self.check_expand_size(self.filter_queryset(
+                self.get_queryset()).filter(**{
+                    self.lookup_field: self.kwargs.get(self.lookup_field)}))
+        return super(ExpandMixin, self).retrieve(request, *args, **kwargs)
+
+
+def expand_lookups(model, tree, prefix=''):
+    """
+    Return the prefetch_related lookups for an expand tree: the relations
+    it names, and those the objects it reaches link to, so that their
+    hyperlinks take no query either.
+    """
+    lookups = [prefix + f.name for f in
+               model._meta.fields + model._meta.many_to_many if f.rel]
+    for name, subtree in sorted(tree.items()):
+        source, viewset, many = EXPANSIONS[model][name]
+        if prefix + source not in lookups:
+            lookups.append(prefix + source)
+        lookups.extend(expand_lookups(viewset.model, subtree,
+                                      prefix + source + '__'))
+    return lookups
+
+
+def expand_paths(model, tree, prefix=''):
+    """
+    Return the queryset lookup of each relation in an expand tree, such
+    as note__releases.
+    """
+    paths = []
+    for name, subtree in sorted(tree.items()):
+        source, viewset, many = EXPANSIONS[model][name]
+        # reverse relations are looked up by another name than their
+        # attribute's
+        for related in (model._meta.get_all_related_objects() +
+                        model._meta.get_all_related_many_to_many_objects()):
+            if related.get_accessor_name() == source:
+                source = related.field.related_query_name()
+        paths.append(prefix + source)
+        paths.extend(expand_paths(viewset.model, subtree,
+                                  prefix + source + '__'))
+    return paths
+
+
+def expanded_serializer_class(model, serializer_class, tree):
+    """
+    Return a subclass of serializer_class that nests the serializers of
+    the relations in an expand tree in place of their hyperlinks.
+    """
+    fields = {}
+    for name, subtree in tree.items():
+        source, viewset, many = EXPANSIONS[model][name]
+        nested_class = expanded_serializer_class(
+            viewset.model, viewset().get_serializer_class(), subtree)
+        fields[name] = nested_class(source=source, many=many, read_only=True)
+    return type(serializer_class)(
+        'Expanded' + serializer_class.__name__, (serializer_class,), fields)
+
+
+class NoteViewSet(routers.ReplicaReadMixin, ExpandMixin, ValuesListMixin,
+                  ModelViewSet):
     model = models.Note
+    serializer_class = serializers.NoteSerializer
+
+
+class ReleaseViewSet(routers.ReplicaReadMixin, ExpandMixin, ValuesListMixin,
+                     ModelViewSet):
+    model = models.Release
+
+
+# name: (source, viewset of the related model, many) of the relations
+# that ?expand= can embed, by model
+EXPANSIONS = {
+    models.Note: {
+        'releases': ('releases', ReleaseViewSet, True),
+        'fixed_in_release': ('fixed_in_release', ReleaseViewSet, False),
+    },
+    models.Release: {
+        'notes': ('note_set', NoteViewSet, True),
+    },
+}
+
 
+class TombstoneViewSet(routers.ReplicaReadMixin, ValuesListMixin,
+                       ReadOnlyModelViewSet):
+    model = models.Tombstone
 
-class ReleaseViewSet(ModelViewSet):
+
+class ReleaseCopyView(routers.ReplicaReadMixin, generics.GenericAPIView):
+    """
+    Copy the releases whose ids are POSTed as ids, with their notes.
+    """
     model = models.Release
 
+    def post(self, request, *args, **kwargs):
+        if hasattr(request.DATA, 'getlist'):
+            ids = request.DATA.getlist('ids')
+        else:
+            ids = request.DATA.get('ids', [])
+        copies = utils.copy_releases(
+            models.Release.objects.filter(pk__in=ids))
+        return Response(self.get_serializer(copies, many=True).data,
+                        status=status.HTTP_201_CREATED)
+
 
-class NestedNoteView(generics.ListAPIView):
+class NestedNoteView(routers.ReplicaReadMixin, generics.ListAPIView):
     model = models.Note
+    serializer_class = serializers.NoteSerializer
 
     def get_queryset(self):
         release = get_object_or_404(models.Release, pk=self.kwargs.get('pk'))
         return chain(*release.notes())
+
+
+class ReleaseDiffView(routers.ReplicaReadMixin, generics.GenericAPIView):
+    """
+    Notes added, removed and modified between two releases.
+    """
+    model = models.Note
+    serializer_class = serializers.NoteSerializer
+
+    def get(self, request, *args, **kwargs):
+        release = get_object_or_404(models.Release, pk=kwargs.get('pk'))
+        other = get_object_or_404(models.Release, pk=kwargs.get('other_pk'))
+        etag = release.note_diff_etag(other)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = {}
+            for key, notes in zip(('added', 'removed', 'modified'),
+                                  release.note_diff(other)):
+                data[key] = self.get_serializer(notes.select_related(
+                    'fixed_in_release').prefetch_related('releases'),
+                    many=True).data
+            response = Response(data)
+        response['ETag'] = etag
+        return response
+
+
+class ReleasePageView(routers.ReplicaReadMixin, generics.GenericAPIView):
+    """
+    Everything a release notes page shows, from Release.page: the release,
+    its new features and known issues, its equivalent releases and its
+    bug search URL, with the page rendered by the rna/release_page.html
+    template as html if ?html=1. Pass ?public_only=1 for public notes
+    only. Responses are cached for RNA['RELEASE_PAGE_CACHE_TIMEOUT']
+    seconds under their ETag.
+    """
+    model = models.Release
+
+    def get(self, request, *args, **kwargs):
+        release = get_object_or_404(models.Release, pk=kwargs.get('pk'))
+        public_only = request.QUERY_PARAMS.get('public_only') == '1'
+        html = request.QUERY_PARAMS.get('html') == '1'
+        etag = release.page_etag(public_only)
+        if html:
+            etag = '%s-html"' % etag[:-1]
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
+
+        key = 'rna:page:' + hashlib.md5(etag).hexdigest()
+        data = cache.get(key)
+        metrics.inc('rna_cache_requests_total', cache='release_page',
+                    result='miss' if data is None else 'hit')
+        if data is None:
+            data = self.page_data(release.page(public_only), html)
+            cache.set(key, data,
+                      settings.RNA.get('RELEASE_PAGE_CACHE_TIMEOUT', 300))
+        response = Response(data)
+        response['ETag'] = etag
+        return response
+
+    def page_data(self, page, html):
+        context = self.get_serializer_context()
+
+        def release_data(release):
+            if release is None:
+                return None
+            return self.get_serializer(release).data
+
+        data = {
+            'release': release_data(page['release']),
+            'new_features': serializers.NoteSerializer(
+                page['new_features'], many=True, context=context).data,
+            'known_issues': serializers.NoteSerializer(
+                page['known_issues'], many=True, context=context).data,
+            'equivalent_android_release': release_data(
+                page['equivalent_android_release']),
+            'equivalent_desktop_release': release_data(
+                page['equivalent_desktop_release']),
+            'bug_search_url': page['bug_search_url'],
+        }
+        if html:
+            data['html'] = render_to_string('rna/release_page.html', page)
+        return data
+
+
+class ReleasePayloadView(ReleasePageView):
+    """
+    The page of a released release with its public notes, at a URL with
+    the SHA-1 of its content, served as immutable so that caches keep it
+    for good. The URL without the hash, or with an outdated one,
+    redirects to the current one; this is the release's mutable payload
+    URL, while releases/<pk>/ and releases/<pk>/page/ keep serving their
+    data directly, since API clients, rnasync and editors previewing
+    unreleased releases read them. The content and its hash are built
+    again only when the page ETag changes, and are cached for
+    RNA['RELEASE_PAYLOAD_CACHE_TIMEOUT'] seconds.
+    """
+    def payload(self, release):
+        """
+        Return the hash and JSON of the payload of a release. Which
+        payload is current is remembered under the release's modified
+        timestamp for RNA['RELEASE_PAYLOAD_DIGEST_TIMEOUT'] seconds, so
+        that until then serving it takes no queries. Only after that is
+        the page ETag, which also covers the notes and the equivalent
+        releases, computed again.
+        """
+        # hyperlinks are absolute, so each host has its own payload
+        host = self.request.build_absolute_uri('/')
+        current_key = 'rna:payload:current:' + hashlib.md5('%s:%s:%s' % (
+            release.pk, release.modified, host)).hexdigest()
+        key = cache.get(current_key)
+        payload = cache.get(key) if key else None
+        if payload is None:
+            key = 'rna:payload:' + hashlib.md5('%s:%s' % (
+                release.page_etag(public_only=True), host)).hexdigest()
+            payload = cache.get(key)
+            metrics.inc('rna_cache_requests_total', cache='release_payload',
+                        result='miss' if payload is None else 'hit')
+            if payload is None:
+                content = JSONRenderer().render(self.page_data(
+                    release.page(public_only=True), False))
+                payload = (hashlib.sha1(content).hexdigest(), content)
+                cache.set(key, payload, settings.RNA.get(
+                    'RELEASE_PAYLOAD_CACHE_TIMEOUT', 86400))
+            cache.set(current_key, key, settings.RNA.get(
+                'RELEASE_PAYLOAD_DIGEST_TIMEOUT', 60))
+        else:
+            metrics.inc('rna_cache_requests_total', cache='release_payload',
+                        result='hit')
+        return payload
+
+    def get(self, request, *args, **kwargs):
+        release = get_object_or_404(models.Release, pk=kwargs.get('pk'))
+        if not release.is_released():
+            raise Http404
+        digest, content = self.payload(release)
+        if kwargs.get('digest') != digest:
+            response = HttpResponseRedirect(reverse(
+                'release-payload', kwargs={'pk': release.pk,
+                                           'digest': digest},
+                request=request))
+            response['Cache-Control'] = 'max-age=%d' % settings.RNA.get(
+                'RELEASE_PAYLOAD_REDIRECT_MAX_AGE', 60)
+            return response
+        etag = '"%s"' % digest
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+def settled(since, changes):
+    """
+    Return the changes, ordered by id, up to the first that is recent and
+    doesn't follow on from the one before, so from since for the first.
+    """
+    recent = datetime.now() - timedelta(
+        seconds=settings.RNA.get('CHANGES_SETTLE_TIME', 60))
+    result = []
+    for change in changes:
+        if change['created'] > recent and change['id'] != since + 1:
+            break
+        result.append(change)
+        since = change['id']
+    return result
+
+
+class ChangeFeedView(routers.ReplicaReadMixin, generics.GenericAPIView):
+    """
+    Changes with a sequence number above since, oldest first, in pages of
+    RNA['CHANGES_PAGE_SIZE']. Continue from last_seq, or follow next
+    until it is null.
+
+    Sequence numbers are taken when a change is written but the change is
+    only seen once its transaction commits, so a change with a lower
+    number may still be in flight. Changes from the last
+    RNA['CHANGES_SETTLE_TIME'] seconds are only returned while their
+    numbers follow on without a gap, which should be longer than any
+    transaction that writes changes.
+    """
+    model = models.Change
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.QUERY_PARAMS.get('since', 0))
+        except ValueError:
+            return Response({'detail': 'since must be a sequence number'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        size = settings.RNA.get('CHANGES_PAGE_SIZE', 1000)
+        # one more than a page tells whether there is a next page
+        changes = settled(since, models.Change.objects.filter(
+            id__gt=since).values('id', 'kind', 'action', 'object_id',
+                                 'related_id', 'created')[:size + 1])
+        next_url = None
+        if len(changes) > size:
+            changes = changes[:size]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'since', changes[-1]['id'])
+        return Response({
+            'results': changes,
+            'next': next_url,
+            'last_seq': changes[-1]['id'] if changes else since,
+        })
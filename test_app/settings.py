@@ -5,7 +5,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'test.db',
-    }
+    },
+    # for the read replica routing tests; RNA['REPLICAS'] is empty, so
+    # nothing reads from it otherwise
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.db',
+    },
 }
 
 USE_TZ = False